@@ -1,19 +1,50 @@
 import json
 import os
+from concurrent.futures import ThreadPoolExecutor
 from openai import OpenAI
-from models import User, Session, Registration, Attendance
-from app import db
+from models import Session, Registration, Attendance
+from app import app
+from instrumentation import timed
+import participant_analytics
+import participant_search
 import logging
 
 # the newest OpenAI model is "gpt-5" which was released August 7, 2025.
 # do not change this unless explicitly requested by the user
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "sk-test-key")
-openai = OpenAI(api_key=OPENAI_API_KEY)
+# Deadline for one model call; callers that want retries (profile_enrichment.py) do their own
+AI_CALL_TIMEOUT = float(os.environ.get("AI_CALL_TIMEOUT", 20))  # seconds
+AI_MAX_RETRIES = int(os.environ.get("AI_MAX_RETRIES", 0))
+AI_MAX_CONCURRENCY = int(os.environ.get("AI_MAX_CONCURRENCY", 4))
+SEARCH_RESULTS = 10  # Text matches shown when the model cannot re-rank
+openai = OpenAI(api_key=OPENAI_API_KEY, timeout=AI_CALL_TIMEOUT, max_retries=AI_MAX_RETRIES)
+
+# Independent model calls run here side by side instead of one after another
+_ai_executor = ThreadPoolExecutor(max_workers=AI_MAX_CONCURRENCY, thread_name_prefix='ai')
+
+def submit(func, *args):
+    """Run func(*args) on the AI pool inside an app context; returns its Future"""
+    def run():
+        with app.app_context():
+            return func(*args)
+    return _ai_executor.submit(run)
+
+@timed('ai')
+def _chat_completion(**kwargs):
+    """Call the chat completions API, timed for request instrumentation"""
+    return openai.chat.completions.create(**kwargs)
 
 def generate_professional_description(goal, activity_type=""):
     """Generate a professional Arabic description based on user's goal and activity"""
     try:
-        prompt = f"""
+        return request_professional_description(goal, activity_type)
+    except Exception as e:
+        logging.error(f"AI description generation failed: {e}")
+        return ""
+
+def request_professional_description(goal, activity_type=""):
+    """Ask the model for a profile description, raising on failure so callers can retry"""
+    prompt = f"""
         أنت خبير في كتابة الأوصاف المهنية باللغة العربية. 
         
         المعطيات:
@@ -28,94 +59,32 @@ def generate_professional_description(goal, activity_type=""):
         - باللغة العربية الفصحى المبسطة
         
         أرجع النتيجة في تنسيق JSON بهذا الشكل:
-        {"description": "الوصف المهني هنا"}
+        {{"description": "الوصف المهني هنا"}}
         """
-        
-        response = openai.chat.completions.create(
-            model="gpt-5",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            max_completion_tokens=200
-        )
-        
-        result = json.loads(response.choices[0].message.content)
-        return result.get("description", "")
-        
-    except Exception as e:
-        logging.error(f"AI description generation failed: {e}")
-        return ""
 
-def analyze_participant_data(analysis_type):
-    """Analyze participant data using AI for insights"""
-    try:
-        # Initialize data variable
-        data = {}
-        
-        # Get data based on analysis type
-        if analysis_type == "demographics":
-            users = User.query.all()
-            data = {
-                "total_users": len(users),
-                "activity_types": {},
-                "companies": [],
-                "goals": []
-            }
-            
-            for user in users:
-                if user.activity_type:
-                    data["activity_types"][user.activity_type] = data["activity_types"].get(user.activity_type, 0) + 1
-                if user.company_name:
-                    data["companies"].append(user.company_name)
-                if user.goal:
-                    data["goals"].append(user.goal)
-        
-        elif analysis_type == "trends":
-            sessions = Session.query.all()
-            registrations = Registration.query.all()
-            data = {
-                "total_sessions": len(sessions),
-                "total_registrations": len(registrations),
-                "sessions_data": []
-            }
-            
-            for session in sessions:
-                data["sessions_data"].append({
-                    "title": session.title,
-                    "date": session.date.strftime("%Y-%m-%d"),
-                    "registrations": session.get_registration_count()
-                })
-        
-        elif analysis_type == "insights":
-            attendances = Attendance.query.filter_by(attended=True).all()
-            data = {
-                "total_attendances": len(attendances),
-                "attendance_patterns": {},
-                "repeat_attendees": 0
-            }
-            
-            # Calculate repeat attendees
-            user_attendance_count = {}
-            for attendance in attendances:
-                user_attendance_count[attendance.user_id] = user_attendance_count.get(attendance.user_id, 0) + 1
-            
-            data["repeat_attendees"] = len([count for count in user_attendance_count.values() if count > 1])
-        
-        else:
-            # Fallback for unknown analysis types
-            data = {"error": f"Unknown analysis type: {analysis_type}"}
-        
-        # If no OpenAI API key available, return basic data analysis
-        if not OPENAI_API_KEY:
-            return {
-                "summary": "تحليل البيانات الأساسي",
-                "key_insights": ["البيانات متوفرة للمراجعة"],
-                "recommendations": ["تفعيل خدمة الذكاء الاصطناعي للحصول على تحليل أعمق"],
-                "metrics": data,
-                "raw_data": data
-            }
-        
-        # Generate AI analysis
-        prompt = f"""
+    response = _chat_completion(
+        model="gpt-5",
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        max_completion_tokens=200
+    )
+
+    result = json.loads(response.choices[0].message.content)
+    return result.get("description", "")
+
+def basic_participant_analysis(data):
+    """Analysis without the model: the figures alone"""
+    return {
+        "summary": "تحليل البيانات الأساسي",
+        "key_insights": ["البيانات متوفرة للمراجعة"],
+        "recommendations": ["تفعيل خدمة الذكاء الاصطناعي للحصول على تحليل أعمق"],
+        "metrics": data,
+        "raw_data": data
+    }
+
+def request_participant_analysis(analysis_type, data):
+    """Ask the model to analyze aggregated figures, raising on failure"""
+    prompt = f"""
         أنت محلل بيانات خبير. حلل البيانات التالية واستخرج رؤى مفيدة باللغة العربية:
         
         نوع التحليل: {analysis_type}
@@ -135,22 +104,33 @@ def analyze_participant_data(analysis_type):
             "metrics": {{"metric1": value1, "metric2": value2}}
         }}
         """
+    
+    response = _chat_completion(
+        model="gpt-5",
+        messages=[{"role": "user", "content": prompt}],
+        response_format={"type": "json_object"},
+        max_tokens=1000
+    )
+    
+    # Safely parse the JSON response
+    content = response.choices[0].message.content
+    if not content:
+        raise ValueError("Empty response from AI service")
+    result = json.loads(content)
+    result["raw_data"] = data
+    return result
+
+def analyze_participant_data(analysis_type):
+    """Analyze participant data using AI for insights"""
+    try:
+        # Pre-aggregated figures; the raw rows never leave the database
+        data = participant_analytics.metrics(analysis_type)
         
-        response = openai.chat.completions.create(
-            model="gpt-5",
-            messages=[{"role": "user", "content": prompt}],
-            response_format={"type": "json_object"},
-            max_tokens=1000
-        )
+        # If no OpenAI API key available, return basic data analysis
+        if not OPENAI_API_KEY:
+            return basic_participant_analysis(data)
         
-        # Safely parse the JSON response
-        content = response.choices[0].message.content
-        if content:
-            result = json.loads(content)
-            result["raw_data"] = data
-            return result
-        else:
-            raise ValueError("Empty response from AI service")
+        return request_participant_analysis(analysis_type, data)
         
     except Exception as e:
         logging.error(f"AI analysis failed: {e}")
@@ -164,33 +144,32 @@ def analyze_participant_data(analysis_type):
             "error": str(e)
         }
 
+def _text_matches(candidates, limit=SEARCH_RESULTS):
+    """Candidates in full-text rank order, for when the model is unavailable"""
+    return [{
+        "id": c["id"],
+        "name": c["name"],
+        "reason": "مطابقة نصية",
+        "relevance": round(1 - i / len(candidates), 2)
+    } for i, c in enumerate(candidates[:limit])]
+
 def search_participants(query):
     """Intelligent search through participant data using natural language"""
+    # Full-text index first; only its top candidates reach the model
+    candidates = participant_search.candidates(query)
+    if not candidates:
+        return {"matches": [], "search_summary": "لا توجد نتائج مطابقة"}
+    if not OPENAI_API_KEY:
+        return {"matches": _text_matches(candidates), "search_summary": "نتائج البحث النصي"}
+
     try:
-        # Get all users data
-        users = User.query.all()
-        users_data = []
-        
-        for user in users:
-            user_info = {
-                "id": user.id,
-                "name": user.name,
-                "email": user.email,
-                "company": user.company_name or "",
-                "position": user.position or "",
-                "activity": user.activity_type or "",
-                "goal": user.goal or "",
-                "attendance_count": user.get_attendance_count()
-            }
-            users_data.append(user_info)
-        
         prompt = f"""
-        أنت محرك بحث ذكي للمشاركين. استخدم الاستعلام التالي للبحث في بيانات المشاركين:
+        أنت محرك بحث ذكي للمشاركين. هؤلاء المرشحون الأقرب للاستعلام من البحث النصي، رتّبهم حسب مطابقتهم له:
         
         الاستعلام: {query}
-        بيانات المشاركين: {json.dumps(users_data, ensure_ascii=False)[:3000]}
+        المرشحون: {json.dumps(candidates, ensure_ascii=False)}
         
-        ابحث وأرجع المشاركين الذين يطابقون الاستعلام. يمكن أن يكون البحث عن:
+        أرجع فقط المرشحين الذين يطابقون الاستعلام فعلاً (بمعرّفاتهم كما وردت). يمكن أن يكون البحث عن:
         - الأسماء أو الشركات
         - أنواع الأنشطة
         - الأهداف أو المهارات
@@ -206,7 +185,7 @@ def search_participants(query):
         }}
         """
         
-        response = openai.chat.completions.create(
+        response = _chat_completion(
             model="gpt-5",
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"},
@@ -214,11 +193,22 @@ def search_participants(query):
         )
         
         result = json.loads(response.choices[0].message.content)
+        # Keep the model to the candidates it was given
+        names = {c["id"]: c["name"] for c in candidates}
+        matches = []
+        for match in result.get("matches", []):
+            try:
+                user_id = int(match.get("id"))
+            except (TypeError, ValueError):
+                continue
+            if user_id in names:
+                matches.append(dict(match, id=user_id, name=names[user_id]))
+        result["matches"] = matches
         return result
         
     except Exception as e:
         logging.error(f"AI search failed: {e}")
-        return {"matches": [], "search_summary": "فشل في البحث"}
+        return {"matches": _text_matches(candidates), "search_summary": "نتائج البحث النصي"}
 
 def generate_session_insights(session_id):
     """Generate AI insights for a specific session"""
@@ -260,7 +250,7 @@ def generate_session_insights(session_id):
         أرجع النتيجة في تنسيق JSON باللغة العربية.
         """
         
-        response = openai.chat.completions.create(
+        response = _chat_completion(
             model="gpt-5",
             messages=[{"role": "user", "content": prompt}],
             response_format={"type": "json_object"},
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Stored AI analyses for the analytics pages.
+
+Each analysis type keeps one AIAnalytics row holding the model's answer and
+a fingerprint (SHA-256) of the aggregated figures it was written from. A
+request recomputes the figures, which is a few GROUP BY queries, and:
+
+- serves the stored analysis if the fingerprint matches;
+- otherwise regenerates it on the AI pool (at most once per
+  AI_ANALYTICS_MIN_REFRESH seconds, and not again for
+  AI_ANALYTICS_RETRY_AFTER seconds after a failure), all stale types at
+  once, waiting up to AI_PAGE_BUDGET seconds for the answers;
+- serves what missed the budget from the store marked stale, or as the
+  figures alone marked pending. The model call keeps running under its
+  own deadline (AI_CALL_TIMEOUT) and stores its answer for the next load.
+
+raw_data is always the current figures, so the charts never lag.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import wait
+from datetime import datetime, timedelta
+
+import ai_service
+import participant_analytics
+from ai_service import basic_participant_analysis, request_participant_analysis
+from app import db
+from models import AIAnalytics
+
+logger = logging.getLogger(__name__)
+
+AI_ANALYTICS_MIN_REFRESH = int(os.environ.get('AI_ANALYTICS_MIN_REFRESH', 300))  # seconds
+AI_ANALYTICS_RETRY_AFTER = int(os.environ.get('AI_ANALYTICS_RETRY_AFTER', 300))  # seconds
+# How long a request waits for fresh analyses before answering with the figures alone
+AI_PAGE_BUDGET = float(os.environ.get('AI_PAGE_BUDGET', 3))  # seconds
+
+_lock = threading.Lock()
+_running = {}  # analysis type -> Future of its regeneration
+_failed_at = {}  # analysis type -> time.monotonic() of the last failure
+
+
+def fingerprint(data):
+    """Stable hash of an analysis' input figures"""
+    encoded = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def _stored(analysis_type):
+    return AIAnalytics.query.filter(
+        AIAnalytics.analysis_type == analysis_type, AIAnalytics.session_id.is_(None)
+    ).order_by(AIAnalytics.generated_at.desc()).first()
+
+
+def _regenerate(analysis_type, data, current):
+    """Ask the model about data and store the answer; returns (analysis, generated_at)"""
+    result = request_participant_analysis(analysis_type, data)
+    # The figures are recomputed on every read; keep only the model's answer
+    result.pop('raw_data', None)
+    stored = _stored(analysis_type)
+    if stored is None:
+        stored = AIAnalytics(analysis_type=analysis_type)
+        db.session.add(stored)
+    stored.data = result
+    stored.fingerprint = current
+    stored.generated_at = datetime.utcnow()
+    db.session.commit()
+    logger.info("Stored %s analysis %s", analysis_type, current[:12])
+    return result, stored.generated_at
+
+
+def _finished(analysis_type, future):
+    error = future.exception()
+    if error is not None:
+        logger.error("%s analysis failed: %s", analysis_type, error)
+        with _lock:
+            _failed_at[analysis_type] = time.monotonic()
+
+
+def schedule_refresh(analysis_type, data, current):
+    """Start regenerating an analysis unless it is already running or just failed; returns the Future"""
+    with _lock:
+        future = _running.get(analysis_type)
+        if future is not None and not future.done():
+            return future
+        failed_at = _failed_at.get(analysis_type)
+        if failed_at is not None and time.monotonic() - failed_at < AI_ANALYTICS_RETRY_AFTER:
+            return None
+        future = ai_service.submit(_regenerate, analysis_type, data, current)
+        _running[analysis_type] = future
+    future.add_done_callback(lambda f: _finished(analysis_type, f))
+    return future
+
+
+def get_many(analysis_types, budget=AI_PAGE_BUDGET):
+    """Analyses for the current figures, keyed by type, within budget seconds.
+
+    Each result carries cache: fresh, stale or pending, and generated_at when
+    an analysis is stored.
+    """
+    results, waiting = {}, {}
+    for analysis_type in analysis_types:
+        data = participant_analytics.metrics(analysis_type)
+        if not ai_service.OPENAI_API_KEY or 'error' in data:
+            results[analysis_type] = basic_participant_analysis(data)
+            continue
+        current = fingerprint(data)
+        stored = _stored(analysis_type)
+        if stored is not None and stored.fingerprint == current:
+            results[analysis_type] = dict(stored.data, raw_data=data, cache='fresh',
+                                          generated_at=stored.generated_at.isoformat())
+            continue
+        future = None
+        if stored is None or stored.generated_at <= datetime.utcnow() - timedelta(seconds=AI_ANALYTICS_MIN_REFRESH):
+            future = schedule_refresh(analysis_type, data, current)
+        waiting[analysis_type] = (data, stored, future)
+
+    futures = [future for _, _, future in waiting.values() if future is not None]
+    if futures and budget > 0:
+        wait(futures, timeout=budget)
+
+    for analysis_type, (data, stored, future) in waiting.items():
+        if future is not None and future.done() and future.exception() is None:
+            analysis, generated_at = future.result()
+            results[analysis_type] = dict(analysis, raw_data=data, cache='fresh',
+                                          generated_at=generated_at.isoformat())
+        elif stored is not None:
+            results[analysis_type] = dict(stored.data, raw_data=data, cache='stale',
+                                          generated_at=stored.generated_at.isoformat())
+        else:
+            results[analysis_type] = dict(basic_participant_analysis(data), cache='pending')
+    return results
+
+
+def get(analysis_type, budget=AI_PAGE_BUDGET):
+    """The analysis of one type; see get_many()"""
+    return get_many([analysis_type], budget)[analysis_type]
@@ -84,6 +84,14 @@ with app.app_context():
     
     # Create all tables
     db.create_all()
+
+    # create_all() never alters existing tables - apply versioned migrations
+    import migrations
+    migrations.upgrade(db.engine)
+
+    # Opt-in per-request timings (PERF_INSTRUMENTATION=1)
+    import instrumentation
+    instrumentation.init_app(app, db)
     
     # Create default admin if not exists
     from models import Admin
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+Arabic text normalization for search.
+
+Indexed documents and queries go through the same terms() so spelling
+variants meet: diacritics and tatweel are dropped, alef forms fold to ا,
+alef maqsura to ي, ta marbuta to ه and hamza carriers to their base
+letter, Arabic-Indic digits become ASCII and Latin text is lowercased. A
+light stemmer then strips the definite article (with a leading و/ب/ك/ف)
+and common function words are left out.
+"""
+
+import re
+
+_DIACRITICS = re.compile('[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]')
+_FOLD = str.maketrans({
+    'أ': 'ا', 'إ': 'ا', 'آ': 'ا', 'ٱ': 'ا',
+    'ى': 'ي', 'ئ': 'ي',
+    'ة': 'ه',
+    'ؤ': 'و',
+    '٠': '0', '١': '1', '٢': '2', '٣': '3', '٤': '4',
+    '٥': '5', '٦': '6', '٧': '7', '٨': '8', '٩': '9',
+})
+_NON_WORD = re.compile(r'[\W_]+')
+_ARTICLES = ('وال', 'بال', 'كال', 'فال', 'لل', 'ال')
+
+_STOP_WORDS = (
+    'في من إلى على عن مع أو و ثم أن إن هو هي هم التي الذي الذين هذا هذه ذلك تلك كل بعض لدي لديه '
+    'عند مثل غير بين حول يعمل تعمل يعملون مجال مشارك مشاركين أريد ابحث '
+    'the a an of in on for and or to with who is are'
+)
+
+
+def normalize(text):
+    """Fold spelling variants and punctuation away; returns space-separated words"""
+    text = _DIACRITICS.sub('', (text or '').lower()).translate(_FOLD)
+    return _NON_WORD.sub(' ', text).strip()
+
+
+STOP_WORDS = frozenset(normalize(_STOP_WORDS).split())
+
+
+def _stem(word):
+    for article in _ARTICLES:
+        # Words left with fewer than two letters keep their article
+        if word.startswith(article) and len(word) - len(article) >= 2:
+            return word[len(article):]
+    return word
+
+
+def terms(text):
+    """Search terms of a text, in order, without duplicates or stop words"""
+    seen = []
+    for word in normalize(text).split():
+        if word in STOP_WORDS:
+            continue
+        word = _stem(word)
+        if len(word) > 1 and word not in STOP_WORDS and word not in seen:
+            seen.append(word)
+    return seen
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Runs long admin actions off the request.
+
+The request records a BackgroundJob row and returns its id straight away; the
+work runs on a small thread pool inside an app context and reports progress on
+the row, which the admin UI polls through /admin/jobs/<id>.
+
+Jobs live only in the process that started them. A heartbeat thread stamps
+the process' queued and running jobs every JOB_HEARTBEAT_SECONDS, and a job
+whose stamp is older than JOB_STALE_SECONDS (its worker restarted or died) is
+marked failed the next time jobs are looked up, so it neither blocks a new
+approve-all nor keeps the UI polling. A partial unique index allows one
+active approve-all job per session.
+"""
+
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import BackgroundJob
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get('BULK_JOB_WORKERS', 2))
+JOB_HEARTBEAT_SECONDS = int(os.environ.get('BULK_JOB_HEARTBEAT_SECONDS', 30))
+JOB_STALE_SECONDS = int(os.environ.get('BULK_JOB_STALE_SECONDS', 120))
+ACTIVE_STATUSES = ('queued', 'running')
+
+_job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='bulk-job')
+_active = set()  # Ids of the queued and running jobs of this process
+_active_lock = threading.Lock()
+_heartbeat = None
+
+
+def _beat():
+    while True:
+        time.sleep(JOB_HEARTBEAT_SECONDS)
+        with _active_lock:
+            job_ids = list(_active)
+        if not job_ids:
+            continue
+        with app.app_context():
+            try:
+                db.session.execute(
+                    db.update(BackgroundJob)
+                    .where(BackgroundJob.id.in_(job_ids), BackgroundJob.status.in_(ACTIVE_STATUSES))
+                    .values(heartbeat_at=datetime.utcnow())
+                )
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning("Job heartbeat failed: %s", e)
+
+
+def _track(job_id):
+    global _heartbeat
+    with _active_lock:
+        _active.add(job_id)
+        if _heartbeat is None:
+            _heartbeat = threading.Thread(target=_beat, name='bulk-job-heartbeat', daemon=True)
+            _heartbeat.start()
+
+
+def fail_stale():
+    """Mark queued or running jobs whose worker stopped beating as failed"""
+    now = datetime.utcnow()
+    result = db.session.execute(
+        db.update(BackgroundJob)
+        .where(
+            BackgroundJob.status.in_(ACTIVE_STATUSES),
+            db.func.coalesce(BackgroundJob.heartbeat_at, BackgroundJob.created_at)
+            < now - timedelta(seconds=JOB_STALE_SECONDS)
+        )
+        .values(status='failed', error="Interrupted: the worker running this job stopped", finished_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount:
+        logger.warning("Marked %s interrupted background jobs as failed", result.rowcount)
+    db.session.commit()
+
+
+def in_flight(kind, session_id):
+    """The queued or running job of this kind for a session, if any"""
+    fail_stale()
+    return BackgroundJob.query.filter(
+        BackgroundJob.kind == kind,
+        BackgroundJob.session_id == session_id,
+        BackgroundJob.status.in_(ACTIVE_STATUSES)
+    ).first()
+
+
+def start(kind, session_id, work, *args, total=0, result=None):
+    """Record a job and run work(job, *args) in the background; returns the job.
+
+    For an approve-all job the index allows only one per session: when another
+    request started one meanwhile, that job is returned instead.
+    """
+    job = BackgroundJob(kind=kind, session_id=session_id, status='queued', total=total, result=result,
+                        heartbeat_at=datetime.utcnow())
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        job = in_flight(kind, session_id)
+        if job is None:
+            raise
+        return job
+    _track(job.id)
+    _job_executor.submit(_run_job, job.id, work, args)
+    return job
+
+
+def _run_job(job_id, work, args):
+    with app.app_context():
+        try:
+            _run(job_id, work, args)
+        finally:
+            with _active_lock:
+                _active.discard(job_id)
+
+
+def _run(job_id, work, args):
+    job = db.session.get(BackgroundJob, job_id)
+    job.status = 'running'
+    job.started_at = job.heartbeat_at = datetime.utcnow()
+    db.session.commit()
+    try:
+        work(job, *args)
+        job.status = 'done'
+    except Exception as e:
+        logger.exception("%s job %s failed", job.kind, job_id)
+        db.session.rollback()
+        job = db.session.get(BackgroundJob, job_id)
+        job.status = 'failed'
+        job.error = str(e)
+    job.finished_at = datetime.utcnow()
+    db.session.commit()
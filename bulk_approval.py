@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""
+Approve-all as a background job.
+
+The admin request only records a BackgroundJob row and returns its id; a job
+thread then approves the session's pending registrations in one transaction
+(one set-based UPDATE, one bulk INSERT for new companion guest registrations
+and one seat reservation) and afterwards renders the tickets on a thread pool
+and queues the confirmation emails in batches, updating the job's progress
+as it goes. The outbox worker sends the emails.
+"""
+
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from sqlalchemy.orm import selectinload
+
+import background_jobs
+from app import db
+from models import Registration, Session
+from tickets import make_ticket, KIND_REGISTRANT, KIND_COMPANION
+from utils import generate_qr_code, send_registration_confirmed_email, send_companion_registered_email
+
+logger = logging.getLogger(__name__)
+
+QR_RENDER_CONCURRENCY = int(os.environ.get('QR_RENDER_CONCURRENCY', 4))
+EMAIL_BATCH_SIZE = 50
+# Concurrent sign-ups and single approvals can change seats between planning and writing; replan this often
+RESERVE_ATTEMPTS = 3
+
+
+def start_approve_all(session_id):
+    """Queue approve-all for a session, returning the job already in flight if there is one"""
+    job = background_jobs.in_flight('approve_all', session_id)
+    if job:
+        return job
+    return background_jobs.start('approve_all', session_id, approve_all)
+
+
+def _plan(session_obj):
+    """Pick the pending registrations that fit, in sign-up order.
+
+    Returns (approve_ids, new_companions, registrants, existing_ids, seats, skipped)
+    where registrants holds (registration, [(companion name, email)]) for the emails,
+    new_companions maps companion email -> Companion needing a guest registration
+    and existing_ids maps companion email -> their existing guest registration id.
+    """
+    pending = Registration.query.options(
+        selectinload(Registration.companions), selectinload(Registration.user)
+    ).filter_by(session_id=session_obj.id, is_approved=False).order_by(
+        Registration.registered_at.asc(), Registration.id.asc()
+    ).all()
+
+    companion_emails = {c.email for r in pending for c in r.companions if c.email}
+    guest_registrations = {}
+    if companion_emails:
+        guest_registrations = {r.guest_email: r for r in Registration.query.filter(
+            Registration.session_id == session_obj.id,
+            Registration.guest_email.in_(companion_emails)
+        )}
+    # Companions whose seat is already counted, before or during this plan
+    seated = {email for email, r in guest_registrations.items() if r.is_approved}
+
+    seats_left = session_obj.max_participants - session_obj.get_registration_count()
+    approve_ids, new_companions, registrants = set(), {}, []
+    held = set()  # Guest registrations of companions whose registrant did not fit
+    seats = skipped = 0
+    for registration in pending:
+        # Guest registrations of companions are approved (or held back) with their registrant
+        if registration.id in approve_ids or registration.id in held:
+            continue
+        emailed = {c.email: c for c in registration.companions if c.email}
+        needed = 1 + sum(1 for email in emailed if email not in seated)
+        if needed > seats_left:
+            skipped += 1
+            held.update(guest_registrations[email].id for email in emailed if email in guest_registrations)
+            continue
+        seats_left -= needed
+        seats += needed
+        approve_ids.add(registration.id)
+
+        pairs = []
+        for email, companion in emailed.items():
+            existing = guest_registrations.get(email)
+            if existing is not None:
+                approve_ids.add(existing.id)
+            elif email not in new_companions:
+                new_companions[email] = companion
+            seated.add(email)
+            pairs.append((companion.name, email))
+        registrants.append((registration, pairs))
+
+    existing_ids = {email: r.id for email, r in guest_registrations.items()}
+    return approve_ids, new_companions, registrants, existing_ids, seats, skipped
+
+
+def _approve(session_obj):
+    """Approve everything that fits in one transaction; returns the email work and counts"""
+    for _ in range(RESERVE_ATTEMPTS):
+        approve_ids, new_companions, registrants, companion_ids, seats, skipped = _plan(session_obj)
+
+        # Everything the emails need, read before the commit expires the objects
+        recipients = [(r.id, r.get_registrant_email(), r.get_registrant_name(), pairs) for r, pairs in registrants]
+
+        roster_version = Session.next_roster_version(session_obj.id)
+        if approve_ids:
+            # Only rows still pending; one approved on its own since the plan means the seats are off
+            approved_ids = set(db.session.scalars(
+                db.update(Registration)
+                .where(Registration.id.in_(approve_ids), Registration.is_approved.is_(False))
+                .values(is_approved=True, roster_version=roster_version)
+                .returning(Registration.id)
+                .execution_options(synchronize_session=False)
+            ))
+            if approved_ids != approve_ids:
+                db.session.rollback()
+                continue
+        if not session_obj.reserve_seats(seats):
+            db.session.rollback()
+            continue
+        if new_companions:
+            rows = [{
+                'session_id': session_obj.id,
+                'guest_name': c.name,
+                'guest_email': email,
+                'guest_phone': c.phone,
+                'guest_company_name': c.company,
+                'guest_position': c.title,
+                'is_approved': True,
+                'registered_at': datetime.utcnow(),
+                'roster_version': roster_version
+            } for email, c in new_companions.items()]
+            new_ids = db.session.scalars(
+                db.insert(Registration).returning(Registration.id, sort_by_parameter_order=True), rows
+            ).all()
+            companion_ids.update(zip(new_companions, new_ids))
+        # Set-based writes skip the ORM flush hooks that invalidate cached pages and stamp roster versions
+        Session.bump_versions([session_obj.id])
+        db.session.commit()
+
+        companion_count = len(approve_ids) - len(registrants) + len(new_companions)
+        return recipients, companion_ids, len(registrants), companion_count, skipped
+    raise RuntimeError("Seats or registrations kept changing while approving; try again")
+
+
+def approve_all(job):
+    """Approve a session's pending registrations and queue their emails, tracking progress on job"""
+    session_obj = db.session.get(Session, job.session_id)
+    recipients, companion_ids, approved, companions_approved, skipped = _approve(session_obj)
+
+    # One email per registrant and per emailed companion
+    emails = []
+    for registration_id, email, name, pairs in recipients:
+        emails.append((KIND_REGISTRANT, registration_id, email, name, None))
+        for companion_name, companion_email in pairs:
+            emails.append((KIND_COMPANION, companion_ids[companion_email], companion_email, companion_name, name))
+
+    job.total = len(emails)
+    job.result = {'approved': approved, 'companions_approved': companions_approved,
+                  'skipped': skipped, 'emails_queued': 0}
+    db.session.commit()
+
+    # QR rendering is the expensive part; spread it over a pool, queue emails on this thread
+    if session_obj.send_qr_in_email:
+        with ThreadPoolExecutor(max_workers=QR_RENDER_CONCURRENCY) as executor:
+            qr_codes = list(executor.map(
+                lambda e: generate_qr_code(make_ticket(e[1], session_obj.id, e[0])), emails
+            ))
+    else:
+        qr_codes = [None] * len(emails)
+
+    queued = 0
+    for index, ((kind, _, email, name, registrant_name), qr_data) in enumerate(zip(emails, qr_codes), 1):
+        try:
+            if kind == KIND_REGISTRANT:
+                send_registration_confirmed_email(email, name, session_obj, qr_data)
+            else:
+                send_companion_registered_email(email, name, registrant_name, session_obj,
+                                                is_approved=True, qr_data=qr_data)
+            queued += 1
+        except Exception as e:
+            logger.error(f"Bulk approval email failed for {email}: {e}")
+        if index % EMAIL_BATCH_SIZE == 0 or index == len(emails):
+            job.processed = index
+            job.result = dict(job.result, emails_queued=queued)
+            db.session.commit()
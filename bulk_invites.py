@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+Email invitations for many users at once.
+
+The request plans the invitations with a single query (the selected users
+outer-joined to the session's existing invites) and answers straight away
+with a job id and the counts. The job plans again, since other admins may
+have invited some of the users meanwhile, then bulk-inserts the Invite rows
+together with their outbox emails, one transaction per chunk so an invite is
+never stored without its email. email_worker.py sends the emails in provider
+batches.
+"""
+
+import logging
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+import background_jobs
+from app import db
+from models import EmailOutbox, Invite, Session, User
+from utils import generate_invite_token, invitation_email
+
+logger = logging.getLogger(__name__)
+
+INSERT_CHUNK_SIZE = 500
+# Another admin inviting the same people makes a chunk collide on (session, email); retry this often
+INSERT_ATTEMPTS = 3
+
+
+def plan(session_id, user_ids):
+    """Split the selected users by whether the session already invited them.
+
+    Returns (to_invite, already_invited, not_found) where to_invite lists
+    emails in user id order and the others are counts.
+    """
+    rows = db.session.execute(
+        db.select(User.email, Invite.id)
+        .outerjoin(Invite, db.and_(Invite.session_id == session_id, Invite.email == User.email))
+        .where(User.id.in_(user_ids))
+        .order_by(User.id)
+    ).all()
+    to_invite = [email for email, invite_id in rows if invite_id is None]
+    return to_invite, len(rows) - len(to_invite), len(user_ids) - len(rows)
+
+
+def start_send_invites(session_id, user_ids):
+    """Queue invitations for user_ids; returns (job, counts)"""
+    user_ids = sorted(set(user_ids))
+    to_invite, already_invited, not_found = plan(session_id, user_ids)
+    counts = {
+        'requested': len(user_ids),
+        'to_invite': len(to_invite),
+        'already_invited': already_invited,
+        'not_found': not_found
+    }
+    job = background_jobs.start('send_invites', session_id, send_invites, user_ids,
+                                total=len(to_invite), result=dict(counts, invited=0))
+    return job, counts
+
+
+def _insert_chunk(session_obj, emails):
+    """Store invites and their emails for one chunk; returns how many were invited"""
+    for _ in range(INSERT_ATTEMPTS):
+        now = datetime.utcnow()
+        invites, messages = [], []
+        for email in emails:
+            token = generate_invite_token()
+            subject, text = invitation_email(session_obj, token, session_obj.invite_message)
+            invites.append({
+                'session_id': session_obj.id,
+                'email': email,
+                'token': token,
+                'expires_at': session_obj.date,  # Invite expires at session time
+                'created_at': now,
+                'sent_at': now
+            })
+            messages.append({'recipients': [email], 'subject': subject, 'text': text, 'created_at': now})
+        if not invites:
+            return 0
+        try:
+            db.session.execute(db.insert(Invite), invites)
+            db.session.execute(db.insert(EmailOutbox), messages)
+            db.session.commit()
+            return len(invites)
+        except IntegrityError:
+            db.session.rollback()
+            taken = set(db.session.scalars(db.select(Invite.email).where(
+                Invite.session_id == session_obj.id, Invite.email.in_(emails)
+            )))
+            emails = [email for email in emails if email not in taken]
+    raise RuntimeError("Invites kept colliding with another invitation run; try again")
+
+
+def send_invites(job, user_ids):
+    """Invite the users the session has not invited yet, tracking progress on job"""
+    session_obj = db.session.get(Session, job.session_id)
+    to_invite, _, _ = plan(session_obj.id, user_ids)
+    job.total = len(to_invite)
+    db.session.commit()
+
+    invited = 0
+    for start in range(0, len(to_invite), INSERT_CHUNK_SIZE):
+        invited += _insert_chunk(session_obj, to_invite[start:start + INSERT_CHUNK_SIZE])
+        job.processed = min(start + INSERT_CHUNK_SIZE, len(to_invite))
+        job.result = dict(job.result, invited=invited)
+        db.session.commit()
+    logger.info("Invited %s users to session %s", invited, session_obj.id)
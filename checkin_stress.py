@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stress check for concurrent check-ins of one attendee.
+
+Many threads scan the same member's ticket at once through every check-in
+path (manual attendance, QR attendance, single ticket scans and scanner
+batches), then the script checks that the attendee ended up with exactly
+one attendance row (counted once in the analytics summary), one first scan
+and a check-in time that later scans did not move. Exits non-zero if any
+check fails.
+
+Runs on a scratch SQLite file by default; pass --database-url to point it at
+a scratch PostgreSQL database (it adds a session and a user to it).
+
+Usage:
+    python checkin_stress.py
+    python checkin_stress.py --threads 32 --rounds 50 --database-url postgresql://localhost/eventpilot_stress
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime
+
+
+def _setup(db, Session, User, Registration):
+    stamp = int(time.time() * 1000)
+    session_obj = Session(session_number=stamp % 100000, title="Check-in stress", date=datetime.utcnow(),
+                          max_participants=10)
+    user = User(name="Stress", username=f"stress{stamp}", email=f"stress{stamp}@example.com",
+                phone=f"05{stamp % 10 ** 8:08d}")
+    db.session.add_all([session_obj, user])
+    db.session.flush()
+    registration = Registration(session_id=session_obj.id, user_id=user.id, is_approved=True)
+    db.session.add(registration)
+    db.session.commit()
+    return session_obj.id, user.id, registration.id
+
+
+def run(threads, rounds):
+    from app import app, db
+    from models import Attendance, ParticipantSummary, Registration, Session, User
+    from tickets import make_ticket
+
+    with app.app_context():
+        session_id, user_id, registration_id = _setup(db, Session, User, Registration)
+    ticket = make_ticket(registration_id, session_id)
+    calls = [
+        ('attendance', '/admin/attendance', {'session_id': session_id, 'user_id': user_id}),
+        ('qr', f'/admin/checkin/{session_id}/{user_id}', {'qr_verified': True}),
+        ('ticket', f'/admin/checkin/{session_id}/ticket', {'ticket': ticket}),
+        ('batch', f'/api/checkin/{session_id}/batch', {'tickets': [ticket, ticket]}),
+    ]
+    outcomes = Counter()
+    first_scans = Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def hammer(number):
+        client = app.test_client()
+        client.post('/admin/login', data={'username': 'admin', 'password': 'admin123'})
+        start.wait()
+        for i in range(rounds):
+            label, url, body = calls[(number + i) % len(calls)]
+            response = client.post(url, json=body)
+            data = response.get_json(silent=True) or {}
+            with lock:
+                outcomes[(label, response.status_code)] += 1
+                if label == 'ticket' and data.get('already_checked_in') is False:
+                    first_scans['ticket'] += 1
+                elif label == 'batch':
+                    first_scans['batch'] += sum(1 for r in data.get('results', ()) if r['status'] == 'checked_in')
+
+    workers = [threading.Thread(target=hammer, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        rows = Attendance.query.filter_by(session_id=session_id, user_id=user_id).all()
+        attended = bool(rows) and rows[0].attended
+        first_time = rows[0].check_in_time if rows else None
+        checked_in_at = db.session.get(Registration, registration_id).checked_in_at
+        # One more scan must leave the stored time alone
+        Attendance.check_in(session_id, {user_id: True})
+        db.session.commit()
+        later_time = db.session.scalar(db.select(Attendance.check_in_time).where(
+            Attendance.session_id == session_id, Attendance.user_id == user_id))
+        counted = db.session.scalar(db.select(ParticipantSummary.attendances).where(
+            ParticipantSummary.user_id == user_id))
+
+    requests = sum(outcomes.values())
+    print(f"{threads} threads x {rounds} scans: {requests} requests in {elapsed:.2f}s "
+          f"({requests / elapsed:.0f}/s)")
+    for (label, status), count in sorted(outcomes.items()):
+        print(f"  {label:<12}{status:>5}{count:>8}")
+
+    checks = [
+        ("no request failed", all(status == 200 for _, status in outcomes)),
+        ("one attendance row", len(rows) == 1),
+        ("attendance marked present", attended),
+        ("one first scan across ticket and batch paths", sum(first_scans.values()) == 1),
+        ("registration checked in", checked_in_at is not None),
+        ("repeat scan kept the first check-in time", first_time is not None and later_time == first_time),
+        ("analytics summary counts one attendance", counted == 1),
+    ]
+    for label, ok in checks:
+        print(f"{'ok' if ok else 'FAIL':<6}{label}")
+    return all(ok for _, ok in checks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Hammer one attendee's check-in from many threads")
+    parser.add_argument('--threads', type=int, default=16, help="Concurrent scanners")
+    parser.add_argument('--rounds', type=int, default=25, help="Scans per scanner")
+    parser.add_argument('--database-url', help="Scratch database (default: a temporary SQLite file)")
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f"sqlite:///{scratch.name}"
+    logging.disable(logging.WARNING)
+    try:
+        passed = run(args.threads, args.rounds)
+    finally:
+        if scratch:
+            os.unlink(scratch.name)
+    sys.exit(0 if passed else 1)
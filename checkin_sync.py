@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Roster sync for the door scanners.
+
+A scanner downloads the session's roster once as a compact snapshot (field
+names listed once, one array per registration) together with the session's
+roster_version. Every change to a registration stamps it with the next
+roster version, so the scanner then polls for the rows stamped after its
+cursor instead of downloading the roster again. Scans made while offline are
+sent back in batches and checked in with one UPDATE and one attendance upsert.
+"""
+
+from app import db
+from models import Attendance, Registration, Session, User
+from tickets import verify_ticket
+
+SNAPSHOT_FIELDS = ['id', 'user_id', 'name', 'email', 'phone', 'company', 'checked_in_at']
+DELTA_FIELDS = SNAPSHOT_FIELDS + ['is_approved']
+MAX_BATCH_SCANS = 500
+
+
+def _roster_query(session_id, *columns):
+    return (
+        db.select(
+            Registration.id,
+            Registration.user_id,
+            db.func.coalesce(User.name, Registration.guest_name),
+            db.func.coalesce(User.email, Registration.guest_email),
+            db.func.coalesce(User.phone, Registration.guest_phone),
+            db.func.coalesce(User.company_name, Registration.guest_company_name),
+            Registration.checked_in_at,
+            *columns
+        )
+        .outerjoin(User, User.id == Registration.user_id)
+        .where(Registration.session_id == session_id)
+        .order_by(Registration.id)
+    )
+
+
+def _row(row):
+    row = list(row)
+    checked_in_at = row[6]
+    row[6] = checked_in_at.isoformat() if checked_in_at else None
+    return row
+
+
+def current_version(session_id):
+    return db.session.scalar(db.select(Session.roster_version).where(Session.id == session_id))
+
+
+def snapshot(session_id):
+    """The approved registrations of a session as {'version', 'fields', 'rows'}"""
+    # Read the cursor first: changes committed after it are at most sent twice, never missed
+    version = current_version(session_id)
+    rows = db.session.execute(_roster_query(session_id).where(Registration.is_approved.is_(True)))
+    return {'version': version, 'fields': SNAPSHOT_FIELDS, 'rows': [_row(row) for row in rows]}
+
+
+def delta(session_id, since):
+    """Registrations changed after roster version since, approved or not.
+
+    reset is set when since is ahead of the session (the roster was rebuilt
+    or the cursor is from another server), telling the scanner to take a
+    fresh snapshot.
+    """
+    version = current_version(session_id)
+    if since > version:
+        return {'version': version, 'reset': True, 'fields': DELTA_FIELDS, 'rows': []}
+    rows = db.session.execute(
+        _roster_query(session_id, Registration.is_approved).where(Registration.roster_version > since)
+    )
+    return {'version': version, 'reset': False, 'fields': DELTA_FIELDS,
+            'rows': [_row(row) for row in rows]}
+
+
+def check_in_batch(session_id, scans):
+    """Check in a batch of scanned tickets for a session.
+
+    Returns one {'ticket', 'status', ...} per scan, in order, where status is
+    checked_in, already_checked_in, invalid, wrong_session or not_found. A
+    ticket scanned twice in the batch counts as checked in once.
+    """
+    results, tickets = [], {}
+    for text in scans:
+        ticket = verify_ticket(text)
+        if not ticket:
+            results.append({'ticket': text, 'status': 'invalid'})
+        elif ticket['session_id'] != session_id:
+            results.append({'ticket': text, 'status': 'wrong_session'})
+        else:
+            results.append({'ticket': text, 'registration_id': ticket['registration_id'], 'kind': ticket['kind']})
+            tickets.setdefault(ticket['registration_id'], ticket)
+
+    checked_in, already = {}, {}
+    if tickets:
+        checked_in, already = Registration.check_in_many(list(tickets), session_id)
+    # Members also get an attendance row so their history and analytics include the visit
+    Attendance.check_in(session_id, {user_id: tickets[registration_id]['signed']
+                                     for registration_id, user_id in checked_in.items() if user_id})
+    db.session.commit()
+
+    seen = set()
+    for result in results:
+        registration_id = result.get('registration_id')
+        if registration_id is None:
+            continue
+        if registration_id in checked_in and registration_id not in seen:
+            result.update(status='checked_in', user_id=checked_in[registration_id])
+        elif registration_id in checked_in or registration_id in already:
+            result.update(status='already_checked_in',
+                          user_id=checked_in.get(registration_id, already.get(registration_id)))
+        else:
+            result['status'] = 'not_found'
+        seen.add(registration_id)
+    return results
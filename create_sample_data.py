@@ -376,6 +376,11 @@ def create_sample_data():
         # Commit all registrations and attendances
         db.session.commit()
 
+        # Registrations were inserted directly - sync the seat counters
+        for session in sessions:
+            session.recount_registrations()
+        db.session.commit()
+
         print(f"✅ تم إنشاء {total_registrations} تسجيل و {total_attendances} حضور")
         print(f"✅ تم إنشاء {total_guest_registrations} تسجيل ضيف و {total_companions} مرافق")
         print("🎉 تم إكمال إنشاء البيانات التجريبية بنجاح!")
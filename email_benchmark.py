@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Offline throughput benchmark for email rendering and sending.
+
+Sends go through the local stand-in transport, which answers like the
+Resend API after a simulated per-request latency, so nothing leaves the
+machine. Compares one request per message (the old path) with send_many()
+and times the template render for a confirmation email.
+
+Usage:
+    python email_benchmark.py
+    python email_benchmark.py --messages 1000 --latency-ms 80 --concurrency 8
+"""
+
+import argparse
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from types import SimpleNamespace
+
+# Nothing here touches the database or the network
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+os.environ['EMAIL_TRANSPORT'] = 'local'
+
+import app  # noqa: F401  (utils imports models, which need the app initialised first)
+import email_transport
+import utils
+
+
+def _messages(count):
+    session = SimpleNamespace(title="ثلوثية الأعمال", session_number=12, date=datetime(2026, 1, 6, 19, 30),
+                              location="الرياض", send_qr_in_email=False)
+    return [{
+        'to': f"guest{i}@example.com",
+        'subject': f"تأكيد التسجيل - {session.title}",
+        'text': utils._render_email('confirmation.txt', name=f"ضيف {i}", session=session),
+        'html': utils._render_email('registration_confirmed.html', name=f"ضيف {i}", session=session, show_qr=False)
+    } for i in range(count)]
+
+
+def _render_cost(count):
+    session = SimpleNamespace(title="ثلوثية الأعمال", session_number=12, date=datetime(2026, 1, 6, 19, 30),
+                              location=None, send_qr_in_email=True)
+    started = time.perf_counter()
+    for i in range(count):
+        utils._render_email('registration_confirmed.html', name=f"ضيف {i}", session=session, show_qr=True)
+        utils._render_email('confirmation.txt', name=f"ضيف {i}", session=session)
+    return (time.perf_counter() - started) / count * 1e6
+
+
+def _run(label, transport, send):
+    transport.requests = transport.emails = 0
+    started = time.perf_counter()
+    results = send()
+    elapsed = time.perf_counter() - started
+    failed = sum(1 for _, error in results if error)
+    print(f"{label:<24}{transport.requests:>10}{elapsed:>10.2f}{len(results) / elapsed:>14.1f}{failed:>8}")
+
+
+def run(count, latency_ms, concurrency, rate_limit):
+    logging.getLogger('utils').setLevel(logging.WARNING)
+    utils._resend_sender()
+    transport = email_transport.install('local', rate_limit=rate_limit).inner
+    transport.latency = latency_ms / 1000
+    messages = _messages(count)
+
+    print(f"Template render (html + text): {_render_cost(500):.1f} us per email\n")
+    limit = f"{rate_limit:g} requests/s" if rate_limit > 0 else "no rate limit"
+    print(f"{count} messages, {latency_ms:g} ms simulated latency, {concurrency} threads, {limit}\n")
+    print(f"{'path':<24}{'requests':>10}{'seconds':>10}{'emails/s':>14}{'failed':>8}")
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        def one_by_one():
+            def deliver(message):
+                try:
+                    return utils._deliver_email(**message), None
+                except Exception as e:
+                    return None, str(e)
+            return list(executor.map(deliver, messages))
+
+        _run('one request each', transport, one_by_one)
+        _run('send_many', transport, lambda: utils.send_many(messages, executor))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark email sending against a local stand-in transport")
+    parser.add_argument('--messages', type=int, default=500, help="Emails to send")
+    parser.add_argument('--latency-ms', type=float, default=50, help="Simulated provider latency per request")
+    parser.add_argument('--concurrency', type=int, default=4, help="Sending threads")
+    parser.add_argument('--rate-limit', type=float, default=0,
+                        help="Token bucket rate in requests per second, as EMAIL_RATE_LIMIT (0 disables)")
+    args = parser.parse_args()
+    run(args.messages, args.latency_ms, args.concurrency, args.rate_limit)
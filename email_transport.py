@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP transports for the Resend SDK.
+
+The SDK's default client calls requests.request() for every email, opening a
+new TLS connection each time. PooledTransport keeps one requests.Session per
+process so consecutive sends reuse keep-alive connections.
+
+LocalTransport never touches the network: it answers like the Resend API
+after an optional simulated latency, so email throughput can be benchmarked
+offline (EMAIL_TRANSPORT=local).
+
+Either one is wrapped in a GovernedTransport: every request first takes a
+token from a per-process token bucket (EMAIL_RATE_LIMIT requests per second,
+bursts of EMAIL_RATE_BURST), and 429, 5xx and connection errors are retried
+with exponential backoff and full jitter, honouring Retry-After. A 429 also
+holds the bucket so the other sending threads back off with it. A POST is
+only retried after a 5xx or a connection error when it carries an
+Idempotency-Key: the provider may already have accepted it, and without
+the key a retry would send the email twice. A 429 was not processed, so it
+is always retried.
+"""
+
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+
+import requests
+import resend
+from requests.adapters import HTTPAdapter
+
+EMAIL_TRANSPORT = os.environ.get('EMAIL_TRANSPORT', 'pooled')  # pooled, local
+EMAIL_HTTP_POOL_SIZE = int(os.environ.get('EMAIL_HTTP_POOL_SIZE', 10))
+EMAIL_HTTP_TIMEOUT = float(os.environ.get('EMAIL_HTTP_TIMEOUT', 30))
+EMAIL_LOCAL_LATENCY_MS = float(os.environ.get('EMAIL_LOCAL_LATENCY_MS', 0))
+EMAIL_RATE_LIMIT = float(os.environ.get('EMAIL_RATE_LIMIT', 2))  # requests per second, 0 disables
+EMAIL_RATE_BURST = int(os.environ.get('EMAIL_RATE_BURST', 2))
+EMAIL_HTTP_RETRIES = int(os.environ.get('EMAIL_HTTP_RETRIES', 3))
+EMAIL_BACKOFF_BASE = float(os.environ.get('EMAIL_BACKOFF_BASE', 0.5))  # seconds
+EMAIL_BACKOFF_MAX = float(os.environ.get('EMAIL_BACKOFF_MAX', 30))
+
+logger = logging.getLogger(__name__)
+
+_JSON_HEADERS = {'content-type': 'application/json'}
+
+
+class PooledTransport(resend.HTTPClient):
+    """Resend HTTP client sharing keep-alive connections across sends"""
+
+    def __init__(self, pool_size=EMAIL_HTTP_POOL_SIZE, timeout=EMAIL_HTTP_TIMEOUT):
+        self._timeout = timeout
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    def request(self, method, url, headers, json=None, files=None, data=None):
+        try:
+            if files is not None:
+                response = self._session.request(method, url, headers=headers, files=files,
+                                                 data=data, timeout=self._timeout)
+            else:
+                response = self._session.request(method, url, headers=headers,
+                                                 json=json if data is None else None,
+                                                 data=data, timeout=self._timeout)
+            return response.content, response.status_code, response.headers
+        except requests.RequestException as e:
+            raise RuntimeError(f"Request failed: {e}") from e
+
+
+class LocalTransport(resend.HTTPClient):
+    """Stand-in for the Resend API that records requests instead of sending them"""
+
+    def __init__(self, latency_ms=EMAIL_LOCAL_LATENCY_MS):
+        self.latency = latency_ms / 1000
+        self.requests = 0
+        self.emails = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, headers, json=None, files=None, data=None):
+        if self.latency:
+            time.sleep(self.latency)
+        if isinstance(json, list):
+            body = {'data': [{'id': str(uuid.uuid4())} for _ in json]}
+            count = len(json)
+        else:
+            body = {'id': str(uuid.uuid4())}
+            count = 1
+        with self._lock:
+            self.requests += 1
+            self.emails += count
+        return _dumps(body), 200, _JSON_HEADERS
+
+
+def _dumps(body):
+    return json.dumps(body).encode('utf-8')
+
+
+class TokenBucket:
+    """Blocking token bucket shared by the sending threads of a process"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._held_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, sleeping until one is available"""
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._held_until and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._held_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def hold(self, seconds):
+        """Hand out no tokens for the next seconds (the provider asked us to slow down)"""
+        with self._lock:
+            self._held_until = max(self._held_until, time.monotonic() + seconds)
+            self._tokens = 0.0
+
+
+def backoff_delay(attempt, base=EMAIL_BACKOFF_BASE, cap=EMAIL_BACKOFF_MAX):
+    """Exponential backoff with full jitter for the given zero-based retry"""
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def _retry_after(headers):
+    value = {k.lower(): v for k, v in (headers or {}).items()}.get('retry-after')
+    try:
+        return min(float(value), EMAIL_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_transient(status_code):
+    """Whether a provider status code is worth retrying"""
+    return status_code == 429 or status_code >= 500
+
+
+def is_transient_error(error):
+    """Whether a failed send is worth trying again later.
+
+    Resend errors carry the HTTP status as code (connection failures surface
+    as 500); anything else, such as missing configuration or a rejected
+    address, needs someone to look at it first.
+    """
+    try:
+        return is_transient(int(getattr(error, 'code', None)))
+    except (TypeError, ValueError):
+        return False
+
+
+def _replay_safe(method, headers):
+    """Whether a request may be sent again after an unclear failure"""
+    if method.lower() != 'post':
+        return True
+    return any(name.lower() == 'idempotency-key' for name in (headers or {}))
+
+
+class GovernedTransport(resend.HTTPClient):
+    """Rate-limits and retries the requests of another transport"""
+
+    def __init__(self, inner, bucket, retries=EMAIL_HTTP_RETRIES):
+        self.inner = inner
+        self.bucket = bucket
+        self.retries = retries
+
+    def request(self, method, url, headers, **kwargs):
+        replay_safe = _replay_safe(method, headers)
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                content, status_code, response_headers = self.inner.request(method, url, headers, **kwargs)
+            except Exception as e:
+                if attempt == self.retries or not replay_safe:
+                    raise
+                delay = backoff_delay(attempt)
+                logger.warning("Email provider request failed (%s), retrying in %.1fs", e, delay)
+            else:
+                if not is_transient(status_code) or attempt == self.retries:
+                    return content, status_code, response_headers
+                if status_code != 429 and not replay_safe:
+                    return content, status_code, response_headers
+                delay = _retry_after(response_headers) or backoff_delay(attempt)
+                if status_code == 429:
+                    self.bucket.hold(delay)
+                logger.warning("Email provider answered %s, retrying in %.1fs", status_code, delay)
+            time.sleep(delay)
+
+
+def install(kind=None, rate_limit=EMAIL_RATE_LIMIT, burst=EMAIL_RATE_BURST):
+    """Point the Resend SDK at the configured transport and return it"""
+    kind = kind or EMAIL_TRANSPORT
+    inner = LocalTransport() if kind == 'local' else PooledTransport()
+    transport = GovernedTransport(inner, TokenBucket(rate_limit, burst))
+    resend.default_http_client = transport
+    return transport
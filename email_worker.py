@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background worker that drains the email outbox.
+
+Requests only queue EmailOutbox rows inside their own transaction; this
+process claims pending messages in batches and sends them through Resend's
+batch endpoint (one request per 100 messages; messages with attachments are
+sent singly) on a thread pool, recording the outcome of every message.
+
+The transport already rate-limits and retries throttled requests. Messages
+that still fail transiently are retried later with exponential backoff;
+messages that fail permanently, or keep failing for EMAIL_MAX_ATTEMPTS
+tries, move to the dead-letter table, where admins can requeue them.
+
+Usage:
+    python email_worker.py                 # run forever
+    python email_worker.py --once          # drain what is pending and exit
+    python email_worker.py --concurrency 8 --batch-size 100
+"""
+
+import argparse
+import logging
+import os
+import secrets
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from app import app, db
+from email_transport import backoff_delay, is_transient_error
+from models import EmailDeadLetter, EmailOutbox
+from utils import send_many
+
+logger = logging.getLogger(__name__)
+
+# Messages stuck in 'sending' this long (worker crashed mid-batch) are retried
+STALE_LOCK_MINUTES = 10
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 5))
+# Backoff between attempts of one message, in seconds
+RETRY_BACKOFF_BASE = 30
+RETRY_BACKOFF_MAX = 3600
+
+
+def release_stale_claims():
+    """Put messages claimed by a dead worker back in the queue"""
+    cutoff = datetime.utcnow() - timedelta(minutes=STALE_LOCK_MINUTES)
+    released = db.session.execute(
+        db.update(EmailOutbox)
+        .where(EmailOutbox.status == 'sending', EmailOutbox.locked_at < cutoff)
+        .values(status='pending', lock_token=None, locked_at=None)
+    ).rowcount
+    db.session.commit()
+    if released:
+        logger.warning("Released %s stale outbox claims", released)
+    return released
+
+
+def claim_batch(batch_size):
+    """Atomically claim up to batch_size pending messages for this worker"""
+    token = secrets.token_hex(16)
+    now = datetime.utcnow()
+    pending_ids = db.select(EmailOutbox.id).where(
+        EmailOutbox.status == 'pending',
+        db.or_(EmailOutbox.next_attempt_at.is_(None), EmailOutbox.next_attempt_at <= now)
+    ).order_by(EmailOutbox.id).limit(batch_size).scalar_subquery()
+
+    # The status check in the UPDATE makes concurrent workers skip rows another one won
+    db.session.execute(
+        db.update(EmailOutbox)
+        .where(EmailOutbox.id.in_(pending_ids), EmailOutbox.status == 'pending')
+        .values(status='sending', lock_token=token, locked_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    db.session.commit()
+    return EmailOutbox.query.filter_by(lock_token=token).order_by(EmailOutbox.id).all()
+
+
+def process_batch(executor, batch_size):
+    """Claim and send one batch. Returns the number of messages processed."""
+    messages = claim_batch(batch_size)
+    if not messages:
+        return 0
+
+    # Threads only talk to the provider; all database writes stay on this thread
+    payloads = [{
+        'to': m.recipients,
+        'subject': m.subject,
+        'text': m.text,
+        'html': m.html,
+        'attachments': m.attachments,
+        # Same key on every attempt, so the provider drops a resend of a message it already took
+        'idempotency_key': f'outbox-{m.id}'
+    } for m in messages]
+    results = send_many(payloads, executor)
+
+    sent = retried = dead = 0
+    for message, (provider_id, error) in zip(messages, results):
+        message.attempts = (message.attempts or 0) + 1
+        message.lock_token = None
+        message.locked_at = None
+        if error is None:
+            message.status = 'sent'
+            message.provider_id = provider_id
+            message.sent_at = datetime.utcnow()
+            message.last_error = None
+            message.next_attempt_at = None
+            sent += 1
+        elif is_transient_error(error) and message.attempts < EMAIL_MAX_ATTEMPTS:
+            delay = backoff_delay(message.attempts - 1, base=RETRY_BACKOFF_BASE, cap=RETRY_BACKOFF_MAX)
+            message.status = 'pending'
+            message.last_error = str(error)
+            message.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            retried += 1
+            logger.warning("Outbox message %s to %s failed, retrying in %.0fs: %s",
+                           message.id, message.recipients, delay, error)
+        else:
+            dead_letter(message, str(error))
+            dead += 1
+            logger.error("Outbox message %s to %s failed for good: %s", message.id, message.recipients, error)
+
+    db.session.commit()
+    logger.info("Outbox batch done: %s sent, %s to retry, %s dead-lettered", sent, retried, dead)
+    return len(messages)
+
+
+def dead_letter(message, error):
+    """Move a message the worker gives up on to the dead-letter table"""
+    db.session.add(EmailDeadLetter(
+        outbox_id=message.id,
+        recipients=message.recipients,
+        subject=message.subject,
+        text=message.text,
+        html=message.html,
+        attachments=message.attachments,
+        attempts=message.attempts,
+        last_error=error,
+        created_at=message.created_at
+    ))
+    db.session.delete(message)
+
+
+def run(concurrency, batch_size, poll_interval, once=False):
+    """Drain the outbox, polling for new messages unless once is set"""
+    with app.app_context(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        release_stale_claims()
+        while True:
+            processed = process_batch(executor, batch_size)
+            if processed:
+                continue
+            if once:
+                return
+            db.session.remove()
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Send queued emails from the outbox")
+    parser.add_argument('--concurrency', type=int,
+                        default=int(os.environ.get('EMAIL_WORKER_CONCURRENCY', 4)),
+                        help="Parallel provider requests (EMAIL_WORKER_CONCURRENCY)")
+    parser.add_argument('--batch-size', type=int,
+                        default=int(os.environ.get('EMAIL_WORKER_BATCH_SIZE', 50)),
+                        help="Messages claimed per batch (EMAIL_WORKER_BATCH_SIZE)")
+    parser.add_argument('--poll-interval', type=float,
+                        default=float(os.environ.get('EMAIL_WORKER_POLL_INTERVAL', 2)),
+                        help="Seconds to wait when the outbox is empty (EMAIL_WORKER_POLL_INTERVAL)")
+    parser.add_argument('--once', action='store_true', help="Exit once the outbox is empty")
+    args = parser.parse_args()
+
+    run(args.concurrency, args.batch_size, args.poll_interval, once=args.once)
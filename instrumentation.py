@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+"""
+Opt-in per-request performance instrumentation.
+
+Set PERF_INSTRUMENTATION=1 to record, for every request, the number of SQL
+statements and the time spent in the database, in ai_service calls, in email
+delivery and in template rendering. The numbers are sent back as a
+Server-Timing header (visible in the browser dev tools), requests slower than
+SLOW_REQUEST_MS are logged with their most expensive queries, and the most
+recent slow requests are kept in memory for the admin performance page.
+
+When the variable is not set nothing is hooked and timed() costs one flag check.
+"""
+
+import functools
+import logging
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from flask import g, has_request_context, request, before_render_template, template_rendered
+from sqlalchemy import event
+
+logger = logging.getLogger(__name__)
+
+ENABLED = os.environ.get('PERF_INSTRUMENTATION', '').lower() in ('1', 'true', 'yes')
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_BUFFER_SIZE = int(os.environ.get('SLOW_REQUEST_BUFFER_SIZE', 100))
+TOP_QUERIES = 5
+# Statements kept per request; counts and totals are exact beyond this
+MAX_RECORDED_QUERIES = 500
+
+_slow_requests = deque(maxlen=SLOW_REQUEST_BUFFER_SIZE)
+_slow_requests_lock = threading.Lock()
+
+
+class RequestStats:
+    """Timings collected for the current request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.query_count = 0
+        self.query_time = 0.0
+        self.queries = []  # (statement, seconds)
+        self.timings = {}  # category -> seconds, e.g. 'ai', 'email', 'render'
+
+    def add(self, category, seconds):
+        self.timings[category] = self.timings.get(category, 0.0) + seconds
+
+    def top_queries(self, limit=TOP_QUERIES):
+        """Statements grouped by text, most total time first - repeated ones point at N+1 loops"""
+        grouped = {}
+        for statement, seconds in self.queries:
+            entry = grouped.setdefault(statement, [0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+        ranked = sorted(grouped.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [{'statement': statement, 'count': count, 'ms': round(seconds * 1000, 2)}
+                for statement, (count, seconds) in ranked]
+
+
+def current_stats():
+    """Stats for the request being handled, or None outside an instrumented request"""
+    if not ENABLED or not has_request_context():
+        return None
+    return g.get('_perf_stats')
+
+
+def timed(category):
+    """Decorator adding the wrapped function's run time to the request's category"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stats = current_stats()
+            if stats is None:
+                return func(*args, **kwargs)
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stats.add(category, time.perf_counter() - started)
+        return wrapper
+    return decorator
+
+
+def recent_slow_requests():
+    """Newest first"""
+    with _slow_requests_lock:
+        return list(reversed(_slow_requests))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if current_stats() is not None:
+        conn.info.setdefault('_perf_started', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current_stats()
+    started = conn.info.get('_perf_started')
+    if stats is None or not started:
+        return
+    seconds = time.perf_counter() - started.pop()
+    stats.query_count += 1
+    stats.query_time += seconds
+    if len(stats.queries) < MAX_RECORDED_QUERIES:
+        stats.queries.append((statement, seconds))
+
+
+def _before_render(sender, template, context, **extra):
+    stats = current_stats()
+    if stats is not None:
+        g._perf_render_started = time.perf_counter()
+
+
+def _after_render(sender, template, context, **extra):
+    stats = current_stats()
+    started = g.pop('_perf_render_started', None)
+    if stats is not None and started is not None:
+        stats.add('render', time.perf_counter() - started)
+
+
+def _start_request():
+    g._perf_stats = RequestStats()
+
+
+def _finish_request(response):
+    stats = g.pop('_perf_stats', None)
+    if stats is None:
+        return response
+    total = time.perf_counter() - stats.started
+
+    metrics = [f'db;dur={stats.query_time * 1000:.1f};desc="{stats.query_count} queries"']
+    for category in sorted(stats.timings):
+        metrics.append(f'{category};dur={stats.timings[category] * 1000:.1f}')
+    metrics.append(f'total;dur={total * 1000:.1f}')
+    response.headers.add('Server-Timing', ', '.join(metrics))
+
+    if total * 1000 >= SLOW_REQUEST_MS:
+        entry = {
+            'time': datetime.utcnow(),
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 1),
+            'query_count': stats.query_count,
+            'query_ms': round(stats.query_time * 1000, 1),
+            'timings_ms': {k: round(v * 1000, 1) for k, v in sorted(stats.timings.items())},
+            'top_queries': stats.top_queries(),
+        }
+        with _slow_requests_lock:
+            _slow_requests.append(entry)
+        logger.warning(
+            "Slow request %s %s: %.0fms, %s queries in %.0fms, %s; top queries: %s",
+            entry['method'], entry['path'], entry['total_ms'], entry['query_count'], entry['query_ms'],
+            entry['timings_ms'],
+            [f"{q['count']}x {q['ms']}ms {q['statement'][:200]}" for q in entry['top_queries']]
+        )
+    return response
+
+
+def init_app(app, db):
+    """Hook the request, SQL and template events when PERF_INSTRUMENTATION is set"""
+    if not ENABLED:
+        return
+    event.listen(db.engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(db.engine, 'after_cursor_execute', _after_cursor_execute)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_after_render, app)
+    # Registered ahead of the other hooks so their queries are counted too
+    app.before_request_funcs.setdefault(None, []).insert(0, _start_request)
+    app.after_request(_finish_request)
+    logger.info("Request instrumentation enabled (slow threshold %sms)", SLOW_REQUEST_MS)
@@ -0,0 +1,425 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Load-test harness for the public and admin endpoints.
+
+Seeds a database with load-test sessions, drives realistic traffic phases
+against a running server and reports p50/p95/p99 latency, throughput and
+error rate per endpoint. Results can be saved as a baseline and later runs
+compared against it. Uses only the standard library.
+
+Phases:
+    browse     - homepage and /sessions
+    register   - burst of guest registrations with companions
+    countdown  - /api/countdown polling
+    checkin    - QR check-in scans (mark_attendance_qr)
+    approve    - admin approve-all on sessions full of pending registrations
+
+Usage:
+    # Start gunicorn on a scratch SQLite database and test it
+    python loadtest.py --spawn --database-url sqlite:////tmp/loadtest.db
+
+    # Against a server you started yourself on a local PostgreSQL database
+    python loadtest.py --base-url http://127.0.0.1:5000 --database-url postgresql://localhost/eventpilot
+
+    # Save a baseline, then compare a later run against it
+    python loadtest.py --spawn --save-baseline loadtest-baseline.json
+    python loadtest.py --spawn --compare loadtest-baseline.json
+"""
+
+import argparse
+import http.cookiejar
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+PHASES = ['browse', 'register', 'countdown', 'checkin', 'approve']
+
+# Seeded rows are tagged so repeated runs can find (and never clash with) them
+SEED_TAG = 'loadtest'
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    """Report redirects as responses instead of following them"""
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+class Recorder:
+    """Thread-safe latency and error collection per endpoint"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}  # endpoint -> list of (latency_seconds, ok)
+        self.windows = {}  # endpoint -> [first_start, last_end]
+
+    def record(self, endpoint, started, latency, ok):
+        with self._lock:
+            self.samples.setdefault(endpoint, []).append((latency, ok))
+            window = self.windows.setdefault(endpoint, [started, started + latency])
+            window[0] = min(window[0], started)
+            window[1] = max(window[1], started + latency)
+
+    def summary(self):
+        """Return {endpoint: stats} with latencies in milliseconds"""
+        result = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(latency for latency, _ in samples)
+            errors = sum(1 for _, ok in samples if not ok)
+            elapsed = max(self.windows[endpoint][1] - self.windows[endpoint][0], 1e-9)
+            result[endpoint] = {
+                'requests': len(samples),
+                'errors': errors,
+                'error_rate': errors / len(samples),
+                'throughput_rps': len(samples) / elapsed,
+                'p50_ms': _percentile(latencies, 50) * 1000,
+                'p95_ms': _percentile(latencies, 95) * 1000,
+                'p99_ms': _percentile(latencies, 99) * 1000,
+                'max_ms': latencies[-1] * 1000,
+            }
+        return result
+
+
+def _percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, math.ceil(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class Client:
+    """Minimal HTTP client with its own cookie jar, timing every request"""
+
+    def __init__(self, base_url, recorder, timeout=30):
+        self.base_url = base_url.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+        )
+
+    def request(self, endpoint, method, path, form=None, json_body=None, record=True, return_body=False):
+        data, headers = None, {}
+        if form is not None:
+            data = urllib.parse.urlencode(form).encode()
+            headers['Content-Type'] = 'application/x-www-form-urlencoded'
+        elif json_body is not None:
+            data = json.dumps(json_body).encode()
+            headers['Content-Type'] = 'application/json'
+        req = urllib.request.Request(self.base_url + path, data=data, headers=headers, method=method)
+
+        started = time.perf_counter()
+        body = b''
+        try:
+            with self.opener.open(req, timeout=self.timeout) as response:
+                body = response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        except Exception:
+            status = None
+        latency = time.perf_counter() - started
+
+        # Redirects are how the form routes report success
+        ok = status is not None and status < 400
+        if record:
+            self.recorder.record(endpoint, started, latency, ok)
+        return (status, body) if return_body else status
+
+    def admin_login(self, username, password):
+        status = self.request('admin_login', 'POST', '/admin/login',
+                              form={'username': username, 'password': password}, record=False)
+        if status != 302:
+            raise SystemExit(f"Admin login failed (HTTP {status}) - check --admin-user/--admin-password")
+
+
+def seed(args):
+    """Create the sessions, users and registrations the phases need. Returns their ids."""
+    os.environ['DATABASE_URL'] = args.database_url
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from app import app, db
+    from models import User, Session, Registration
+
+    run_id = datetime.utcnow().strftime('%Y%m%d%H%M%S')
+    with app.app_context():
+        last = Session.query.order_by(Session.session_number.desc()).first()
+        number = (last.session_number + 1) if last else 1
+        now = datetime.utcnow()
+
+        def new_session(title, days, **kwargs):
+            nonlocal number
+            session_obj = Session(session_number=number, title=f"{SEED_TAG} {title} {run_id}",
+                                  date=now + timedelta(days=days), **kwargs)
+            number += 1
+            db.session.add(session_obj)
+            return session_obj
+
+        # Past sessions so the listings look like production
+        for i in range(args.past_sessions):
+            new_session(f"past {i}", -7 * (i + 1), status='completed')
+
+        register_session = new_session('register', 7, max_participants=args.register_requests * 4,
+                                       max_companions=5)
+        checkin_session = new_session('checkin', 0, max_participants=args.checkin_users * 2)
+        approve_sessions = [
+            new_session(f"approve {i}", 14, requires_approval=True, max_participants=args.approve_pending * 4)
+            for i in range(args.approve_sessions)
+        ]
+        db.session.flush()
+
+        # Registered users for the door scans
+        users = []
+        for i in range(args.checkin_users):
+            user = User(name=f"{SEED_TAG} user {i}", username=f"{SEED_TAG}_{run_id}_{i}",
+                        email=f"{SEED_TAG}.{run_id}.{i}@example.com", phone=f"+8{run_id[-8:]}{i:05d}",
+                        ai_description="")
+            db.session.add(user)
+            users.append(user)
+        db.session.flush()
+        for user in users:
+            db.session.add(Registration(user_id=user.id, session_id=checkin_session.id, is_approved=True))
+        checkin_session.registration_count = len(users)
+
+        # Pending guest registrations for approve-all
+        for session_obj in approve_sessions:
+            for i in range(args.approve_pending):
+                db.session.add(Registration(
+                    session_id=session_obj.id, is_approved=False,
+                    guest_name=f"{SEED_TAG} guest {i}",
+                    guest_email=f"{SEED_TAG}.{run_id}.{session_obj.id}.{i}@example.com",
+                    guest_phone=f"05{i:08d}"
+                ))
+
+        db.session.commit()
+        return {
+            'run_id': run_id,
+            'register_session_id': register_session.id,
+            'checkin_session_id': checkin_session.id,
+            'checkin_user_ids': [u.id for u in users],
+            'approve_session_ids': [s.id for s in approve_sessions],
+        }
+
+
+def run_for(duration, concurrency, task):
+    """Call task(worker_index) in a loop on concurrency threads for duration seconds"""
+    deadline = time.monotonic() + duration
+
+    def loop(worker):
+        while time.monotonic() < deadline:
+            task(worker)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(loop, range(concurrency)))
+
+
+def run_each(items, concurrency, task):
+    """Call task(item) once per item on concurrency threads"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(task, items))
+
+
+def phase_browse(args, ids, recorder):
+    clients = [Client(args.base_url, recorder) for _ in range(args.concurrency)]
+
+    def task(worker):
+        client = clients[worker]
+        client.request('index', 'GET', '/')
+        client.request('sessions', 'GET', '/sessions')
+
+    run_for(args.duration, args.concurrency, task)
+
+
+def phase_register(args, ids, recorder):
+    session_id = ids['register_session_id']
+
+    def task(i):
+        form = {
+            'name': f"{SEED_TAG} registrant {i}",
+            'email': f"{SEED_TAG}.{ids['run_id']}.reg.{i}@example.com",
+            'phone': f"05{i:08d}",
+            'company_name': 'Load Test Co',
+            'goal': 'networking',
+        }
+        companions = random.randint(0, args.max_companions)
+        form['companion_count'] = str(companions)
+        for c in range(companions):
+            form[f'companion_name_{c}'] = f"{SEED_TAG} companion {i}-{c}"
+            form[f'companion_email_{c}'] = f"{SEED_TAG}.{ids['run_id']}.comp.{i}.{c}@example.com"
+        Client(args.base_url, recorder).request('guest_session_register', 'POST',
+                                                f'/session/{session_id}/guest-register', form=form)
+
+    # Everyone submits at once, like a session opening
+    run_each(range(args.register_requests), args.burst_concurrency, task)
+
+
+def phase_countdown(args, ids, recorder):
+    client = Client(args.base_url, recorder)
+    session_id = ids['register_session_id']
+    run_for(args.duration, args.concurrency,
+            lambda worker: client.request('api_countdown', 'GET', f'/api/countdown/{session_id}'))
+
+
+def phase_checkin(args, ids, recorder):
+    session_id = ids['checkin_session_id']
+    doors = []
+    for _ in range(args.doors):
+        client = Client(args.base_url, recorder)
+        client.admin_login(args.admin_user, args.admin_password)
+        doors.append(client)
+
+    user_ids = list(ids['checkin_user_ids'])
+    random.shuffle(user_ids)
+    # Every attendee scanned once, plus some repeat scans of the same badge
+    scans = user_ids + random.sample(user_ids, len(user_ids) // 10)
+
+    def task(scan):
+        index, user_id = scan
+        doors[index % len(doors)].request('mark_attendance_qr', 'POST',
+                                          f'/admin/checkin/{session_id}/{user_id}',
+                                          json_body={'qr_verified': True})
+
+    run_each(list(enumerate(scans)), args.doors, task)
+
+
+def phase_approve(args, ids, recorder):
+    client = Client(args.base_url, recorder, timeout=300)
+    client.admin_login(args.admin_user, args.admin_password)
+    for session_id in ids['approve_session_ids']:
+        started = time.perf_counter()
+        status, body = client.request('approve_all_registrations', 'POST',
+                                      f'/admin/session/{session_id}/approve-all', return_body=True)
+        # Approval runs as a background job; time it until the job finishes
+        job_ok = False
+        if status == 202:
+            status_url = json.loads(body)['status_url']
+            while True:
+                status, body = client.request('job_status', 'GET', status_url, record=False, return_body=True)
+                job = json.loads(body)['job'] if status == 200 else {'status': 'failed'}
+                if job['status'] in ('done', 'failed'):
+                    job_ok = job['status'] == 'done'
+                    break
+                time.sleep(0.2)
+        recorder.record('approve_all_job', started, time.perf_counter() - started, job_ok)
+
+
+PHASE_RUNNERS = {
+    'browse': phase_browse,
+    'register': phase_register,
+    'countdown': phase_countdown,
+    'checkin': phase_checkin,
+    'approve': phase_approve,
+}
+
+
+def spawn_server(args):
+    """Start gunicorn on the test database and wait until it answers"""
+    env = dict(os.environ, DATABASE_URL=args.database_url)
+    port = urllib.parse.urlparse(args.base_url).port or 5000
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--bind', f'127.0.0.1:{port}',
+         '--workers', str(args.workers), '--threads', str(args.threads), '--log-level', 'warning', 'main:app'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=env
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(args.base_url + '/api/sessions/upcoming', timeout=2).read()
+            return process
+        except Exception:
+            if process.poll() is not None:
+                raise SystemExit("gunicorn exited during startup")
+            time.sleep(0.5)
+    process.terminate()
+    raise SystemExit("gunicorn did not come up within 30s")
+
+
+def print_report(summary, baseline=None):
+    header = f"{'endpoint':<28}{'reqs':>7}{'err%':>7}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}"
+    print(header)
+    print('-' * len(header))
+    for endpoint, stats in summary.items():
+        print(f"{endpoint:<28}{stats['requests']:>7}{stats['error_rate'] * 100:>6.1f}%"
+              f"{stats['throughput_rps']:>9.1f}{stats['p50_ms']:>9.1f}{stats['p95_ms']:>9.1f}{stats['p99_ms']:>9.1f}")
+        if baseline and endpoint in baseline:
+            old = baseline[endpoint]
+            deltas = []
+            for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms'):
+                if old[key]:
+                    deltas.append(f"{key} {(stats[key] - old[key]) / old[key] * 100:+.0f}%")
+            print(f"{'  vs baseline':<28}" + ', '.join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test the event planner endpoints")
+    parser.add_argument('--base-url', default='http://127.0.0.1:5055')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'sqlite:////tmp/loadtest.db'),
+                        help="Database the server uses; the harness seeds it directly")
+    parser.add_argument('--spawn', action='store_true', help="Start gunicorn on --database-url for the run")
+    parser.add_argument('--workers', type=int, default=2, help="gunicorn workers with --spawn")
+    parser.add_argument('--threads', type=int, default=4, help="gunicorn threads per worker with --spawn")
+    parser.add_argument('--phases', default=','.join(PHASES), help="Comma-separated subset of " + ', '.join(PHASES))
+    parser.add_argument('--duration', type=float, default=15, help="Seconds for the timed phases")
+    parser.add_argument('--concurrency', type=int, default=16, help="Virtual users for the timed phases")
+    parser.add_argument('--register-requests', type=int, default=300)
+    parser.add_argument('--burst-concurrency', type=int, default=50)
+    parser.add_argument('--max-companions', type=int, default=3)
+    parser.add_argument('--checkin-users', type=int, default=300)
+    parser.add_argument('--doors', type=int, default=4, help="Parallel check-in scanners")
+    parser.add_argument('--approve-sessions', type=int, default=3)
+    parser.add_argument('--approve-pending', type=int, default=200, help="Pending registrations per approve-all")
+    parser.add_argument('--past-sessions', type=int, default=100)
+    parser.add_argument('--admin-user', default='admin')
+    parser.add_argument('--admin-password', default='admin123')
+    parser.add_argument('--save-baseline', metavar='PATH', help="Write the results as a baseline file")
+    parser.add_argument('--compare', metavar='PATH', help="Compare the results with a saved baseline")
+    args = parser.parse_args()
+
+    phases = [p.strip() for p in args.phases.split(',') if p.strip()]
+    unknown = set(phases) - set(PHASES)
+    if unknown:
+        parser.error(f"unknown phases: {', '.join(sorted(unknown))}")
+
+    ids = seed(args)
+    server = spawn_server(args) if args.spawn else None
+    recorder = Recorder()
+    try:
+        for phase in phases:
+            print(f"Running {phase}...", flush=True)
+            PHASE_RUNNERS[phase](args, ids, recorder)
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+
+    summary = recorder.summary()
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['endpoints']
+    print()
+    print_report(summary, baseline)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump({
+                'created_at': datetime.utcnow().isoformat(),
+                'database': args.database_url.split(':', 1)[0],
+                'phases': phases,
+                'endpoints': summary,
+            }, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+
+if __name__ == '__main__':
+    main()
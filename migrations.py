@@ -0,0 +1,424 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Versioned schema migrations.
+
+db.create_all() only creates missing tables; it never adds columns or
+indexes to tables that already exist. Every schema change to an existing
+table goes here as a numbered migration. upgrade() runs on app start, applies
+the ones not yet recorded in the schema_migrations table and records them.
+Migrations are idempotent, so a database freshly built by create_all() just
+gets them stamped. Works on SQLite and PostgreSQL.
+
+Usage:
+    python migrations.py            # apply pending migrations and show status
+    python migrations.py status     # list applied migrations
+    python migrations.py explain    # EXPLAIN the hot lookup queries
+    python migrations.py explain --compare  # ... with and without migration 2's indexes
+    python migrations.py rebuild-summary  # recompute the analytics participant summary
+    python migrations.py rebuild-search   # rewrite the participant search documents
+"""
+
+import logging
+import sys
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import OperationalError
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for pg_advisory_xact_lock so concurrent app workers migrate one at a time
+MIGRATION_LOCK_KEY = 7262024
+
+# The indexes migration 2 adds for hot_queries()
+HOT_QUERY_INDEXES = (
+    'ix_registration_session_user', 'ix_registration_session_guest_email', 'ix_registration_guest_phone',
+    'ix_attendance_session_user', 'ix_invite_session_email', 'ix_session_slug', 'ix_session_date_status',
+    'ix_user_reset_token',
+)
+
+
+def _quote(conn, name):
+    return conn.dialect.identifier_preparer.quote(name)
+
+
+def _has_column(conn, table, column):
+    return column in {c['name'] for c in inspect(conn).get_columns(table)}
+
+
+def _create_index(conn, name, table, columns, unique=False):
+    """Create an index if missing. A unique index falls back to a plain one when
+    existing rows already violate it, so startup never fails on legacy data."""
+    cols = ', '.join(_quote(conn, c) for c in columns)
+    if unique:
+        not_null = ' AND '.join(f'{_quote(conn, c)} IS NOT NULL' for c in columns)
+        duplicates = conn.execute(text(
+            f'SELECT {cols}, COUNT(*) FROM {_quote(conn, table)} WHERE {not_null} '
+            f'GROUP BY {cols} HAVING COUNT(*) > 1'
+        )).fetchmany(5)
+        if duplicates:
+            logger.error("Cannot make %s unique, duplicate %s rows exist (e.g. %s); "
+                         "creating a non-unique index instead", name, table, duplicates)
+            unique = False
+    conn.execute(text(
+        f'CREATE {"UNIQUE " if unique else ""}INDEX IF NOT EXISTS {_quote(conn, name)} '
+        f'ON {_quote(conn, table)} ({cols})'
+    ))
+
+
+def _merge_duplicate_attendance(conn):
+    """Collapse duplicate (session, user) attendance rows into the earliest one"""
+    groups = conn.execute(text(
+        'SELECT session_id, user_id FROM attendance GROUP BY session_id, user_id HAVING COUNT(*) > 1'
+    )).fetchall()
+    for session_id, user_id in groups:
+        rows = conn.execute(text(
+            'SELECT id, attended, check_in_time, qr_verified FROM attendance '
+            'WHERE session_id = :session_id AND user_id = :user_id ORDER BY id'
+        ), {'session_id': session_id, 'user_id': user_id}).fetchall()
+        check_ins = [r.check_in_time for r in rows if r.check_in_time]
+        conn.execute(text(
+            'UPDATE attendance SET attended = :attended, check_in_time = :check_in_time, '
+            'qr_verified = :qr_verified WHERE id = :id'
+        ), {
+            'id': rows[0].id,
+            'attended': any(r.attended for r in rows),
+            'check_in_time': min(check_ins) if check_ins else None,
+            'qr_verified': any(r.qr_verified for r in rows),
+        })
+        conn.execute(text('DELETE FROM attendance WHERE session_id = :session_id AND user_id = :user_id '
+                          'AND id <> :id'), {'session_id': session_id, 'user_id': user_id, 'id': rows[0].id})
+    if groups:
+        logger.warning("Merged duplicate attendance rows for %s attendees", len(groups))
+
+
+def _add_session_registration_count(conn):
+    """Session.registration_count seat counter, backfilled from approved registrations"""
+    if _has_column(conn, 'session', 'registration_count'):
+        return
+    session_table = _quote(conn, 'session')
+    conn.execute(text(f'ALTER TABLE {session_table} ADD COLUMN registration_count INTEGER NOT NULL DEFAULT 0'))
+    conn.execute(text(
+        f'UPDATE {session_table} SET registration_count = ('
+        f'SELECT COUNT(*) FROM registration WHERE registration.session_id = {session_table}.id '
+        f'AND registration.is_approved = :approved)'
+    ), {'approved': True})
+
+
+def _add_hot_query_indexes(conn):
+    """Indexes and unique constraints for the lookups routes.py runs on every request"""
+    _merge_duplicate_attendance(conn)
+    _create_index(conn, 'ix_registration_session_user', 'registration', ['session_id', 'user_id'], unique=True)
+    _create_index(conn, 'ix_registration_session_guest_email', 'registration', ['session_id', 'guest_email'], unique=True)
+    _create_index(conn, 'ix_registration_guest_phone', 'registration', ['guest_phone'])
+    _create_index(conn, 'ix_attendance_session_user', 'attendance', ['session_id', 'user_id'], unique=True)
+    _create_index(conn, 'ix_invite_session_email', 'invite', ['session_id', 'email'], unique=True)
+    _create_index(conn, 'ix_session_slug', 'session', ['slug'], unique=True)
+    _create_index(conn, 'ix_session_date_status', 'session', ['date', 'status'])
+    _create_index(conn, 'ix_user_reset_token', 'user', ['reset_token'])
+
+
+def _add_session_data_version(conn):
+    """Session.data_version, the key of the public page cache"""
+    if _has_column(conn, 'session', 'data_version'):
+        return
+    conn.execute(text(f'ALTER TABLE {_quote(conn, "session")} ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0'))
+
+
+def _add_registration_checked_in_at(conn):
+    """Registration.checked_in_at, written by signed ticket scans"""
+    if _has_column(conn, 'registration', 'checked_in_at'):
+        return
+    conn.execute(text('ALTER TABLE registration ADD COLUMN checked_in_at TIMESTAMP'))
+
+
+def _add_email_retries(conn):
+    """EmailOutbox.next_attempt_at; failed messages move to the dead-letter table"""
+    if not _has_column(conn, 'email_outbox', 'next_attempt_at'):
+        conn.execute(text('ALTER TABLE email_outbox ADD COLUMN next_attempt_at TIMESTAMP'))
+    # The worker used to leave failures in the outbox as 'failed'; they are dead letters now
+    conn.execute(text(
+        'INSERT INTO email_dead_letter '
+        '(outbox_id, recipients, subject, text, html, attachments, attempts, last_error, created_at, failed_at) '
+        'SELECT id, recipients, subject, text, html, attachments, attempts, last_error, created_at, CURRENT_TIMESTAMP '
+        "FROM email_outbox WHERE status = 'failed'"
+    ))
+    conn.execute(text("DELETE FROM email_outbox WHERE status = 'failed'"))
+
+
+def _add_roster_versions(conn):
+    """Session and Registration roster_version, the check-in scanners' sync cursor"""
+    if not _has_column(conn, 'session', 'roster_version'):
+        conn.execute(text(f'ALTER TABLE {_quote(conn, "session")} ADD COLUMN roster_version INTEGER NOT NULL DEFAULT 0'))
+    if not _has_column(conn, 'registration', 'roster_version'):
+        conn.execute(text('ALTER TABLE registration ADD COLUMN roster_version INTEGER NOT NULL DEFAULT 0'))
+    _create_index(conn, 'ix_registration_session_roster_version', 'registration', ['session_id', 'roster_version'])
+
+
+def rebuild_participant_summary(conn):
+    """Recompute every member's registration and attendance counts from the raw tables"""
+    conn.execute(text('DELETE FROM participant_summary'))
+    conn.execute(text(
+        'INSERT INTO participant_summary (user_id, registrations, attendances) '
+        'SELECT user_id, SUM(registrations), SUM(attendances) FROM ('
+        ' SELECT user_id, COUNT(*) AS registrations, 0 AS attendances FROM registration'
+        ' WHERE user_id IS NOT NULL GROUP BY user_id'
+        ' UNION ALL'
+        ' SELECT user_id, 0, COUNT(*) FROM attendance WHERE attended = :attended GROUP BY user_id'
+        ') AS counts GROUP BY user_id'
+    ), {'attended': True})
+
+
+def _fill_participant_summary(conn):
+    """Backfill the analytics summary table created by create_all()"""
+    rebuild_participant_summary(conn)
+
+
+def _add_ai_analytics_fingerprint(conn):
+    """AIAnalytics.fingerprint, the cache key for stored AI analyses"""
+    if not _has_column(conn, 'ai_analytics', 'fingerprint'):
+        conn.execute(text('ALTER TABLE ai_analytics ADD COLUMN fingerprint VARCHAR(64)'))
+
+
+def _add_participant_search(conn):
+    """Full-text index over participant_search (FTS5 on SQLite, tsvector on PostgreSQL) and its backfill"""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text(
+            'CREATE INDEX IF NOT EXISTS ix_participant_search_document ON participant_search '
+            "USING gin (to_tsvector('simple', document))"
+        ))
+    else:
+        try:
+            with conn.begin_nested():
+                conn.execute(text(
+                    'CREATE VIRTUAL TABLE IF NOT EXISTS participant_fts USING fts5('
+                    "document, content='participant_search', content_rowid='user_id')"
+                ))
+        except OperationalError as e:
+            logger.warning("SQLite has no FTS5 (%s); participant search falls back to LIKE", e)
+        else:
+            # External-content FTS5 table: the triggers keep it in step with participant_search
+            conn.execute(text(
+                'CREATE TRIGGER IF NOT EXISTS participant_search_ai AFTER INSERT ON participant_search BEGIN '
+                'INSERT INTO participant_fts(rowid, document) VALUES (new.user_id, new.document); END'
+            ))
+            conn.execute(text(
+                'CREATE TRIGGER IF NOT EXISTS participant_search_ad AFTER DELETE ON participant_search BEGIN '
+                "INSERT INTO participant_fts(participant_fts, rowid, document) "
+                "VALUES ('delete', old.user_id, old.document); END"
+            ))
+            conn.execute(text(
+                'CREATE TRIGGER IF NOT EXISTS participant_search_au AFTER UPDATE ON participant_search BEGIN '
+                "INSERT INTO participant_fts(participant_fts, rowid, document) "
+                "VALUES ('delete', old.user_id, old.document); "
+                'INSERT INTO participant_fts(rowid, document) VALUES (new.user_id, new.document); END'
+            ))
+    rebuild_participant_search(conn)
+
+
+def rebuild_participant_search(conn):
+    """Rewrite every member's search document; the normalization is Python, not SQL"""
+    from participant_search import rebuild
+    rebuild(conn)
+
+
+def _add_session_attendance_version(conn):
+    """Session.attendance_version, with data_version the key of the session performance cache"""
+    if _has_column(conn, 'session', 'attendance_version'):
+        return
+    conn.execute(text(f'ALTER TABLE {_quote(conn, "session")} ADD COLUMN attendance_version INTEGER NOT NULL DEFAULT 0'))
+
+
+def _drop_legacy_refresh_tokens(conn):
+    """Clear the plaintext user.refresh_token columns replaced by RefreshToken, and drop them where possible"""
+    user = _quote(conn, 'user')
+    if not _has_column(conn, 'user', 'refresh_token'):
+        return
+    conn.execute(text(f'UPDATE {user} SET refresh_token = NULL, refresh_token_expires = NULL'))
+    try:
+        with conn.begin_nested():
+            conn.execute(text(f'ALTER TABLE {user} DROP COLUMN refresh_token'))
+            conn.execute(text(f'ALTER TABLE {user} DROP COLUMN refresh_token_expires'))
+    except OperationalError as e:
+        # SQLite before 3.35 cannot drop columns; the values are gone either way
+        logger.warning("Could not drop user.refresh_token columns (%s); left them empty", e)
+
+
+def _add_user_tokens_revoked_at(conn):
+    """User.tokens_revoked_at, which invalidates other workers' cached refresh tokens"""
+    if _has_column(conn, 'user', 'tokens_revoked_at'):
+        return
+    conn.execute(text(f'ALTER TABLE {_quote(conn, "user")} ADD COLUMN tokens_revoked_at TIMESTAMP'))
+
+
+def _add_background_job_heartbeat(conn):
+    """BackgroundJob.heartbeat_at, and at most one queued or running approve-all job per session"""
+    table = _quote(conn, 'background_job')
+    if not _has_column(conn, 'background_job', 'heartbeat_at'):
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN heartbeat_at TIMESTAMP'))
+    active = "kind = 'approve_all' AND status IN ('queued', 'running')"
+    # Keep the newest of any duplicates; the older ones can never finish now
+    conn.execute(text(
+        f"UPDATE {table} SET status = 'failed', error = :error, finished_at = :now "
+        f"WHERE {active} AND id NOT IN (SELECT MAX(id) FROM {table} WHERE {active} GROUP BY session_id)"
+    ), {'error': 'Superseded by a newer approve-all job', 'now': datetime.utcnow()})
+    conn.execute(text(
+        f'CREATE UNIQUE INDEX IF NOT EXISTS ux_background_job_active_approve_all '
+        f'ON {table} (kind, session_id) WHERE {active}'
+    ))
+
+
+def _drop_user_tokens_revoked_at(conn):
+    """Drop user.tokens_revoked_at; refresh tokens are no longer cached, so nothing reads it"""
+    if not _has_column(conn, 'user', 'tokens_revoked_at'):
+        return
+    try:
+        with conn.begin_nested():
+            conn.execute(text(f'ALTER TABLE {_quote(conn, "user")} DROP COLUMN tokens_revoked_at'))
+    except OperationalError as e:
+        # SQLite before 3.35 cannot drop columns; the unused column stays
+        logger.warning("Could not drop user.tokens_revoked_at (%s)", e)
+
+
+# (version, name, function) - append only, never renumber
+MIGRATIONS = [
+    (1, 'session registration_count', _add_session_registration_count),
+    (2, 'hot query indexes', _add_hot_query_indexes),
+    (3, 'session data_version', _add_session_data_version),
+    (4, 'registration checked_in_at', _add_registration_checked_in_at),
+    (5, 'email retries and dead letters', _add_email_retries),
+    (6, 'roster versions', _add_roster_versions),
+    (7, 'participant summary', _fill_participant_summary),
+    (8, 'ai analytics fingerprint', _add_ai_analytics_fingerprint),
+    (9, 'participant search index', _add_participant_search),
+    (10, 'session attendance_version', _add_session_attendance_version),
+    (11, 'drop legacy refresh token columns', _drop_legacy_refresh_tokens),
+    (12, 'user tokens_revoked_at', _add_user_tokens_revoked_at),
+    (13, 'background job heartbeat', _add_background_job_heartbeat),
+    (14, 'drop user tokens_revoked_at', _drop_user_tokens_revoked_at),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version INTEGER PRIMARY KEY, name VARCHAR(200) NOT NULL, applied_at TIMESTAMP NOT NULL)'
+    ))
+
+
+def upgrade(engine):
+    """Apply every migration not yet recorded, in one transaction"""
+    with engine.begin() as conn:
+        if conn.dialect.name == 'postgresql':
+            conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': MIGRATION_LOCK_KEY})
+        _ensure_version_table(conn)
+        applied = {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+        for version, name, migrate in MIGRATIONS:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s: %s", version, name)
+            migrate(conn)
+            conn.execute(text(
+                'INSERT INTO schema_migrations (version, name, applied_at) VALUES (:version, :name, :applied_at)'
+            ), {'version': version, 'name': name, 'applied_at': datetime.utcnow()})
+
+
+def status(engine):
+    """Return (version, name, applied_at or None) for every known migration"""
+    with engine.begin() as conn:
+        _ensure_version_table(conn)
+        applied = dict(conn.execute(text('SELECT version, applied_at FROM schema_migrations')).fetchall())
+    return [(version, name, applied.get(version)) for version, name, _ in MIGRATIONS]
+
+
+def hot_queries():
+    """The lookups migration 2 indexes, as (label, statement) pairs"""
+    from app import db
+    from models import User, Session, Registration, Attendance, Invite
+
+    return [
+        ('registration by session + user',
+         db.select(Registration).where(Registration.session_id == 1, Registration.user_id == 1)),
+        ('registration by session + guest email',
+         db.select(Registration).where(Registration.session_id == 1, Registration.guest_email == 'a@example.com')),
+        ('registration by guest phone',
+         db.select(Registration).where(Registration.user_id.is_(None), Registration.guest_phone == '0500000000')),
+        ('attendance by session + user',
+         db.select(Attendance).where(Attendance.session_id == 1, Attendance.user_id == 1)),
+        ('invite by session + email',
+         db.select(Invite).where(Invite.session_id == 1, Invite.email == 'a@example.com')),
+        ('session by slug',
+         db.select(Session).where(Session.slug == 'business-tuesday-1')),
+        ('upcoming open sessions',
+         db.select(Session).where(Session.date > datetime(2025, 1, 1), Session.status == 'open')
+         .order_by(Session.date).limit(3)),
+        ('user by reset token',
+         db.select(User).where(User.reset_token == 'token')),
+    ]
+
+
+def explain(engine, without_indexes=False):
+    """Return (label, plan lines) for each hot query on this database.
+
+    With without_indexes the plans are made as if migration 2 had not run.
+    SQLite drops its indexes in a transaction that is rolled back. PostgreSQL
+    switches index scans off for the transaction instead, so no table is locked.
+    """
+    sqlite = engine.dialect.name == 'sqlite'
+    prefix = 'EXPLAIN QUERY PLAN ' if sqlite else 'EXPLAIN '
+    report = []
+    with engine.connect() as conn:
+        if without_indexes and sqlite:
+            # pysqlite opens no transaction for DDL, so BEGIN and ROLLBACK are issued by hand
+            conn.execution_options(isolation_level='AUTOCOMMIT')
+            conn.exec_driver_sql('BEGIN')
+            for name in HOT_QUERY_INDEXES:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS {_quote(conn, name)}')
+            # SQLite never re-prepares an EXPLAIN after a schema change, so keep these apart
+            # from the plain plans in pysqlite's statement cache
+            prefix += '/* without indexes */ '
+        elif without_indexes:
+            for setting in ('enable_indexscan', 'enable_indexonlyscan', 'enable_bitmapscan'):
+                conn.exec_driver_sql(f'SET LOCAL {setting} = off')
+        try:
+            for label, statement in hot_queries():
+                sql = str(statement.compile(dialect=engine.dialect, compile_kwargs={'literal_binds': True}))
+                rows = conn.execute(text(prefix + sql)).fetchall()
+                report.append((label, [' | '.join(str(v) for v in row) for row in rows]))
+        finally:
+            if without_indexes and sqlite:
+                conn.exec_driver_sql('ROLLBACK')
+    return report
+
+
+if __name__ == '__main__':
+    # Importing the app applies pending migrations
+    from app import app, db
+
+    command = sys.argv[1] if len(sys.argv) > 1 else 'upgrade'
+    with app.app_context():
+        if command == 'rebuild-summary':
+            with db.engine.begin() as conn:
+                rebuild_participant_summary(conn)
+            print("Participant summary rebuilt")
+        elif command == 'rebuild-search':
+            with db.engine.begin() as conn:
+                rebuild_participant_search(conn)
+            print("Participant search documents rebuilt")
+        elif command == 'explain':
+            plans = [('', explain(db.engine))]
+            if '--compare' in sys.argv:
+                plans = [('with indexes', plans[0][1]),
+                         ('without migration 2 indexes', explain(db.engine, without_indexes=True))]
+            for i, (label, _) in enumerate(plans[0][1]):
+                print(f"{label}:")
+                for heading, report in plans:
+                    if heading:
+                        print(f"  {heading}:")
+                    for line in report[i][1]:
+                        print(f"    {line}")
+        else:
+            for version, name, applied_at in status(db.engine):
+                print(f"{version:>4}  {name:<40} {applied_at or 'pending'}")
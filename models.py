@@ -1,8 +1,14 @@
 from app import db
 from flask_login import UserMixin
 from datetime import datetime
-from sqlalchemy import func
+import hashlib
+import secrets
+from sqlalchemy import event, func
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session as OrmSession
 from werkzeug.security import generate_password_hash, check_password_hash
+import arabic_text
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -25,16 +31,13 @@ class User(db.Model):
     is_active = db.Column(db.Boolean, default=True)
 
     # Password reset fields
-    reset_token = db.Column(db.String(128))
+    reset_token = db.Column(db.String(128), index=True)
     reset_token_expires = db.Column(db.DateTime)
 
-    # Remember me / refresh token fields
-    refresh_token = db.Column(db.String(128))
-    refresh_token_expires = db.Column(db.DateTime)
-
     # Relationships
     registrations = db.relationship('Registration', backref='user', lazy=True)
     attendances = db.relationship('Attendance', backref='user', lazy=True)
+    refresh_tokens = db.relationship('RefreshToken', backref='user', lazy=True, cascade='all, delete-orphan')
 
     def set_password(self, password):
         """Hash and set the user's password"""
@@ -52,7 +55,42 @@ class User(db.Model):
     def get_profile_url(self):
         return f"/u/{self.username}"
 
+class RefreshToken(db.Model):
+    """Remember-me token for one device; only a SHA-256 hash of the cookie value is stored"""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    user_agent = db.Column(db.String(200))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+    last_extended_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    @staticmethod
+    def hash_token(token):
+        """Hash a cookie value for lookup (tokens are random, so a plain digest is enough)"""
+        return hashlib.sha256(token.encode()).hexdigest()
+
+    @classmethod
+    def issue(cls, user, lifetime, user_agent=None):
+        """Create a token for user and return the raw value to put in the cookie"""
+        token = secrets.token_urlsafe(32)
+        now = datetime.utcnow()
+        db.session.add(cls(
+            user_id=user.id,
+            token_hash=cls.hash_token(token),
+            user_agent=(user_agent or '')[:200] or None,
+            created_at=now,
+            expires_at=now + lifetime,
+            last_extended_at=now
+        ))
+        return token
+
 class Session(db.Model):
+    __table_args__ = (
+        db.Index('ix_session_slug', 'slug', unique=True),
+        db.Index('ix_session_date_status', 'date', 'status'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     session_number = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String(200), nullable=False)
@@ -80,15 +118,133 @@ class Session(db.Model):
     invite_message = db.Column(db.Text)  # Custom invitation message
     send_qr_in_email = db.Column(db.Boolean, default=True)  # Include QR code in confirmation emails
 
+    # Seats taken by approved registrations: reserve_seats() takes them, recount_registrations() rebuilds the count
+    registration_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Bumped on every write to the session or its registrations; keys the public page cache
+    data_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped for every change to the session's check-in roster; the door scanners' sync cursor
+    roster_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # Bumped on every write to the session's attendance; keys the admin analytics cache
+    attendance_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relationships
     registrations = db.relationship('Registration', backref='session', lazy=True)
     attendances = db.relationship('Attendance', backref='session', lazy=True)
     
     def get_registration_count(self):
-        return len([r for r in self.registrations if r.is_approved])
+        return self.registration_count or 0
     
     def is_full(self):
         return self.get_registration_count() >= self.max_participants
+
+    def reserve_seats(self, seats=1):
+        """Atomically take seats if capacity allows.
+
+        Runs a single conditional UPDATE so concurrent registrations can never
+        push the counter past max_participants. Returns True if the seats were
+        reserved; the caller commits (or rolls back) with the registration rows.
+        """
+        if seats <= 0:
+            return True
+        result = db.session.execute(
+            db.update(Session)
+            .where(
+                Session.id == self.id,
+                Session.registration_count + seats <= Session.max_participants
+            )
+            .values(registration_count=Session.registration_count + seats)
+            .execution_options(synchronize_session=False)
+        )
+        db.session.expire(self, ['registration_count'])
+        return result.rowcount == 1
+
+    @classmethod
+    def with_counts(cls, query, limit=None):
+        """Run a session listing query with its counts precomputed.
+
+        Approved counts come from the maintained registration_count column and
+        attended counts from one grouped subquery joined onto the listing, so a
+        page costs a single query however many sessions it shows. Each returned
+        session gets an attended_count attribute for the templates.
+        """
+        attended = db.session.query(
+            Attendance.session_id,
+            func.count(Attendance.id).label('attended_count')
+        ).filter(Attendance.attended.is_(True)).group_by(Attendance.session_id).subquery()
+
+        query = query.outerjoin(attended, attended.c.session_id == cls.id).add_columns(
+            func.coalesce(attended.c.attended_count, 0)
+        )
+        if limit is not None:
+            query = query.limit(limit)
+
+        sessions = []
+        for session, attended_count in query.all():
+            session.attended_count = attended_count
+            sessions.append(session)
+        return sessions
+
+    @classmethod
+    def bump_versions(cls, session_ids, connection=None, counter='data_version'):
+        """Mark the given sessions' cached pages stale. Set-based writes that skip the
+        ORM (bulk UPDATE/INSERT of registrations) must call this themselves.
+        counter='attendance_version' does the same for attendance writes."""
+        session_ids = {sid for sid in session_ids if sid is not None}
+        if not session_ids:
+            return
+        statement = db.update(Session).where(Session.id.in_(session_ids)).values(
+            {counter: getattr(Session, counter) + 1}
+        )
+        if connection is not None:
+            connection.execute(statement)
+        else:
+            db.session.execute(statement.execution_options(synchronize_session=False))
+
+    @classmethod
+    def next_roster_version(cls, session_id, connection=None):
+        """Take the next roster version of a session.
+
+        The UPDATE holds the session row until commit, so writers get versions
+        in commit order and a reader that sees version v sees every change up to v.
+        """
+        statement = db.update(Session).where(Session.id == session_id).values(
+            roster_version=Session.roster_version + 1
+        ).returning(Session.roster_version)
+        if connection is not None:
+            return connection.execute(statement).scalar()
+        return db.session.execute(statement.execution_options(synchronize_session=False)).scalar()
+
+    @classmethod
+    def get_by_identifier(cls, identifier):
+        """Find a session by its slug, falling back to a numeric id"""
+        session_obj = cls.query.filter_by(slug=identifier).first()
+        if not session_obj and identifier.isdigit():
+            session_obj = db.session.get(cls, int(identifier))
+        return session_obj
+
+    @classmethod
+    def listing_version(cls):
+        """Fingerprint of all sessions; changes when any session or registration is written"""
+        return tuple(db.session.query(
+            func.count(cls.id), func.coalesce(func.sum(cls.data_version), 0), func.max(cls.id)
+        ).one())
+
+    @classmethod
+    def performance_version(cls):
+        """listing_version() that also changes when any attendance is written"""
+        return tuple(db.session.query(
+            func.count(cls.id), func.coalesce(func.sum(cls.data_version), 0),
+            func.coalesce(func.sum(cls.attendance_version), 0), func.max(cls.id)
+        ).one())
+
+    def recount_registrations(self):
+        """Rebuild the seat counter from approved registration rows"""
+        self.registration_count = Registration.query.filter_by(
+            session_id=self.id,
+            is_approved=True
+        ).count()
+        return self.registration_count
     
     def can_register(self):
         # Check if registration is open and not full
@@ -124,6 +280,13 @@ class Session(db.Model):
         return self.slug
 
 class Registration(db.Model):
+    __table_args__ = (
+        # NULLs are distinct, so guest rows don't collide on user_id (nor user rows on guest_email)
+        db.Index('ix_registration_session_user', 'session_id', 'user_id', unique=True),
+        db.Index('ix_registration_session_guest_email', 'session_id', 'guest_email', unique=True),
+        db.Index('ix_registration_session_roster_version', 'session_id', 'roster_version'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Nullable for guest registrations
     session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
@@ -134,7 +297,7 @@ class Registration(db.Model):
     # Guest registration fields (used when user_id is NULL)
     guest_name = db.Column(db.String(100))
     guest_email = db.Column(db.String(120))
-    guest_phone = db.Column(db.String(20))
+    guest_phone = db.Column(db.String(20), index=True)
     guest_instagram = db.Column(db.String(200))
     guest_snapchat = db.Column(db.String(200))
     guest_twitter = db.Column(db.String(200))
@@ -144,6 +307,11 @@ class Registration(db.Model):
     guest_gender = db.Column(db.String(10))
     guest_goal = db.Column(db.Text)
 
+    # Set by the first ticket scan at the door
+    checked_in_at = db.Column(db.DateTime)
+    # Session.roster_version of the last change to this row, for scanner delta sync
+    roster_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relationships
     companions = db.relationship('Companion', backref='registration', lazy=True, cascade='all, delete-orphan')
 
@@ -173,7 +341,69 @@ class Registration(db.Model):
         """Get the number of companions for this registration"""
         return len(self.companions)
 
+    @classmethod
+    def _stamp_roster_version(cls, registration_ids, session_id):
+        """Give registrations that just changed the next roster version of their session"""
+        db.session.execute(
+            db.update(cls).where(cls.id.in_(registration_ids))
+            .values(roster_version=Session.next_roster_version(session_id))
+            .execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    def check_in(cls, registration_id, session_id):
+        """Check a ticket holder in with one conditional primary-key UPDATE.
+
+        Returns (user_id, first_scan) for an approved registration of the
+        session, or None if there is no such registration. Only a first scan
+        takes a roster version (and so the session row lock); repeat scans
+        keep the first check-in time, write nothing and cost one more lookup.
+        """
+        approved = (cls.id == registration_id, cls.session_id == session_id, cls.is_approved.is_(True))
+        row = db.session.execute(
+            db.update(cls)
+            .where(*approved, cls.checked_in_at.is_(None))
+            .values(checked_in_at=datetime.utcnow())
+            .returning(cls.user_id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if row is not None:
+            cls._stamp_roster_version([registration_id], session_id)
+            return row.user_id, True
+        row = db.session.execute(db.select(cls.user_id).where(*approved)).first()
+        return (row.user_id, False) if row is not None else None
+
+    @classmethod
+    def check_in_many(cls, registration_ids, session_id):
+        """Check in several ticket holders of a session with one UPDATE.
+
+        Returns (checked_in, already_checked_in) dicts of registration id ->
+        user_id; ids that are not approved registrations of the session are in
+        neither.
+        """
+        approved = (cls.id.in_(registration_ids), cls.session_id == session_id, cls.is_approved.is_(True))
+        checked_in = dict(db.session.execute(
+            db.update(cls)
+            .where(*approved, cls.checked_in_at.is_(None))
+            .values(checked_in_at=datetime.utcnow())
+            .returning(cls.id, cls.user_id)
+            .execution_options(synchronize_session=False)
+        ).all())
+        if checked_in:
+            cls._stamp_roster_version(list(checked_in), session_id)
+        already = {}
+        if len(checked_in) < len(set(registration_ids)):
+            already = dict(db.session.execute(
+                db.select(cls.id, cls.user_id).where(*approved, cls.id.notin_(list(checked_in)))
+            ).all())
+        return checked_in, already
+
+
 class Attendance(db.Model):
+    __table_args__ = (
+        db.Index('ix_attendance_session_user', 'session_id', 'user_id', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
@@ -181,6 +411,129 @@ class Attendance(db.Model):
     check_in_time = db.Column(db.DateTime)
     qr_verified = db.Column(db.Boolean, default=False)
 
+    @classmethod
+    def check_in(cls, session_id, verified):
+        """Mark members of a session present with one upsert.
+
+        verified maps user id -> whether the visit was confirmed by a QR
+        scan. The first check-in wins: rows already marked present keep their
+        time and are not written again. Returns the user ids marked present
+        by this call.
+        """
+        if not verified:
+            return set()
+        now = datetime.utcnow()
+        statement = _upsert(cls).values([
+            {'session_id': session_id, 'user_id': user_id, 'attended': True,
+             'check_in_time': now, 'qr_verified': bool(qr_verified)}
+            for user_id, qr_verified in verified.items()
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=['session_id', 'user_id'],
+            set_={
+                'attended': True,
+                'check_in_time': db.func.coalesce(cls.check_in_time, statement.excluded.check_in_time),
+                'qr_verified': statement.excluded.qr_verified
+            },
+            where=db.or_(cls.attended.is_(None), cls.attended.is_(False))
+        ).returning(cls.user_id)
+        marked = set(db.session.scalars(statement))
+        if marked:
+            ParticipantSummary.add('attendances', {user_id: 1 for user_id in marked})
+            Session.bump_versions({session_id}, counter='attendance_version')
+        return marked
+
+    @classmethod
+    def mark_absent(cls, session_id, user_id):
+        """Record a member as not attending, clearing any check-in"""
+        was_present = db.session.execute(
+            db.update(cls)
+            .where(cls.session_id == session_id, cls.user_id == user_id, cls.attended.is_(True))
+            .values(attended=False, check_in_time=None, qr_verified=False)
+            .returning(cls.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        if was_present:
+            ParticipantSummary.add('attendances', {user_id: -1})
+            Session.bump_versions({session_id}, counter='attendance_version')
+        else:
+            # Nothing to undo; if a check-in lands meanwhile it wins
+            db.session.execute(_upsert(cls).values(
+                session_id=session_id, user_id=user_id, attended=False
+            ).on_conflict_do_nothing(index_elements=['session_id', 'user_id']))
+
+
+class ParticipantSummary(db.Model):
+    """Per-member registration and attendance counts for analytics.
+
+    Kept current by the flush hooks below and by the set-based attendance
+    writes, so analytics read one small table instead of every registration
+    and attendance row. `python migrations.py rebuild-summary` recomputes it.
+    """
+    __tablename__ = 'participant_summary'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    registrations = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    attendances = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    @classmethod
+    def add(cls, counter, deltas, connection=None):
+        """Add deltas (user id -> change) to one counter with a single upsert"""
+        deltas = {user_id: delta for user_id, delta in deltas.items() if user_id is not None and delta}
+        if not deltas:
+            return
+        other = 'attendances' if counter == 'registrations' else 'registrations'
+        # Sorted so concurrent upserts lock rows in the same order
+        statement = _upsert(cls, connection).values([
+            {'user_id': user_id, counter: delta, other: 0} for user_id, delta in sorted(deltas.items())
+        ])
+        statement = statement.on_conflict_do_update(
+            index_elements=['user_id'],
+            set_={counter: getattr(cls, counter) + getattr(statement.excluded, counter)}
+        )
+        (connection or db.session).execute(statement)
+
+
+class ParticipantSearch(db.Model):
+    """Normalized search text of a member (see arabic_text.py).
+
+    Rewritten by the flush hook below whenever a searchable User field
+    changes. Migration 9 indexes it: an FTS5 table kept in step by triggers
+    on SQLite, a tsvector expression index on PostgreSQL.
+    """
+    __tablename__ = 'participant_search'
+
+    FIELDS = ('name', 'company_name', 'position', 'activity_type', 'goal', 'ai_description')
+    STORE_CHUNK = 1000
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), primary_key=True)
+    document = db.Column(db.Text, nullable=False, default='')
+
+    @classmethod
+    def document_for(cls, values):
+        """Indexed text for a mapping (or row) of the searchable fields"""
+        return ' '.join(arabic_text.terms(' '.join(values[field] or '' for field in cls.FIELDS)))
+
+    @classmethod
+    def store(cls, documents, connection=None):
+        """Upsert documents (user id -> text)"""
+        rows = [{'user_id': user_id, 'document': document} for user_id, document in sorted(documents.items())]
+        # Chunked to stay under SQLite's bound-parameter limit on bulk imports
+        for start in range(0, len(rows), cls.STORE_CHUNK):
+            statement = _upsert(cls, connection).values(rows[start:start + cls.STORE_CHUNK])
+            statement = statement.on_conflict_do_update(
+                index_elements=['user_id'], set_={'document': statement.excluded.document}
+            )
+            (connection or db.session).execute(statement)
+
+
+def _upsert(model, connection=None):
+    """INSERT supporting ON CONFLICT for the database in use"""
+    bind = connection if connection is not None else db.session.get_bind()
+    if bind.dialect.name == 'sqlite':
+        return sqlite_insert(model)
+    return postgresql_insert(model)
+
 
 class Companion(db.Model):
     """Companion attached to a registration"""
@@ -212,6 +565,10 @@ class Admin(UserMixin, db.Model):
     last_login = db.Column(db.DateTime)
 
 class Invite(db.Model):
+    __table_args__ = (
+        db.Index('ix_invite_session_email', 'session_id', 'email', unique=True),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=False)
     email = db.Column(db.String(120), nullable=False)
@@ -230,3 +587,173 @@ class AIAnalytics(db.Model):
     data = db.Column(db.JSON)
     generated_at = db.Column(db.DateTime, default=datetime.utcnow)
     session_id = db.Column(db.Integer, db.ForeignKey('session.id'), nullable=True)
+    # Hash of the aggregated figures the analysis was written from; see analytics_cache.py
+    fingerprint = db.Column(db.String(64))
+
+
+class EmailOutbox(db.Model):
+    """Outgoing email queued in the caller's transaction and sent by email_worker.py"""
+    id = db.Column(db.Integer, primary_key=True)
+    recipients = db.Column(db.JSON, nullable=False)  # List of email addresses
+    subject = db.Column(db.String(255), nullable=False)
+    text = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attachments = db.Column(db.JSON)  # Resend attachment dicts (base64 content)
+    status = db.Column(db.String(20), nullable=False, default='pending', index=True)  # pending, sending, sent
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    provider_id = db.Column(db.String(100))  # Message id returned by the email provider
+    lock_token = db.Column(db.String(32))  # Set by the worker that claimed the message
+    locked_at = db.Column(db.DateTime)
+    next_attempt_at = db.Column(db.DateTime)  # Retry not before this after a transient failure
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sent_at = db.Column(db.DateTime)
+
+
+class EmailDeadLetter(db.Model):
+    """Outbox message the worker gave up on; admins can requeue it"""
+    id = db.Column(db.Integer, primary_key=True)
+    outbox_id = db.Column(db.Integer)  # Id the message had in the outbox
+    recipients = db.Column(db.JSON, nullable=False)
+    subject = db.Column(db.String(255), nullable=False)
+    text = db.Column(db.Text)
+    html = db.Column(db.Text)
+    attachments = db.Column(db.JSON)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime)  # When the message was first queued
+    failed_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+class BackgroundJob(db.Model):
+    """Long-running admin action run off the request; polled for progress"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)  # approve_all, send_invites
+    session_id = db.Column(db.Integer, db.ForeignKey('session.id'), index=True)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, done, failed
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    heartbeat_at = db.Column(db.DateTime)  # Stamped while the job's process is alive
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'session_id': self.session_id,
+            'status': self.status,
+            'total': self.total,
+            'processed': self.processed,
+            'result': self.result,
+            'error': self.error,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None
+        }
+
+
+@event.listens_for(OrmSession, 'before_flush')
+def _collect_changed_sessions(session, flush_context, instances):
+    """Remember which sessions this flush touches so their data_version gets bumped"""
+    changed = session.info.setdefault('changed_session_ids', set())
+    attended = session.info.setdefault('attendance_session_ids', set())
+    roster = session.info.setdefault('changed_registrations', [])
+    new, deleted = session.new, session.deleted
+    for obj in list(new) + list(session.dirty) + list(deleted):
+        if isinstance(obj, Registration) and (obj in new or obj in deleted or session.is_modified(obj)):
+            # Registrations attached through the relationship get session_id on this flush
+            changed.add(obj.session_id if obj.session_id is not None else getattr(obj.session, 'id', None))
+            if obj not in deleted:
+                roster.append(obj)
+        elif isinstance(obj, Session) and obj not in new and (obj in deleted or session.is_modified(obj)):
+            changed.add(obj.id)
+        elif isinstance(obj, Attendance) and (obj in new or obj in deleted or session.is_modified(obj)):
+            attended.add(obj.session_id if obj.session_id is not None else getattr(obj.session, 'id', None))
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _bump_changed_sessions(session, flush_context):
+    changed = session.info.pop('changed_session_ids', None)
+    if changed:
+        Session.bump_versions(changed, connection=session.connection())
+    attended = session.info.pop('attendance_session_ids', None)
+    if attended:
+        Session.bump_versions(attended, connection=session.connection(), counter='attendance_version')
+
+    # Stamp changed registrations with a new roster version of their session
+    by_session = {}
+    for registration in session.info.pop('changed_registrations', None) or ():
+        by_session.setdefault(registration.session_id, set()).add(registration.id)
+    connection = session.connection()
+    for session_id, registration_ids in by_session.items():
+        version = Session.next_roster_version(session_id, connection=connection)
+        connection.execute(
+            db.update(Registration).where(Registration.id.in_(registration_ids)).values(roster_version=version)
+        )
+
+    _count_participant_changes(session, connection)
+    _index_changed_users(session, connection)
+
+
+def _history(obj, attr):
+    """(old, new) value of an attribute across the flush"""
+    history = db.inspect(obj).attrs[attr].history
+    new = history.added[0] if history.added else getattr(obj, attr)
+    old = history.deleted[0] if history.deleted else (None if history.added else new)
+    return old, new
+
+
+def _count_participant_changes(session, connection):
+    """Apply this flush's member registrations and attendances to ParticipantSummary"""
+    registrations, attendances = {}, {}
+
+    def count(deltas, user_id, change):
+        if user_id is not None:
+            deltas[user_id] = deltas.get(user_id, 0) + change
+
+    # session.new and session.deleted build a new set on every access
+    new, deleted = session.new, session.deleted
+    for obj in new:
+        if isinstance(obj, Registration):
+            count(registrations, obj.user_id, 1)
+        elif isinstance(obj, Attendance) and obj.attended:
+            count(attendances, obj.user_id, 1)
+    for obj in deleted:
+        if isinstance(obj, Registration):
+            count(registrations, _history(obj, 'user_id')[0], -1)
+        elif isinstance(obj, Attendance) and _history(obj, 'attended')[0]:
+            count(attendances, _history(obj, 'user_id')[0], -1)
+    for obj in session.dirty:
+        if obj in new or obj in deleted:
+            continue
+        if isinstance(obj, Registration):
+            old_user, new_user = _history(obj, 'user_id')
+            if old_user != new_user:
+                count(registrations, old_user, -1)
+                count(registrations, new_user, 1)
+        elif isinstance(obj, Attendance):
+            old_user, new_user = _history(obj, 'user_id')
+            old_attended, new_attended = _history(obj, 'attended')
+            if old_attended:
+                count(attendances, old_user, -1)
+            if new_attended:
+                count(attendances, new_user, 1)
+
+    ParticipantSummary.add('registrations', registrations, connection=connection)
+    ParticipantSummary.add('attendances', attendances, connection=connection)
+
+
+def _index_changed_users(session, connection):
+    """Rewrite the search documents of users whose searchable fields this flush changed"""
+    documents = {}
+    new, deleted = session.new, session.deleted
+    for obj in list(new) + list(session.dirty):
+        if not isinstance(obj, User) or obj in deleted:
+            continue
+        state = db.inspect(obj)
+        if obj in new or any(state.attrs[f].history.has_changes() for f in ParticipantSearch.FIELDS):
+            documents[obj.id] = ParticipantSearch.document_for({f: getattr(obj, f) for f in ParticipantSearch.FIELDS})
+    ParticipantSearch.store(documents, connection=connection)
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""
+Participant metrics for the analytics pages and their AI summaries.
+
+Everything is computed in the database: GROUP BY queries over users and
+sessions, and the ParticipantSummary table (per-member registration and
+attendance counts, kept current on every write) for repeat attendance. No
+query loads the users, registrations or attendance rows themselves, and
+the AI prompt receives only these aggregated figures.
+"""
+
+from app import db
+from models import Attendance, ParticipantSummary, Registration, Session, User
+
+# Long lists are cut to their most common (or most recent) entries before reaching the prompt
+TOP_COMPANIES = 20
+GOAL_SAMPLE_SIZE = 20
+
+
+def _filled(column):
+    return db.and_(column.isnot(None), column != '')
+
+
+def demographics():
+    """Member count, activity type counts, the most common companies and a sample of goals"""
+    activity_types = db.session.execute(
+        db.select(User.activity_type, db.func.count())
+        .where(_filled(User.activity_type))
+        .group_by(User.activity_type)
+        .order_by(db.func.count().desc())
+    ).all()
+    companies = db.session.execute(
+        db.select(User.company_name, db.func.count())
+        .where(_filled(User.company_name))
+        .group_by(User.company_name)
+        .order_by(db.func.count().desc(), User.company_name)
+        .limit(TOP_COMPANIES)
+    ).all()
+    total_users, with_company, with_goal = db.session.execute(db.select(
+        db.func.count(),
+        db.func.count(db.case((_filled(User.company_name), 1))),
+        db.func.count(db.case((_filled(User.goal), 1)))
+    )).one()
+    goals = db.session.scalars(
+        db.select(User.goal).where(_filled(User.goal)).order_by(User.id.desc()).limit(GOAL_SAMPLE_SIZE)
+    ).all()
+    return {
+        "total_users": total_users,
+        "activity_types": dict(activity_types),
+        "users_with_company": with_company,
+        "top_companies": [{"name": name, "count": count} for name, count in companies],
+        "users_with_goal": with_goal,
+        "recent_goals": goals
+    }
+
+
+def _attended_per_session():
+    return (
+        db.select(Attendance.session_id, db.func.count().label('attendances'))
+        .where(Attendance.attended.is_(True))
+        .group_by(Attendance.session_id)
+        .subquery()
+    )
+
+
+def trends():
+    """Registrations and attendance per session, oldest session first"""
+    attended = _attended_per_session()
+    sessions = db.session.execute(
+        db.select(Session.title, Session.date, Session.registration_count,
+                  db.func.coalesce(attended.c.attendances, 0))
+        .outerjoin(attended, attended.c.session_id == Session.id)
+        .order_by(Session.date)
+    ).all()
+    total_registrations = db.session.scalar(db.select(db.func.count()).select_from(Registration))
+    return {
+        "total_sessions": len(sessions),
+        "total_registrations": total_registrations,
+        "sessions_data": [{
+            "title": title,
+            "date": date.strftime("%Y-%m-%d"),
+            "registrations": registrations or 0,
+            "attendances": attendances
+        } for title, date, registrations, attendances in sessions]
+    }
+
+
+def insights():
+    """Attendance totals, repeat attendees and how many members attended how often"""
+    total_attendances, attendees, repeat_attendees, registered_never_attended = db.session.execute(db.select(
+        db.func.coalesce(db.func.sum(ParticipantSummary.attendances), 0),
+        db.func.count(db.case((ParticipantSummary.attendances > 0, 1))),
+        db.func.count(db.case((ParticipantSummary.attendances > 1, 1))),
+        db.func.count(db.case((db.and_(ParticipantSummary.registrations > 0,
+                                       ParticipantSummary.attendances == 0), 1)))
+    )).one()
+    patterns = db.session.execute(
+        db.select(ParticipantSummary.attendances, db.func.count())
+        .where(ParticipantSummary.attendances > 0)
+        .group_by(ParticipantSummary.attendances)
+        .order_by(ParticipantSummary.attendances)
+    ).all()
+    return {
+        "total_attendances": int(total_attendances),
+        "attendees": attendees,
+        "attendance_patterns": {str(times): members for times, members in patterns},
+        "repeat_attendees": repeat_attendees,
+        "registered_never_attended": registered_never_attended
+    }
+
+
+def _performance_row(row):
+    return {
+        "session_id": row.session_id,
+        "title": row.title,
+        "session_number": row.session_number,
+        "registrations": row.registrations,
+        "attendances": row.attendances,
+        "attendance_rate": float(row.attendance_rate),
+        "date": row.date.strftime("%Y-%m-%d")
+    }
+
+
+def session_performance(date_from=None, date_to=None, page=1, per_page=50):
+    """One page of approved registrations, attendances and attendance rate per session, best rate first,
+    with the session count, average rate and best session over all of them.
+
+    date_from and date_to bound Session.date; date_to is exclusive.
+    """
+    registered = (
+        db.select(Registration.session_id, db.func.count().label('registrations'))
+        .where(Registration.is_approved.is_(True))
+        .group_by(Registration.session_id)
+        .subquery()
+    )
+    attended = _attended_per_session()
+    registrations = db.func.coalesce(registered.c.registrations, 0)
+    attendances = db.func.coalesce(attended.c.attendances, 0)
+    rate = db.case((registrations > 0, attendances * 100.0 / registrations), else_=0.0)
+    query = (
+        db.select(Session.id.label('session_id'), Session.title, Session.session_number, Session.date,
+                  registrations.label('registrations'), attendances.label('attendances'),
+                  rate.label('attendance_rate'))
+        .outerjoin(registered, registered.c.session_id == Session.id)
+        .outerjoin(attended, attended.c.session_id == Session.id)
+    )
+    if date_from is not None:
+        query = query.where(Session.date >= date_from)
+    if date_to is not None:
+        query = query.where(Session.date < date_to)
+    performance = query.subquery()
+    best_first = (performance.c.attendance_rate.desc(), performance.c.date.desc(), performance.c.session_id)
+    ranked = db.select(
+        performance,
+        db.func.row_number().over(order_by=best_first).label('rank'),
+        db.func.count().over().label('total_sessions'),
+        db.func.avg(performance.c.attendance_rate).over().label('average_attendance_rate')
+    ).subquery()
+
+    # Window functions run before the WHERE of the outer select, so the totals cover every
+    # session; rank 1 (the best session) comes back alongside the requested page
+    first, last = (page - 1) * per_page + 1, page * per_page
+    rows = db.session.execute(
+        db.select(ranked)
+        .where(db.or_(ranked.c.rank == 1, ranked.c.rank.between(first, last)))
+        .order_by(ranked.c.rank)
+    ).all()
+    best = rows[0] if rows else None
+    return {
+        "sessions": [_performance_row(row) for row in rows if first <= row.rank <= last],
+        "total_sessions": best.total_sessions if best else 0,
+        "average_attendance_rate": float(best.average_attendance_rate) if best else 0,
+        "best_performing_session": _performance_row(best) if best else None
+    }
+
+
+METRICS = {
+    'demographics': demographics,
+    'trends': trends,
+    'insights': insights,
+}
+
+
+def metrics(analysis_type):
+    """The figures for one analysis type, or an error entry for unknown types"""
+    compute = METRICS.get(analysis_type)
+    if compute is None:
+        return {"error": f"Unknown analysis type: {analysis_type}"}
+    return compute()
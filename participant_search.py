@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Full-text search over members for the admin search box.
+
+Each member has a normalized document (ParticipantSearch, see
+arabic_text.py) built from their name, company, position, activity type,
+goal and AI description. On SQLite it is indexed by an FTS5 table ranked
+with BM25, on PostgreSQL by a tsvector expression index ranked with
+ts_rank; without either, a LIKE scan is the fallback. Query terms are
+matched as prefixes and OR-ed, so members matching more terms rank first.
+Only the top candidates go on to the model for re-ranking.
+
+Usage:
+    python migrations.py rebuild-search    # rewrite every member's document
+"""
+
+import logging
+import os
+
+from app import db
+from models import ParticipantSearch, ParticipantSummary, User
+import arabic_text
+
+logger = logging.getLogger(__name__)
+
+SEARCH_CANDIDATES = int(os.environ.get('SEARCH_CANDIDATES', 30))
+REBUILD_BATCH_SIZE = 1000
+# Long free-text fields are cut before they reach the prompt
+TEXT_LIMIT = 300
+
+_backends = {}  # engine url -> fts5, tsvector or like
+
+
+def _backend():
+    engine = db.engine
+    key = str(engine.url)
+    if key not in _backends:
+        if engine.dialect.name == 'postgresql':
+            _backends[key] = 'tsvector'
+        else:
+            has_fts = db.session.execute(db.text(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'participant_fts'"
+            )).first()
+            _backends[key] = 'fts5' if has_fts else 'like'
+    return _backends[key]
+
+
+def rebuild(connection):
+    """Rewrite every member's search document from the users table"""
+    connection.execute(db.delete(ParticipantSearch))
+    columns = [getattr(User, field) for field in ParticipantSearch.FIELDS]
+    last_id = 0
+    while True:
+        rows = connection.execute(
+            db.select(User.id, *columns).where(User.id > last_id).order_by(User.id).limit(REBUILD_BATCH_SIZE)
+        ).mappings().all()
+        if not rows:
+            break
+        ParticipantSearch.store({row['id']: ParticipantSearch.document_for(row) for row in rows},
+                                connection=connection)
+        last_id = rows[-1]['id']
+
+
+def _ranked_ids(terms, limit):
+    backend = _backend()
+    if backend == 'fts5':
+        # Terms are word characters only, so quoting them is enough
+        match = ' OR '.join(f'"{term}"*' for term in terms)
+        return db.session.scalars(db.text(
+            'SELECT rowid FROM participant_fts WHERE participant_fts MATCH :match '
+            'ORDER BY bm25(participant_fts) LIMIT :limit'
+        ), {'match': match, 'limit': limit}).all()
+    if backend == 'tsvector':
+        query = ' | '.join(f'{term}:*' for term in terms)
+        return db.session.scalars(db.text(
+            "SELECT user_id FROM participant_search "
+            "WHERE to_tsvector('simple', document) @@ to_tsquery('simple', :query) "
+            "ORDER BY ts_rank(to_tsvector('simple', document), to_tsquery('simple', :query)) DESC, user_id "
+            "LIMIT :limit"
+        ), {'query': query, 'limit': limit}).all()
+    return db.session.scalars(
+        db.select(ParticipantSearch.user_id)
+        .where(db.or_(*(ParticipantSearch.document.contains(term, autoescape=True) for term in terms)))
+        .order_by(ParticipantSearch.user_id)
+        .limit(limit)
+    ).all()
+
+
+def _clip(text):
+    text = text or ''
+    return text if len(text) <= TEXT_LIMIT else text[:TEXT_LIMIT] + '…'
+
+
+def candidates(query, limit=SEARCH_CANDIDATES):
+    """The best text matches for query, best first, as dicts ready for the prompt"""
+    terms = arabic_text.terms(query)
+    if not terms:
+        return []
+    ids = _ranked_ids(terms, limit)
+    if not ids:
+        return []
+    rows = db.session.execute(
+        db.select(User, db.func.coalesce(ParticipantSummary.attendances, 0))
+        .outerjoin(ParticipantSummary, ParticipantSummary.user_id == User.id)
+        .where(User.id.in_(ids))
+    ).all()
+    by_id = {user.id: (user, attendances) for user, attendances in rows}
+    return [{
+        "id": user.id,
+        "name": user.name,
+        "company": user.company_name or "",
+        "position": user.position or "",
+        "activity": user.activity_type or "",
+        "goal": _clip(user.goal),
+        "description": _clip(user.ai_description),
+        "attendance_count": attendances
+    } for user, attendances in (by_id[user_id] for user_id in ids if user_id in by_id)]
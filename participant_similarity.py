@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+"Similar members" index for the admin API.
+
+Each member's goal, activity type and AI description are normalized
+(arabic_text.normalize) and weighted as character 3- and 4-gram TF-IDF,
+which copes with Arabic prefixes, suffixes and spelling slips without a
+stemmer. The n-grams are hashed into HASH_BUCKETS buckets for their
+document frequencies and the buckets onto SIMILARITY_DIMENSIONS signed
+dimensions, so every member is one short dense vector and inner products
+are preserved on average. Vectors are stored L2-normalized in float32
+files that every worker memory-maps, so a top-k query is one
+matrix-vector product over shared pages.
+
+Files in SIMILARITY_INDEX_DIR (default instance/similarity):
+    state.i64            generation, capacity, rows, changes since the last build
+    vectors-<gen>.f32    one vector per row
+    users-<gen>.i64      member id of each row (0 once deleted)
+    idf-<gen>.f32        n-gram bucket weights fitted by the last build
+    lock, switch         writer lock, and the lock a generation switch is published under
+
+The previous generation's files are kept until the next switch, for
+readers still moving off it.
+
+Profile changes are written into the shared files by a background thread
+after each commit, weighted with the last build's IDF. The index is
+rebuilt from the users table once REFIT_RATIO of its rows changed since.
+When it does not exist yet, the first query queues a build on the same
+background thread and the API answers 503 until the build is done.
+
+Usage:
+    python participant_similarity.py --rebuild    # rebuild from the users table
+"""
+
+import argparse
+import fcntl
+import glob
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session as OrmSession
+
+from app import app, db
+from models import User
+import arabic_text
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR') or os.path.join(app.instance_path, 'similarity')
+DIMENSIONS = int(os.environ.get('SIMILARITY_DIMENSIONS', 256))  # Power of two
+HASH_BUCKETS = 1 << 20
+NGRAM_SIZES = (3, 4)
+REFIT_RATIO = 0.2
+BUILD_CHUNK = 10000  # Members vectorized at a time
+MIN_CAPACITY = 1024
+FIELDS = ('goal', 'activity_type', 'ai_description')
+
+# state.i64 slots
+_GENERATION, _CAPACITY, _ROWS, _CHANGES = range(4)
+
+_lock = threading.RLock()  # Guards _view; updates hold it while they append rows
+_view = None  # _View of the current generation in this process
+# One writer thread per process; the file lock serializes writers across processes
+_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='similarity')
+_building = False  # A first build is queued on _writer in this process
+
+
+def profile_text(values):
+    """Indexed text of a mapping (or row or User) of the profile fields"""
+    get = values.get if isinstance(values, dict) else lambda field: getattr(values, field)
+    return arabic_text.normalize(' '.join(get(field) or '' for field in FIELDS))
+
+
+def _grams(texts):
+    """(text index, bucket, count) of every distinct character n-gram of texts"""
+    # Texts are space-padded so word starts and ends are n-grams of their own, and \0-separated
+    joined = ''.join(f' {text} \0' for text in texts)
+    codes = np.frombuffer(joined.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    lengths = np.fromiter((len(text) + 3 for text in texts), dtype=np.int64, count=len(texts))
+    owner = np.repeat(np.arange(len(texts), dtype=np.int64), lengths)
+    separators = np.concatenate(([0], np.cumsum(codes == 0)))
+    keys = []
+    for size in NGRAM_SIZES:
+        count = len(codes) - size + 1
+        if count <= 0:
+            continue
+        hashed = np.full(count, size, dtype=np.uint64)
+        for offset in range(size):
+            hashed = hashed * np.uint64(1000003) + codes[offset:offset + count]
+        # splitmix64 finalizer spreads similar n-grams over the buckets
+        hashed ^= hashed >> np.uint64(30)
+        hashed *= np.uint64(0xBF58476D1CE4E5B9)
+        hashed ^= hashed >> np.uint64(27)
+        buckets = (hashed % np.uint64(HASH_BUCKETS)).astype(np.int64)
+        inside = separators[size:size + count] == separators[:count]
+        keys.append(owner[:count][inside] * HASH_BUCKETS + buckets[inside])
+    if not keys:
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty
+    keys, counts = np.unique(np.concatenate(keys), return_counts=True)
+    return keys // HASH_BUCKETS, keys % HASH_BUCKETS, counts
+
+
+def _vectors(texts, idf):
+    """L2-normalized float32 vectors of texts (all zeros for a text without n-grams)"""
+    rows, buckets, counts = _grams(texts)
+    # Buckets map to a dimension by their low bits and to a sign by the next one
+    signs = 1 - 2 * ((buckets // DIMENSIONS) & 1)
+    weights = (1 + np.log(counts)) * idf[buckets] * signs
+    matrix = np.bincount(rows * DIMENSIONS + buckets % DIMENSIONS, weights=weights,
+                         minlength=len(texts) * DIMENSIONS).reshape(len(texts), DIMENSIONS)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    np.divide(matrix, norms, out=matrix, where=norms > 0)
+    return matrix.astype(np.float32)
+
+
+def _path(name, generation=None):
+    suffix = '' if generation is None else f'-{generation}'
+    stem, extension = os.path.splitext(name)
+    return os.path.join(INDEX_DIR, f'{stem}{suffix}{extension}')
+
+
+class _FileLock:
+    """Lock shared by every process using the index.
+
+    'lock' (exclusive) serializes writers. 'switch' is held only while a
+    generation is published: exclusively by the writer, shared by readers
+    opening or refreshing their view, so they never see half of a switch.
+    """
+
+    def __init__(self, name='lock', shared=False):
+        self._name = name
+        self._mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+
+    def __enter__(self):
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        # A fresh open file per use: flock locks of one open file are shared by all its threads
+        self._file = open(_path(self._name), 'a')
+        fcntl.flock(self._file, self._mode)
+        return self
+
+    def __exit__(self, *exc):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+
+
+class _View:
+    """This process' mapping of one generation of the index files"""
+
+    def __init__(self, state):
+        self.state = state
+        self.generation = int(state[_GENERATION])
+        capacity = int(state[_CAPACITY])
+        self.vectors = np.memmap(_path('vectors.f32', self.generation), dtype=np.float32, mode='r+',
+                                 shape=(capacity, DIMENSIONS))
+        self.users = np.memmap(_path('users.i64', self.generation), dtype=np.int64, mode='r+',
+                               shape=(capacity,))
+        self.idf = np.memmap(_path('idf.f32', self.generation), dtype=np.float32, mode='r',
+                             shape=(HASH_BUCKETS,))
+        self.rows = 0
+        self.row_of = {}
+        self.refresh()
+
+    def refresh(self):
+        """Pick up rows other processes appended"""
+        rows = int(self.state[_ROWS])
+        if rows > self.rows:
+            self.row_of.update(zip(self.users[self.rows:rows].tolist(), range(self.rows, rows)))
+            self.rows = rows
+
+
+def _state(create=False):
+    path = _path('state.i64')
+    if not os.path.exists(path):
+        if not create:
+            return None
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        np.zeros(4, dtype=np.int64).tofile(tmp_path)
+        os.replace(tmp_path, path)
+    return np.memmap(path, dtype=np.int64, mode='r+', shape=(4,))
+
+
+def _current():
+    """The up-to-date view of the index, or None when it was never built"""
+    global _view
+    with _lock, _FileLock('switch', shared=True):
+        if _view is None:
+            state = _state()
+            if state is None or state[_GENERATION] == 0:
+                return None
+            _view = _View(state)
+        elif _view.state[_GENERATION] != _view.generation:
+            _view = _View(_view.state)
+        else:
+            _view.refresh()
+        return _view
+
+
+def _write_generation(state, generation, vectors, users, idf, capacity):
+    """Write a complete generation's files and switch state to it"""
+    rows = len(users)
+    stored = np.memmap(_path('vectors.f32', generation), dtype=np.float32, mode='w+', shape=(capacity, DIMENSIONS))
+    stored[:rows] = vectors
+    stored.flush()
+    ids = np.memmap(_path('users.i64', generation), dtype=np.int64, mode='w+', shape=(capacity,))
+    ids[:rows] = users
+    ids.flush()
+    idf.astype(np.float32).tofile(_path('idf.f32', generation))
+    with _FileLock('switch'):
+        state[_CAPACITY] = capacity
+        state[_ROWS] = rows
+        state[_GENERATION] = generation
+        state.flush()
+    # Keep the previous generation for readers still switching from it; older ones go
+    for old in glob.glob(os.path.join(INDEX_DIR, '*-*.*')):
+        old_generation = os.path.splitext(old)[0].rsplit('-', 1)[1]
+        if old_generation.isdigit() and int(old_generation) < generation - 1:
+            os.unlink(old)
+
+
+def _capacity(rows):
+    """Rows to allocate: room for half as many again before the files are copied"""
+    return rows + rows // 2 + MIN_CAPACITY
+
+
+def rebuild():
+    """Refit the IDF and rewrite every member's vector from the users table"""
+    with _FileLock():
+        state = _state(create=True)
+        profiles = db.session.execute(
+            db.select(User.id, *(getattr(User, field) for field in FIELDS)).order_by(User.id)
+        ).mappings().all()
+        users = np.fromiter((row['id'] for row in profiles), dtype=np.int64, count=len(profiles))
+        texts = [profile_text(row) for row in profiles]
+
+        frequencies = np.zeros(HASH_BUCKETS, dtype=np.int64)
+        for start in range(0, len(texts), BUILD_CHUNK):
+            _, buckets, _ = _grams(texts[start:start + BUILD_CHUNK])
+            frequencies += np.bincount(buckets, minlength=HASH_BUCKETS)
+        idf = np.log((1 + len(texts)) / (1 + frequencies)) + 1
+
+        vectors = np.zeros((len(texts), DIMENSIONS), dtype=np.float32)
+        for start in range(0, len(texts), BUILD_CHUNK):
+            vectors[start:start + BUILD_CHUNK] = _vectors(texts[start:start + BUILD_CHUNK], idf)
+
+        state[_CHANGES] = 0
+        _write_generation(state, int(state[_GENERATION]) + 1, vectors, users, idf, _capacity(len(users)))
+    logger.info("Similarity index rebuilt: %s members", len(users))
+    return len(users)
+
+
+def update(profiles):
+    """Write changed profiles (user id -> text, or None when deleted) into the index"""
+    if not os.path.exists(_path('state.i64')):
+        return  # Never built; the first query builds it from the users table
+    with _FileLock(), _lock:
+        view = _current()
+        if view is None:
+            return
+        deleted = [user_id for user_id, text in profiles.items() if text is None]
+        changed = {user_id: text for user_id, text in profiles.items() if text is not None}
+        for user_id in deleted:
+            row = view.row_of.get(user_id)
+            if row is not None:
+                view.vectors[row] = 0
+                view.users[row] = 0
+        if changed:
+            vectors = _vectors(list(changed.values()), view.idf)
+            new = [user_id for user_id in changed if user_id not in view.row_of]
+            if view.rows + len(new) > len(view.users):
+                # Out of room: copy into a bigger generation
+                rows = view.rows
+                _write_generation(view.state, view.generation + 1, view.vectors[:rows], view.users[:rows],
+                                  np.asarray(view.idf), _capacity(rows + len(new)))
+                view = _current()
+            for user_id, vector in zip(changed, vectors):
+                row = view.row_of.get(user_id)
+                if row is None:
+                    row = view.rows
+                    view.users[row] = user_id
+                    view.rows += 1
+                    view.row_of[user_id] = row
+                view.vectors[row] = vector
+            # Readers only look at rows below the count, so publish it after the rows are written
+            view.state[_ROWS] = view.rows
+        view.state[_CHANGES] += len(profiles)
+        refit = view.state[_CHANGES] > REFIT_RATIO * max(view.rows, MIN_CAPACITY)
+    if refit:
+        rebuild()
+
+
+def _top(view, vector, limit, skip_row=None):
+    rows = view.rows
+    if rows == 0 or not vector.any():
+        return []
+    scores = view.vectors[:rows] @ vector
+    if skip_row is not None:
+        scores[skip_row] = -1
+    limit = min(limit, rows)
+    best = np.argpartition(-scores, limit - 1)[:limit]
+    best = best[np.argsort(-scores[best])]
+    return [(int(view.users[row]), float(scores[row])) for row in best
+            if scores[row] > 0 and view.users[row] != 0]
+
+
+def _first_build():
+    global _building
+    try:
+        if _current() is None:  # Another process may have built it meanwhile
+            logger.info("Building the similarity index on first use")
+            rebuild()
+    finally:
+        with _lock:
+            _building = False
+
+
+def ready():
+    """True once the index exists; otherwise queue its first build and return False"""
+    global _building
+    if _current() is not None:
+        return True
+    with _lock:
+        if not _building:
+            _building = True
+            _writer.submit(_run, _first_build)
+    return False
+
+
+def similar_to_user(user_id, limit):
+    """[(user id, cosine similarity)] of the members most like user_id, best first; None if not indexed"""
+    view = _current()
+    row = view.row_of.get(user_id)
+    if row is None or view.users[row] == 0:
+        return None
+    return _top(view, np.array(view.vectors[row]), limit, skip_row=row)
+
+
+def similar_to_text(text, limit):
+    """[(user id, cosine similarity)] of the members whose profiles are most like text, best first"""
+    view = _current()
+    return _top(view, _vectors([arabic_text.normalize(text)], view.idf)[0], limit)
+
+
+def _run(work, *args):
+    with app.app_context():
+        try:
+            work(*args)
+        except Exception as e:
+            logger.error("Similarity index update failed: %s", e)
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _collect_profiles(session, flush_context):
+    profiles = session.info.setdefault('similarity_profiles', {})
+    new, deleted = session.new, session.deleted
+    for obj in deleted:
+        if isinstance(obj, User):
+            profiles[obj.id] = None
+    for obj in list(new) + list(session.dirty):
+        if not isinstance(obj, User) or obj in deleted:
+            continue
+        state = db.inspect(obj)
+        if obj in new or any(state.attrs[field].history.has_changes() for field in FIELDS):
+            profiles[obj.id] = profile_text(obj)
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _apply_profiles(session):
+    profiles = session.info.pop('similarity_profiles', None)
+    if profiles:
+        _writer.submit(_run, update, profiles)
+
+
+@event.listens_for(OrmSession, 'after_soft_rollback')
+def _discard_profiles(session, previous_transaction):
+    session.info.pop('similarity_profiles', None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the member similarity index")
+    parser.add_argument('--rebuild', action='store_true', required=True,
+                        help="Rebuild the index from the users table")
+    parser.parse_args()
+    with app.app_context():
+        print(f"Indexed {rebuild()} members in {INDEX_DIR}")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background job that writes AI profile descriptions for users.
+
+Sign-up stores users with ai_description = NULL (pending) when they gave a
+goal; this job fills those in batches, calling OpenAI on a capped thread
+pool and retrying transient failures with exponential backoff.
+
+Usage:
+    python profile_enrichment.py                # keep filling pending descriptions
+    python profile_enrichment.py --once         # fill what is pending and exit
+    python profile_enrichment.py --backfill     # also users whose description is empty
+    python profile_enrichment.py --regenerate   # rewrite every user's description
+    python profile_enrichment.py --regenerate --user-id 12 --user-id 15
+"""
+
+import argparse
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app import app, db
+from models import User
+from ai_service import request_professional_description
+
+logger = logging.getLogger(__name__)
+
+MAX_ATTEMPTS = 3
+RETRY_BASE_DELAY = 2  # Seconds, doubled on each retry
+
+
+def _describe(profile):
+    """Generate one description with retries, returning (description, error)"""
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            return request_professional_description(profile['goal'], profile['activity_type'] or ""), None
+        except Exception as e:
+            error = str(e)
+            if attempt + 1 < MAX_ATTEMPTS:
+                time.sleep(RETRY_BASE_DELAY * 2 ** attempt + random.uniform(0, 1))
+    return None, error
+
+
+def select_users(mode, user_ids=None):
+    """Build the query of users to describe for the given mode"""
+    query = User.query.filter(User.goal.isnot(None), User.goal != '')
+    if mode == 'pending':
+        query = query.filter(User.ai_description.is_(None))
+    elif mode == 'backfill':
+        query = query.filter(db.or_(User.ai_description.is_(None), User.ai_description == ''))
+    if user_ids:
+        query = query.filter(User.id.in_(user_ids))
+    return query
+
+
+def enrich(executor, mode='pending', user_ids=None, batch_size=20):
+    """Describe every matching user, one batch at a time. Returns (updated, failed)."""
+    updated = failed = 0
+    last_id = 0
+    while True:
+        # Keyset pagination so regenerate mode never revisits a user
+        users = select_users(mode, user_ids).filter(User.id > last_id).order_by(User.id).limit(batch_size).all()
+        if not users:
+            return updated, failed
+        last_id = users[-1].id
+
+        # Threads only talk to OpenAI; all database writes stay on this thread
+        profiles = [{'goal': u.goal, 'activity_type': u.activity_type} for u in users]
+        for user, (description, error) in zip(users, executor.map(_describe, profiles)):
+            if error is None:
+                user.ai_description = description
+                updated += 1
+            else:
+                logger.error("Description for user %s failed after %s attempts: %s", user.id, MAX_ATTEMPTS, error)
+                failed += 1
+                # Pending users stop being picked up; --backfill retries them later
+                if user.ai_description is None:
+                    user.ai_description = ""
+
+        db.session.commit()
+        logger.info("Enrichment batch done: %s updated, %s failed so far", updated, failed)
+
+
+def run(concurrency, batch_size, poll_interval, mode='pending', user_ids=None, once=False):
+    """Fill descriptions, polling for new pending users unless once is set"""
+    with app.app_context(), ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            updated, failed = enrich(executor, mode, user_ids, batch_size)
+            if once:
+                print(f"Descriptions updated: {updated}, failed: {failed}")
+                return
+            db.session.remove()
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate AI profile descriptions for users")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--backfill', action='store_true',
+                       help="Also describe users whose description is empty (runs once)")
+    group.add_argument('--regenerate', action='store_true',
+                       help="Rewrite descriptions for all users with a goal (runs once)")
+    parser.add_argument('--user-id', type=int, action='append', dest='user_ids',
+                        help="Limit to these user ids (repeatable)")
+    parser.add_argument('--concurrency', type=int,
+                        default=int(os.environ.get('AI_ENRICHMENT_CONCURRENCY', 3)),
+                        help="Parallel OpenAI requests (AI_ENRICHMENT_CONCURRENCY)")
+    parser.add_argument('--batch-size', type=int,
+                        default=int(os.environ.get('AI_ENRICHMENT_BATCH_SIZE', 20)),
+                        help="Users described per commit (AI_ENRICHMENT_BATCH_SIZE)")
+    parser.add_argument('--poll-interval', type=float,
+                        default=float(os.environ.get('AI_ENRICHMENT_POLL_INTERVAL', 10)),
+                        help="Seconds between scans for pending users (AI_ENRICHMENT_POLL_INTERVAL)")
+    parser.add_argument('--once', action='store_true', help="Exit after one pass")
+    args = parser.parse_args()
+
+    mode = 'regenerate' if args.regenerate else 'backfill' if args.backfill else 'pending'
+    run(args.concurrency, args.batch_size, args.poll_interval, mode=mode, user_ids=args.user_ids,
+        once=args.once or mode != 'pending')
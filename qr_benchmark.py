@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmark for utils.generate_qr_code.
+
+Times cold renders (empty memory and disk cache), warm-disk hits (a fresh
+worker after a restart) and warm-memory hits for each output mode, and
+prints the data URI size of each mode.
+
+Usage:
+    python qr_benchmark.py
+    python qr_benchmark.py --payloads 500
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+# Nothing here touches the database; keep app start-up off the real one
+os.environ.setdefault('DATABASE_URL', 'sqlite://')
+
+import app  # noqa: F401  (utils imports models, which need the app initialised first)
+import utils
+
+
+def _time_per_call(payloads, **options):
+    started = time.perf_counter()
+    for payload in payloads:
+        utils.generate_qr_code(payload, **options)
+    return (time.perf_counter() - started) / len(payloads) * 1e6
+
+
+def run(count):
+    payloads = [f"reg:{i},session:{i % 50 + 1}" for i in range(1, count + 1)]
+    modes = [
+        ('png', {}),
+        ('png compact', {'compact': True}),
+        ('svg', {'fmt': 'svg'}),
+    ]
+
+    cache_dir = tempfile.mkdtemp(prefix='qr-benchmark-')
+    original_dir = utils.QR_CACHE_DIR
+    utils.QR_CACHE_DIR = cache_dir
+    try:
+        print(f"{count} payloads, microseconds per call\n")
+        print(f"{'mode':<14}{'cold':>10}{'warm disk':>12}{'warm memory':>14}{'data URI bytes':>17}")
+        for label, options in modes:
+            utils._qr_data_uri.cache_clear()
+            cold = _time_per_call(payloads, **options)
+
+            utils._qr_data_uri.cache_clear()
+            warm_disk = _time_per_call(payloads, **options)
+            warm_memory = _time_per_call(payloads, **options)
+
+            size = len(utils.generate_qr_code(payloads[0], **options))
+            print(f"{label:<14}{cold:>10.1f}{warm_disk:>12.1f}{warm_memory:>14.2f}{size:>17}")
+    finally:
+        utils.QR_CACHE_DIR = original_dir
+        utils._qr_data_uri.cache_clear()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark QR code generation and caching")
+    parser.add_argument('--payloads', type=int, default=200, help="Distinct payloads to render")
+    args = parser.parse_args()
+    run(args.payloads)
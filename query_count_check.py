@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query-count check for the listing pages.
+
+Renders each page in EXPECTED_QUERIES against a scratch database holding 5 sessions,
+then again with 50, and checks that both renders ran the expected number of
+SQL statements: a page whose count grows with the number of sessions has an
+N+1 loop. Statements are counted by instrumentation.py (the figure it sends
+in the Server-Timing header); the response cache is switched off so every
+request renders.
+
+Exits non-zero on any mismatch. After an intended change to a page's
+queries, update EXPECTED_QUERIES.
+
+Usage:
+    python query_count_check.py
+"""
+
+import logging
+import os
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+# page -> statements per render, including the admin session lookup on admin pages
+EXPECTED_QUERIES = {
+    '/': 3,
+    '/sessions': 2,
+    '/admin/sessions': 2,
+    '/admin': 6,
+}
+SESSION_COUNTS = (5, 50)
+REGISTRATIONS_PER_SESSION = 3
+
+
+def _add_sessions(db, Session, User, Registration, Attendance, count, offset):
+    """count sessions around today, each with approved, pending and attended registrations"""
+    for i in range(count):
+        number = offset + i
+        session_obj = Session(session_number=number + 1, title=f"Session {number}",
+                              date=datetime.utcnow() + timedelta(days=number - count // 2),
+                              max_participants=50, registration_count=REGISTRATIONS_PER_SESSION - 1)
+        db.session.add(session_obj)
+        db.session.flush()
+        for j in range(REGISTRATIONS_PER_SESSION):
+            user = User(name=f"Member {number}-{j}", username=f"member{number}x{j}",
+                        email=f"member{number}x{j}@example.com", phone=f"05{number:04d}{j:04d}")
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Registration(session_id=session_obj.id, user_id=user.id, is_approved=j > 0))
+            if j == 1:
+                db.session.add(Attendance(session_id=session_obj.id, user_id=user.id, attended=True))
+    db.session.commit()
+
+
+def _queries(response):
+    match = re.search(r'desc="(\d+) queries"', response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def run():
+    from app import app, db
+    from models import Attendance, Registration, Session, User
+
+    client = app.test_client()
+    client.post('/admin/login', data={'username': 'admin', 'password': 'admin123'})
+
+    counts = {}
+    added = 0
+    for total in SESSION_COUNTS:
+        with app.app_context():
+            _add_sessions(db, Session, User, Registration, Attendance, total - added, added)
+        added = total
+        for page in EXPECTED_QUERIES:
+            response = client.get(page)
+            counts[page, total] = (response.status_code, _queries(response))
+
+    passed = True
+    print(f"{'page':<20}" + ''.join(f"{f'{total} sessions':>14}" for total in SESSION_COUNTS) + f"{'expected':>10}")
+    for page, expected in EXPECTED_QUERIES.items():
+        row = [counts[page, total] for total in SESSION_COUNTS]
+        ok = all(status == 200 and queries == expected for status, queries in row)
+        passed = passed and ok
+        cells = ''.join(f"{queries if status == 200 else f'HTTP {status}'!s:>14}" for status, queries in row)
+        print(f"{page:<20}{cells}{expected:>10}  {'ok' if ok else 'FAIL'}")
+    return passed
+
+
+if __name__ == '__main__':
+    scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+    os.environ['DATABASE_URL'] = f"sqlite:///{scratch.name}"
+    os.environ['PERF_INSTRUMENTATION'] = '1'
+    os.environ['RESPONSE_CACHE_TTL'] = '0'
+    logging.disable(logging.WARNING)
+    try:
+        passed = run()
+    finally:
+        os.unlink(scratch.name)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Stress check for overbooking under concurrent registrations.
+
+Many threads register guests, each bringing one companion (two seats), for
+the same small session at once, then the script checks that neither the
+seat counter (Session.registration_count) nor the approved registration
+rows exceed max_participants, and that the counter matches the rows.
+Exits non-zero if any check fails.
+
+Runs on a scratch SQLite file by default; pass --database-url to point it at
+a scratch PostgreSQL database (it adds a session and its registrations).
+
+Usage:
+    python registration_stress.py
+    python registration_stress.py --threads 500 --capacity 50 --database-url postgresql://localhost/eventpilot_stress
+"""
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+
+
+def run(threads, capacity):
+    from app import app, db
+    from models import Registration, Session
+
+    stamp = int(time.time() * 1000)
+    with app.app_context():
+        session_obj = Session(session_number=stamp % 100000, title="Registration stress",
+                              date=datetime.utcnow() + timedelta(days=7), max_participants=capacity)
+        db.session.add(session_obj)
+        db.session.commit()
+        session_id = session_obj.id
+
+    outcomes = Counter()
+    lock = threading.Lock()
+    start = threading.Barrier(threads)
+
+    def register(number):
+        client = app.test_client()
+        form = {
+            'name': f"Guest {number}",
+            'email': f"guest{stamp}-{number}@example.com",
+            'phone': f"05{(stamp + number) % 10 ** 8:08d}",
+            'companion_count': '1',
+            'companion_name_0': f"Companion {number}",
+            'companion_email_0': f"companion{stamp}-{number}@example.com",
+        }
+        start.wait()
+        try:
+            outcome = client.post(f'/session/{session_id}/guest-register', data=form).status_code
+        except Exception as e:
+            outcome = type(e).__name__
+        with lock:
+            outcomes[outcome] += 1
+
+    workers = [threading.Thread(target=register, args=(n,)) for n in range(threads)]
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        counter = db.session.get(Session, session_id).registration_count
+        approved = Registration.query.filter_by(session_id=session_id, is_approved=True).count()
+
+    print(f"{threads} registrations of 2 seats for {capacity} seats in {elapsed:.2f}s")
+    for outcome, count in sorted(outcomes.items(), key=str):
+        print(f"  {outcome!s:<20}{count:>8}")
+    print(f"  seat counter {counter}, approved rows {approved}")
+
+    checks = [
+        ("no request failed", all(outcome in (200, 302) for outcome in outcomes)),
+        ("seat counter within capacity", counter <= capacity),
+        ("approved rows within capacity", approved <= capacity),
+        ("seat counter matches approved rows", counter == approved),
+        ("someone got in", approved > 0),
+    ]
+    for label, ok in checks:
+        print(f"{'ok' if ok else 'FAIL':<6}{label}")
+    return all(ok for _, ok in checks)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Register many guests for one session at once")
+    parser.add_argument('--threads', type=int, default=500, help="Concurrent registrations")
+    parser.add_argument('--capacity', type=int, default=50, help="Session max_participants")
+    parser.add_argument('--database-url', help="Scratch database (default: a temporary SQLite file)")
+    args = parser.parse_args()
+
+    scratch = None
+    if args.database_url:
+        os.environ['DATABASE_URL'] = args.database_url
+    else:
+        scratch = tempfile.NamedTemporaryFile(suffix='.db', delete=False)
+        os.environ['DATABASE_URL'] = f"sqlite:///{scratch.name}"
+    logging.disable(logging.WARNING)
+    try:
+        passed = run(args.threads, args.capacity)
+    finally:
+        if scratch:
+            os.unlink(scratch.name)
+    sys.exit(0 if passed else 1)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Versioned response cache for the public pages.
+
+A cached view supplies a version function returning the current data version
+of what it shows (Session.data_version, bumped by every write to a session or
+its registrations). The rendered body is kept in memory per worker and reused
+while the version is unchanged, so a hit costs one small version query instead
+of the listing queries and template render. Entries also expire after
+RESPONSE_CACHE_TTL seconds, since these pages depend on the clock too
+(upcoming sessions, registration deadlines).
+
+Personalized pages render the navbar user links and flash messages as
+placeholders; they are filled in for each request after the cache lookup.
+Every response carries a strong ETag over its final bytes and conditional GETs
+are answered with 304.
+"""
+
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from flask import g, make_response, render_template, request
+
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', 60))
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 256))
+
+# Emitted by base.html instead of the per-visitor fragments when g.cached_page is set
+USER_NAV_PLACEHOLDER = b'<!--cached-page:user-nav-->'
+FLASH_PLACEHOLDER = b'<!--cached-page:flash-messages-->'
+
+_entries = OrderedDict()  # (endpoint, view args, query string) -> _Entry
+_lock = threading.Lock()
+
+
+class _Entry:
+    __slots__ = ('version', 'expires', 'body', 'headers')
+
+    def __init__(self, version, expires, body, headers):
+        self.version = version
+        self.expires = expires
+        self.body = body
+        self.headers = headers
+
+
+def _get(key, version):
+    with _lock:
+        entry = _entries.get(key)
+        if entry is None or entry.version != version or entry.expires < time.monotonic():
+            return None
+        _entries.move_to_end(key)
+        return entry
+
+
+def _put(key, entry):
+    with _lock:
+        _entries[key] = entry
+        _entries.move_to_end(key)
+        while len(_entries) > RESPONSE_CACHE_SIZE:
+            _entries.popitem(last=False)
+
+
+def clear():
+    with _lock:
+        _entries.clear()
+
+
+def _personalize(body):
+    """Fill in the navbar user links and flash messages for this visitor"""
+    body = body.replace(USER_NAV_PLACEHOLDER, render_template('_user_nav.html').encode('utf-8'), 1)
+    return body.replace(FLASH_PLACEHOLDER, render_template('_flash_messages.html').encode('utf-8'), 1)
+
+
+def cached(version, personalized=False):
+    """Cache a view's 200 responses keyed on version(**view_args).
+
+    version returns a hashable data version, or None to bypass the cache
+    (e.g. the object does not exist and the view should 404 as usual).
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(**kwargs):
+            data_version = version(**kwargs) if RESPONSE_CACHE_TTL > 0 else None
+            if data_version is None:
+                return _conditional(make_response(view(**kwargs)))
+
+            key = (request.endpoint, tuple(sorted(kwargs.items())), request.query_string)
+            entry = _get(key, data_version)
+            if entry is None:
+                g.cached_page = personalized
+                response = make_response(view(**kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                headers = [(name, value) for name, value in response.headers.items()
+                           if name.lower() not in ('content-length', 'set-cookie', 'etag')]
+                entry = _Entry(data_version, time.monotonic() + RESPONSE_CACHE_TTL,
+                               response.get_data(), headers)
+                _put(key, entry)
+
+            body = _personalize(entry.body) if personalized else entry.body
+            response = make_response(body)
+            response.headers.clear()
+            response.headers.extend(entry.headers)
+            if personalized:
+                response.vary.add('Cookie')
+            return _conditional(response)
+        return wrapper
+    return decorator
+
+
+def _conditional(response):
+    """Strong ETag over the final body; a matching If-None-Match becomes a 304"""
+    if response.status_code == 200 and not response.is_streamed:
+        response.set_etag(hashlib.sha256(response.get_data()).hexdigest()[:32])
+        response.headers.setdefault('Cache-Control', 'no-cache')
+        response = response.make_conditional(request)
+    return response
@@ -1,23 +1,60 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, make_response, session as flask_session
+from flask import render_template, request, redirect, url_for, flash, jsonify, make_response, Response, stream_with_context, session as flask_session
 from flask_login import login_user, logout_user, login_required, current_user
 from app import app, db
-from models import User, Session, Registration, Attendance, Admin, Companion, Invite
+from models import User, Session, Registration, Attendance, Admin, Companion, Invite, RefreshToken, BackgroundJob, EmailOutbox, EmailDeadLetter
 from sqlalchemy import func
-from ai_service import generate_professional_description, analyze_participant_data, search_participants
+from sqlalchemy.orm import contains_eager
+from ai_service import search_participants
+import instrumentation
+import response_cache
+import background_jobs
+import bulk_approval
+import bulk_invites
+import whatsapp_export
+import checkin_sync
+import analytics_cache
+import participant_analytics
+import participant_similarity
+from tickets import make_ticket, verify_ticket, session_key as ticket_session_key, KIND_COMPANION, ACCEPT_LEGACY as TICKET_ACCEPT_LEGACY
 from utils import (
     generate_username, send_confirmation_email, generate_qr_code, export_to_csv,
-    send_registration_pending_email, send_registration_confirmed_email, send_companion_registered_email,
-    generate_invite_token, send_invitation_email, format_phone_number
+    send_registration_pending_email, send_registration_confirmed_email, send_companion_registered_email
 )
 from werkzeug.security import check_password_hash, generate_password_hash
 from datetime import datetime, timedelta
 import json
+import base64
 import csv
 import io
+import os
 import re
 import secrets
 
 
+REFRESH_TOKEN_LIFETIME = timedelta(days=30)
+REFRESH_TOKEN_EXTEND_INTERVAL = timedelta(days=1)  # Slide the expiry at most once a day
+
+# Embed shell: long-lived in browsers and proxies; live seat counts come from the seats endpoint
+EMBED_CACHE_CONTROL = 'public, max-age={}, stale-while-revalidate={}'.format(
+    int(os.environ.get('EMBED_CACHE_MAX_AGE', 3600)),
+    int(os.environ.get('EMBED_STALE_WHILE_REVALIDATE', 86400))
+)
+SEATS_CACHE_CONTROL = 'public, max-age={}, stale-while-revalidate={}'.format(
+    int(os.environ.get('SEATS_CACHE_MAX_AGE', 10)),
+    int(os.environ.get('SEATS_STALE_WHILE_REVALIDATE', 30))
+)
+
+# Session columns the embed templates render; the shell is re-rendered only when one changes
+EMBED_SHELL_FIELDS = (
+    'id', 'slug', 'session_number', 'title', 'description', 'date', 'location',
+    'guest_name', 'guest_profile', 'show_guest_profile', 'show_countdown', 'enable_mini_view', 'embed_enabled'
+)
+
+SIMILAR_MAX_RESULTS = 50
+SESSION_PERFORMANCE_PAGE_SIZE = 50
+SESSION_PERFORMANCE_MAX_PAGE_SIZE = 200
+
+
 @app.before_request
 def check_refresh_token():
     """Auto-login user if valid refresh token cookie exists"""
@@ -34,44 +71,109 @@ def check_refresh_token():
     if not refresh_token:
         return
 
-    # Find user with this refresh token
-    user = User.query.filter_by(refresh_token=refresh_token).first()
-    if not user:
+    # Find the device token for this cookie (one lookup on the unique token_hash index)
+    record = RefreshToken.query.filter_by(token_hash=RefreshToken.hash_token(refresh_token)).first()
+    if not record:
         return
 
+    now = datetime.utcnow()
+
     # Check if token is expired
-    if user.refresh_token_expires and user.refresh_token_expires < datetime.utcnow():
-        # Token expired - clear it
-        user.refresh_token = None
-        user.refresh_token_expires = None
+    if record.expires_at < now:
+        # Token expired - delete it
+        db.session.delete(record)
         db.session.commit()
         return
 
     # Valid token - auto-login user
-    flask_session['user_id'] = user.id
+    flask_session['user_id'] = record.user_id
 
-    # Refresh the token (extend expiration)
-    user.refresh_token_expires = datetime.utcnow() + timedelta(days=30)
-    db.session.commit()
+    # Refresh the token (extend expiration), writing at most once per interval
+    if not record.last_extended_at or now - record.last_extended_at >= REFRESH_TOKEN_EXTEND_INTERVAL:
+        record.expires_at = now + REFRESH_TOKEN_LIFETIME
+        record.last_extended_at = now
+        db.session.commit()
 
 
-def create_companion_guest_registration(companion, session_obj, is_approved):
-    """Convert a companion to a guest registration"""
-    registration = Registration(
-        session_id=session_obj.id,
-        guest_name=companion.name,
-        guest_email=companion.email,
-        guest_phone=companion.phone,
-        guest_company_name=companion.company,
-        guest_position=companion.title,
-        is_approved=is_approved
-    )
-    db.session.add(registration)
-    db.session.commit()
-    return registration
-
+def add_companion_guest_registrations(companions, session_obj, is_approved, seats=0):
+    """Give each emailed companion a guest registration (flushed, caller commits).
+
+    A companion who already holds a guest registration for the session, such as
+    the pending one created at sign-up, reuses it rather than getting a second
+    one. When approving, the registrant's ``seats`` plus one per companion newly
+    taking a seat are reserved first. Returns None, changing nothing, if the
+    session is full; otherwise the (companion, registration) pairs.
+    """
+    emailed = [c for c in companions if c.email]
+    existing = {}
+    if emailed:
+        existing = {r.guest_email: r for r in Registration.query.filter(
+            Registration.session_id == session_obj.id,
+            Registration.guest_email.in_({c.email for c in emailed})
+        )}
+
+    if is_approved:
+        seats += len({c.email for c in emailed
+                      if c.email not in existing or not existing[c.email].is_approved})
+        if not session_obj.reserve_seats(seats):
+            return None
+
+    companion_registrations = []
+    for companion in emailed:
+        registration = existing.get(companion.email)
+        if registration is None:
+            registration = Registration(
+                session_id=session_obj.id,
+                guest_name=companion.name,
+                guest_email=companion.email,
+                guest_phone=companion.phone,
+                guest_company_name=companion.company,
+                guest_position=companion.title,
+                is_approved=is_approved
+            )
+            db.session.add(registration)
+            existing[companion.email] = registration
+        elif is_approved:
+            registration.is_approved = True
+        companion_registrations.append((companion, registration))
+
+    db.session.flush()
+    return companion_registrations
+
+
+def first_registration_per_session(registrations):
+    """Keep the first registration for each session, dropping the rest"""
+    seen_sessions = set()
+    kept = []
+    for registration in registrations:
+        if registration.session_id not in seen_sessions:
+            seen_sessions.add(registration.session_id)
+            kept.append(registration)
+    return kept
+
+
+def _listing_version():
+    return Session.listing_version()
+
+def _session_data_version(identifier):
+    """data_version of the session an identifier (slug or id) points at"""
+    query = db.session.query(Session.data_version)
+    row = query.filter(Session.slug == identifier).first()
+    if row is None and identifier.isdigit():
+        row = query.filter(Session.id == int(identifier)).first()
+    return row[0] if row else None
+
+def _embed_shell_version(identifier):
+    """The embed page only shows static session fields, so registrations never invalidate it"""
+    columns = [getattr(Session, field) for field in EMBED_SHELL_FIELDS]
+    query = db.session.query(*columns)
+    row = query.filter(Session.slug == identifier).first()
+    if row is None and identifier.isdigit():
+        row = query.filter(Session.id == int(identifier)).first()
+    return tuple(row) if row else None
 
 @app.route('/')
+@response_cache.cached(_listing_version, personalized=True)
 def index():
     # Get next session
     next_session = Session.query.filter(
@@ -80,9 +182,9 @@ def index():
     ).order_by(Session.date.asc()).first()
     
     # Get upcoming 3 sessions
-    upcoming_sessions = Session.query.filter(
+    upcoming_sessions = Session.with_counts(Session.query.filter(
         Session.date > datetime.utcnow()
-    ).order_by(Session.date.asc()).limit(3).all()
+    ).order_by(Session.date.asc()), limit=3)
     
     return render_template('index.html', 
                          next_session=next_session, 
@@ -153,14 +255,6 @@ def register():
             # Generate unique username
             username = generate_username(name)
 
-            # Generate AI description if goal is provided
-            ai_description = ""
-            if goal:
-                try:
-                    ai_description = generate_professional_description(goal, activity_type or "")
-                except Exception as e:
-                    app.logger.error(f"AI description generation failed: {e}")
-
             # Create new user
             user = User(
                 name=name,
@@ -175,7 +269,8 @@ def register():
                 activity_type=activity_type,
                 gender=gender,
                 goal=goal,
-                ai_description=ai_description
+                # NULL marks the description as pending for profile_enrichment.py
+                ai_description=None if goal else ""
             )
             user.set_password(password)
             db.session.add(user)
@@ -190,6 +285,9 @@ def register():
                 )
             ).all()
 
+            # A user can hold only one registration per session
+            guest_registrations = first_registration_per_session(guest_registrations)
+
             for reg in guest_registrations:
                 reg.user_id = user.id
                 # Clear guest fields since now linked to user
@@ -315,12 +413,6 @@ def guest_session_register(session_id):
         if create_account:
             # Create user account
             username = generate_username(name)
-            ai_description = ""
-            if goal:
-                try:
-                    ai_description = generate_professional_description(goal, activity_type or "")
-                except Exception as e:
-                    app.logger.error(f"AI description generation failed: {e}")
 
             user = User(
                 name=name,
@@ -335,7 +427,8 @@ def guest_session_register(session_id):
                 activity_type=activity_type,
                 gender=gender,
                 goal=goal,
-                ai_description=ai_description
+                # NULL marks the description as pending for profile_enrichment.py
+                ai_description=None if goal else ""
             )
             user.set_password(password)
             db.session.add(user)
@@ -351,6 +444,9 @@ def guest_session_register(session_id):
                 )
             ).all()
 
+            # A user can hold only one registration per session
+            previous_guest_regs = first_registration_per_session(previous_guest_regs)
+
             for reg in previous_guest_regs:
                 reg.user_id = user.id
                 # Clear guest fields since now linked to user
@@ -389,6 +485,7 @@ def guest_session_register(session_id):
         # Process companions
         companion_count = int(request.form.get('companion_count', 0))
         max_companions = session_obj.max_companions or 5
+        companions = []
 
         for i in range(min(companion_count, max_companions)):
             companion_name = request.form.get(f'companion_name_{i}')
@@ -402,37 +499,45 @@ def guest_session_register(session_id):
                     email=request.form.get(f'companion_email_{i}', '').strip() or None
                 )
                 db.session.add(companion)
+                companions.append(companion)
 
-        db.session.commit()
+        # Companions with an email get their own guest registration; auto-approved
+        # registrations take their seats in the same transaction
+        companion_registrations = add_companion_guest_registrations(
+            companions, session_obj, registration.is_approved,
+            seats=1 if registration.is_approved else 0
+        )
+        if companion_registrations is None:
+            db.session.rollback()
+            flash('عذراً، اكتمل العدد في هذه الجلسة', 'error')
+            return redirect(url_for('sessions'))
 
-        # Send appropriate email based on approval requirement
+        # Queue appropriate email based on approval requirement (sent by email_worker.py)
         try:
             if session_obj.requires_approval:
                 # Session requires approval - send pending email
                 send_registration_pending_email(email, name, session_obj)
                 # Send pending notification to companions
-                for companion in registration.companions:
-                    if companion.email:
-                        comp_reg = create_companion_guest_registration(companion, session_obj, is_approved=False)
-                        send_companion_registered_email(
-                            companion.email, companion.name, name, session_obj,
-                            is_approved=False, qr_data=None
-                        )
+                for companion, comp_reg in companion_registrations:
+                    send_companion_registered_email(
+                        companion.email, companion.name, name, session_obj,
+                        is_approved=False, qr_data=None
+                    )
             else:
                 # No approval required - send confirmed email with QR
-                qr_data = generate_qr_code(f"reg:{registration.id},session:{session_id}")
+                qr_data = generate_qr_code(make_ticket(registration.id, session_id))
                 send_registration_confirmed_email(email, name, session_obj, qr_data)
-                # Create approved guest registrations for companions and send emails
-                for companion in registration.companions:
-                    if companion.email:
-                        comp_reg = create_companion_guest_registration(companion, session_obj, is_approved=True)
-                        comp_qr = generate_qr_code(f"reg:{comp_reg.id},session:{session_id}")
-                        send_companion_registered_email(
-                            companion.email, companion.name, name, session_obj,
-                            is_approved=True, qr_data=comp_qr
-                        )
+                # Send emails to companions with their approved guest registrations
+                for companion, comp_reg in companion_registrations:
+                    comp_qr = generate_qr_code(make_ticket(comp_reg.id, session_id, KIND_COMPANION))
+                    send_companion_registered_email(
+                        companion.email, companion.name, name, session_obj,
+                        is_approved=True, qr_data=comp_qr
+                    )
         except Exception as e:
-            app.logger.error(f"Email sending failed: {e}")
+            app.logger.error(f"Email queueing failed: {e}")
+
+        db.session.commit()
 
         if user:
             if previous_guest_regs:
@@ -492,9 +597,7 @@ def user_login():
             # Handle "Remember me" - set refresh token
             response = None
             if remember_me:
-                refresh_token = secrets.token_urlsafe(32)
-                user.refresh_token = refresh_token
-                user.refresh_token_expires = datetime.utcnow() + timedelta(days=30)
+                refresh_token = RefreshToken.issue(user, REFRESH_TOKEN_LIFETIME, request.user_agent.string)
                 db.session.commit()
 
                 # Determine redirect
@@ -507,7 +610,7 @@ def user_login():
                 response.set_cookie(
                     'refresh_token',
                     refresh_token,
-                    max_age=30*24*60*60,  # 30 days
+                    max_age=int(REFRESH_TOKEN_LIFETIME.total_seconds()),
                     httponly=True,
                     samesite='Lax'
                 )
@@ -535,13 +638,11 @@ def user_dashboard():
 
 @app.route('/user/logout')
 def user_logout():
-    # Invalidate refresh token in database
-    if 'user_id' in flask_session:
-        user = User.query.get(flask_session['user_id'])
-        if user:
-            user.refresh_token = None
-            user.refresh_token_expires = None
-            db.session.commit()
+    # Invalidate this device's refresh token in database
+    refresh_token = request.cookies.get('refresh_token')
+    if refresh_token:
+        RefreshToken.query.filter_by(token_hash=RefreshToken.hash_token(refresh_token)).delete()
+        db.session.commit()
 
     flask_session.pop('user_id', None)
     flash('تم تسجيل الخروج بنجاح', 'success')
@@ -568,9 +669,8 @@ def forgot_password():
             reset_token = secrets.token_urlsafe(32)
             user.reset_token = reset_token
             user.reset_token_expires = datetime.utcnow() + timedelta(hours=1)
-            db.session.commit()
 
-            # Send reset email
+            # Queue reset email
             try:
                 from utils import send_password_reset_email
                 reset_url = url_for('reset_password', token=reset_token, _external=True)
@@ -578,6 +678,8 @@ def forgot_password():
             except Exception as e:
                 app.logger.error(f"Password reset email failed: {e}")
 
+            db.session.commit()
+
         # Always show success message (don't reveal if email exists)
         flash('إذا كان البريد الإلكتروني مسجلاً، ستصلك رسالة تحتوي على رابط إعادة تعيين كلمة المرور', 'success')
         return redirect(url_for('user_login'))
@@ -610,10 +712,11 @@ def reset_password(token):
             flash('كلمة المرور وتأكيدها غير متطابقتين', 'error')
             return redirect(url_for('reset_password', token=token))
 
-        # Set new password and clear reset token
+        # Set new password, clear reset token and sign out every remembered device
         user.set_password(password)
         user.reset_token = None
         user.reset_token_expires = None
+        RefreshToken.query.filter_by(user_id=user.id).delete()
         db.session.commit()
 
         flash('تم تغيير كلمة المرور بنجاح! يمكنك الآن تسجيل الدخول', 'success')
@@ -683,13 +786,18 @@ def my_qr_code(session_id):
         return jsonify({'error': 'غير مسجل في هذه الجلسة'}), 403
     
     # Generate QR code for this specific user and session
-    qr_data = f"user:{user_id},session:{session_id},reg:{registration.id}"
-    qr_code = generate_qr_code(qr_data)
+    qr_data = make_ticket(registration.id, session_id)
+    qr_format = request.args.get('format', 'png')
+    if qr_format == 'compact':
+        qr_code = generate_qr_code(qr_data, compact=True)
+    else:
+        qr_code = generate_qr_code(qr_data, fmt=qr_format)
     return jsonify({'qr_code': qr_code})
 
 @app.route('/sessions')
+@response_cache.cached(_listing_version, personalized=True)
 def sessions():
-    all_sessions = Session.query.order_by(Session.date.desc()).all()
+    all_sessions = Session.with_counts(Session.query.order_by(Session.date.desc()))
     return render_template('sessions.html', sessions=all_sessions)
 
 @app.route('/session/<int:session_id>/register')
@@ -758,18 +866,27 @@ def register_for_session(session_id):
         is_approved=not session_obj.requires_approval
     )
     db.session.add(registration)
-    db.session.commit()
 
-    # Send appropriate email based on approval requirement
+    # Auto-approved registrations take their seat in the same transaction
+    if registration.is_approved and not session_obj.reserve_seats():
+        db.session.rollback()
+        flash('عذراً، اكتمل العدد في هذه الجلسة', 'error')
+        return redirect(url_for('session_detail', session_id=session_id))
+
+    db.session.flush()  # Get registration.id for the QR code
+
+    # Queue appropriate email based on approval requirement (sent by email_worker.py)
     user = User.query.get(user_id)
     try:
         if session_obj.requires_approval:
             send_registration_pending_email(user.email, user.name, session_obj)
         else:
-            qr_data = generate_qr_code(f"reg:{registration.id},session:{session_id}")
+            qr_data = generate_qr_code(make_ticket(registration.id, session_id))
             send_registration_confirmed_email(user.email, user.name, session_obj, qr_data)
     except Exception as e:
-        app.logger.error(f"Email sending failed: {e}")
+        app.logger.error(f"Email queueing failed: {e}")
+
+    db.session.commit()
 
     if session_obj.requires_approval:
         flash('تم تسجيلك في الجلسة، في انتظار الموافقة من الإدارة', 'success')
@@ -812,14 +929,16 @@ def admin_dashboard():
     pending_approvals = Registration.query.filter_by(is_approved=False).count()
     
     # Get recent registrations
-    recent_registrations = Registration.query.join(User).join(Session).order_by(
+    recent_registrations = Registration.query.join(User).join(Session).options(
+        contains_eager(Registration.user), contains_eager(Registration.session)
+    ).order_by(
         Registration.registered_at.desc()
     ).limit(10).all()
     
     # Get upcoming sessions
-    upcoming_sessions = Session.query.filter(
+    upcoming_sessions = Session.with_counts(Session.query.filter(
         Session.date > datetime.utcnow()
-    ).order_by(Session.date.asc()).limit(5).all()
+    ).order_by(Session.date.asc()), limit=5)
     
     return render_template('admin/dashboard.html',
                          total_users=total_users,
@@ -831,7 +950,7 @@ def admin_dashboard():
 @app.route('/admin/sessions')
 @login_required
 def admin_sessions():
-    sessions = Session.query.order_by(Session.date.desc()).all()
+    sessions = Session.with_counts(Session.query.order_by(Session.date.desc()))
     return render_template('admin/sessions.html', sessions=sessions)
 
 @app.route('/admin/sessions/new', methods=['GET', 'POST'])
@@ -918,10 +1037,7 @@ def admin_edit_session(session_id):
 
 @app.route('/event/<path:identifier>')
 def event_page(identifier):
-    # Try to find session by slug first, then by ID
-    session_obj = Session.query.filter_by(slug=identifier).first()
-    if not session_obj and identifier.isdigit():
-        session_obj = Session.query.get(int(identifier))
+    session_obj = Session.get_by_identifier(identifier)
     
     if not session_obj:
         flash('الجلسة غير موجودة', 'error')
@@ -930,19 +1046,41 @@ def event_page(identifier):
     return redirect(url_for('register', session_id=session_obj.id))
 
 @app.route('/event/<path:identifier>/embed')
+@response_cache.cached(_embed_shell_version)
 def event_embed(identifier):
-    # Try to find session by slug first, then by ID
-    session_obj = Session.query.filter_by(slug=identifier).first()
-    if not session_obj and identifier.isdigit():
-        session_obj = Session.query.get(int(identifier))
-    
+    session_obj = Session.get_by_identifier(identifier)
     if not session_obj or not session_obj.embed_enabled:
         return "هذه الجلسة غير متاحة للتضمين", 404
     
     # Check if mini view is enabled
     template = 'embed_mini.html' if session_obj.enable_mini_view else 'embed_full.html'
     
-    return render_template(template, session_obj=session_obj)
+    # The embed templates read `session`; pass it explicitly so they never see the visitor's cookie session
+    response = make_response(render_template(template, session_obj=session_obj, session=session_obj))
+    response.headers['Cache-Control'] = EMBED_CACHE_CONTROL
+    return response
+
+@app.route('/api/event/<path:identifier>/seats')
+@response_cache.cached(_session_data_version)
+def api_event_seats(identifier):
+    """Registration state for the embed widget, with the seat count when the session shows it"""
+    session_obj = Session.get_by_identifier(identifier)
+    if not session_obj or not session_obj.embed_enabled:
+        return jsonify({'error': 'الجلسة غير موجودة'}), 404
+    
+    seats = {
+        'status': session_obj.status,
+        'registration_open': session_obj.can_register()
+    }
+    if session_obj.show_participant_count:
+        seats.update({
+            'is_full': session_obj.is_full(),
+            'seats_left': max(session_obj.max_participants - session_obj.get_registration_count(), 0),
+            'max_participants': session_obj.max_participants
+        })
+    response = jsonify(seats)
+    response.headers['Cache-Control'] = SEATS_CACHE_CONTROL
+    return response
 
 @app.route('/admin/sessions/<int:session_id>/embed-code')
 @login_required
@@ -966,11 +1104,10 @@ def get_embed_code(session_id):
 @app.route('/admin/analytics')
 @login_required
 def admin_analytics():
-    # Generate AI analytics
+    # Stored AI analyses; changed figures are re-analyzed side by side within the page budget
     try:
-        demographics = analyze_participant_data('demographics')
-        trends = analyze_participant_data('trends')
-        insights = analyze_participant_data('insights')
+        analyses = analytics_cache.get_many(['demographics', 'trends', 'insights'])
+        demographics, trends, insights = analyses['demographics'], analyses['trends'], analyses['insights']
     except Exception as e:
         app.logger.error(f"Analytics generation failed: {e}")
         demographics = trends = insights = None
@@ -980,6 +1117,60 @@ def admin_analytics():
                          trends=trends,
                          insights=insights)
 
+@app.route('/admin/performance')
+@login_required
+def admin_performance():
+    return render_template('admin/performance.html',
+                         enabled=instrumentation.ENABLED,
+                         threshold_ms=instrumentation.SLOW_REQUEST_MS,
+                         slow_requests=instrumentation.recent_slow_requests())
+
+DEAD_LETTER_PAGE_SIZE = 200
+
+
+@app.route('/admin/email/dead-letters')
+@login_required
+def admin_dead_letters():
+    """Emails the outbox worker gave up on, newest first"""
+    dead_letters = EmailDeadLetter.query.order_by(EmailDeadLetter.id.desc()).limit(DEAD_LETTER_PAGE_SIZE).all()
+    return render_template('admin/dead_letters.html',
+                         dead_letters=dead_letters,
+                         total=EmailDeadLetter.query.count(),
+                         pending=EmailOutbox.query.filter_by(status='pending').count())
+
+@app.route('/admin/email/dead-letters/requeue', methods=['POST'])
+@login_required
+def admin_requeue_dead_letters():
+    """Move the selected dead letters, or all of them, back into the outbox"""
+    try:
+        if request.form.get('all'):
+            # Only what the admin saw; letters dead-lettered meanwhile stay put
+            last_id = db.session.scalar(db.select(func.max(EmailDeadLetter.id)))
+            selected = EmailDeadLetter.id <= (last_id or 0)
+        else:
+            ids = [int(value) for value in request.form.getlist('ids') if value.isdigit()]
+            if not ids:
+                flash('لم يتم تحديد رسائل', 'warning')
+                return redirect(url_for('admin_dead_letters'))
+            selected = EmailDeadLetter.id.in_(ids)
+
+        requeued = db.session.execute(db.insert(EmailOutbox).from_select(
+            ['recipients', 'subject', 'text', 'html', 'attachments', 'created_at', 'status', 'attempts'],
+            db.select(
+                EmailDeadLetter.recipients, EmailDeadLetter.subject, EmailDeadLetter.text,
+                EmailDeadLetter.html, EmailDeadLetter.attachments, EmailDeadLetter.created_at,
+                db.literal('pending'), db.literal(0)
+            ).where(selected).order_by(EmailDeadLetter.id)
+        )).rowcount
+        db.session.execute(db.delete(EmailDeadLetter).where(selected))
+        db.session.commit()
+        flash(f'تمت إعادة {requeued} رسالة إلى قائمة الإرسال', 'success')
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Requeue dead letters failed: {e}")
+        flash('حدث خطأ أثناء إعادة الرسائل', 'error')
+    return redirect(url_for('admin_dead_letters'))
+
 @app.route('/admin/search', methods=['POST'])
 @login_required
 def admin_search():
@@ -994,6 +1185,41 @@ def admin_search():
         app.logger.error(f"Search failed: {e}")
         return jsonify({'error': 'فشل في البحث'})
 
+@app.route('/api/admin/similar-participants')
+@login_required
+def api_similar_participants():
+    """Members whose goal, activity and description read most like a member's (user_id) or a text (q)"""
+    user_id = request.args.get('user_id', type=int)
+    text = (request.args.get('q') or '').strip()
+    limit = max(1, min(request.args.get('limit', 10, type=int), SIMILAR_MAX_RESULTS))
+    if user_id is None and not text:
+        return jsonify({'success': False, 'error': 'يجب تحديد مشارك أو نص للبحث'}), 400
+
+    try:
+        if not participant_similarity.ready():
+            return jsonify({'success': False, 'building': True,
+                            'error': 'جاري بناء فهرس التشابه، حاول بعد قليل'}), 503
+        if user_id is not None:
+            if db.session.get(User, user_id) is None:
+                return jsonify({'success': False, 'error': 'المشارك غير موجود'}), 404
+            # None until the member's profile has text to compare
+            matches = participant_similarity.similar_to_user(user_id, limit) or []
+        else:
+            matches = participant_similarity.similar_to_text(text, limit)
+        users = {user.id: user for user in User.query.filter(User.id.in_([uid for uid, _ in matches]))}
+        results = [{
+            'id': uid,
+            'name': users[uid].name,
+            'company': users[uid].company_name or '',
+            'position': users[uid].position or '',
+            'activity': users[uid].activity_type or '',
+            'score': round(score, 3)
+        } for uid, score in matches if uid in users]
+        return jsonify({'success': True, 'results': results})
+    except Exception as e:
+        app.logger.error(f"Similar participants failed: {e}")
+        return jsonify({'success': False, 'error': 'فشل في البحث'}), 500
+
 @app.route('/admin/export/<export_type>')
 @login_required
 def admin_export(export_type):
@@ -1051,28 +1277,37 @@ def session_attendees(session_id):
 def approve_registration(registration_id):
     try:
         registration = Registration.query.get_or_404(registration_id)
+        if registration.is_approved:
+            return jsonify({'success': True})
+
+        # Take seats for the registrant and each emailed companion, or refuse if full
+        companion_registrations = add_companion_guest_registrations(
+            registration.companions, registration.session, True, seats=1
+        )
+        if companion_registrations is None:
+            db.session.rollback()
+            return jsonify({'success': False, 'error': 'الجلسة مكتملة العدد'})
+
         registration.is_approved = True
-        db.session.commit()
 
-        # Send confirmation email to registrant
+        # Queue confirmation email to registrant
         try:
             email = registration.get_registrant_email()
             name = registration.get_registrant_name()
-            qr_data = generate_qr_code(f"reg:{registration.id},session:{registration.session_id}")
+            qr_data = generate_qr_code(make_ticket(registration.id, registration.session_id))
             send_registration_confirmed_email(email, name, registration.session, qr_data)
 
-            # Handle companions - create guest registrations and send emails
-            for companion in registration.companions:
-                if companion.email:
-                    comp_reg = create_companion_guest_registration(companion, registration.session, is_approved=True)
-                    comp_qr = generate_qr_code(f"reg:{comp_reg.id},session:{registration.session_id}")
-                    send_companion_registered_email(
-                        companion.email, companion.name, name, registration.session,
-                        is_approved=True, qr_data=comp_qr
-                    )
+            # Send emails to companions with their approved guest registrations
+            for companion, comp_reg in companion_registrations:
+                comp_qr = generate_qr_code(make_ticket(comp_reg.id, registration.session_id, KIND_COMPANION))
+                send_companion_registered_email(
+                    companion.email, companion.name, name, registration.session,
+                    is_approved=True, qr_data=comp_qr
+                )
         except Exception as e:
-            app.logger.error(f"Approval email sending failed: {e}")
+            app.logger.error(f"Approval email queueing failed: {e}")
 
+        db.session.commit()
         return jsonify({'success': True})
     except Exception as e:
         app.logger.error(f"Registration approval failed: {e}")
@@ -1087,25 +1322,13 @@ def mark_attendance():
         user_id = data.get('user_id')
         attended = data.get('attended', True)
         
-        # Check if attendance record exists
-        attendance = Attendance.query.filter_by(
-            session_id=session_id,
-            user_id=user_id
-        ).first()
-        
-        if attendance:
-            attendance.attended = attended
-            if attended:
-                attendance.check_in_time = datetime.utcnow()
+        if not session_id or not user_id:
+            return jsonify({'success': False, 'error': 'بيانات غير مكتملة'}), 400
+
+        if attended:
+            Attendance.check_in(session_id, {user_id: False})
         else:
-            attendance = Attendance(
-                session_id=session_id,
-                user_id=user_id,
-                attended=attended,
-                check_in_time=datetime.utcnow() if attended else None
-            )
-            db.session.add(attendance)
-        
+            Attendance.mark_absent(session_id, user_id)
         db.session.commit()
         return jsonify({'success': True})
         
@@ -1116,46 +1339,28 @@ def mark_attendance():
 @app.route('/admin/session/<int:session_id>/approve-all', methods=['POST'])
 @login_required
 def approve_all_registrations(session_id):
+    """Start approving every pending registration in the background"""
     try:
-        session_obj = Session.query.get_or_404(session_id)
-        registrations = Registration.query.filter_by(
-            session_id=session_id,
-            is_approved=False
-        ).all()
-
-        for registration in registrations:
-            registration.is_approved = True
-
-        db.session.commit()
-
-        # Send confirmation emails to all approved registrations
-        emails_sent = 0
-        for registration in registrations:
-            try:
-                email = registration.get_registrant_email()
-                name = registration.get_registrant_name()
-                qr_data = generate_qr_code(f"reg:{registration.id},session:{session_id}")
-                send_registration_confirmed_email(email, name, session_obj, qr_data)
-                emails_sent += 1
-
-                # Handle companions - create guest registrations and send emails
-                for companion in registration.companions:
-                    if companion.email:
-                        comp_reg = create_companion_guest_registration(companion, session_obj, is_approved=True)
-                        comp_qr = generate_qr_code(f"reg:{comp_reg.id},session:{session_id}")
-                        send_companion_registered_email(
-                            companion.email, companion.name, name, session_obj,
-                            is_approved=True, qr_data=comp_qr
-                        )
-            except Exception as e:
-                app.logger.error(f"Bulk approval email failed for {email}: {e}")
-
-        return jsonify({'success': True, 'count': len(registrations), 'emails_sent': emails_sent})
+        Session.query.get_or_404(session_id)
+        job = bulk_approval.start_approve_all(session_id)
+        return jsonify({
+            'success': True,
+            'job_id': job.id,
+            'status_url': url_for('admin_job_status', job_id=job.id)
+        }), 202
 
     except Exception as e:
         app.logger.error(f"Bulk approval failed: {e}")
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/admin/jobs/<int:job_id>')
+@login_required
+def admin_job_status(job_id):
+    """Progress of a background job, polled by the admin UI"""
+    background_jobs.fail_stale()
+    job = BackgroundJob.query.get_or_404(job_id)
+    return jsonify({'success': True, 'job': job.to_dict()})
+
 @app.route('/admin/session/<int:session_id>/companions')
 @login_required
 def admin_session_companions(session_id):
@@ -1188,36 +1393,117 @@ def admin_checkin(session_id):
         is_approved=True
     ).all()
 
+    # Per-session ticket key so the scanner rejects forged codes without a request
+    ticket_key = base64.urlsafe_b64encode(ticket_session_key(session_id)).decode().rstrip('=')
+
     return render_template('admin/checkin.html',
                          session_obj=session_obj,
-                         registrations=registrations)
+                         registrations=registrations,
+                         ticket_key=ticket_key,
+                         accept_legacy=TICKET_ACCEPT_LEGACY)
 
 @app.route('/admin/checkin/<int:session_id>/<int:user_id>', methods=['POST'])
 @login_required
 def mark_attendance_qr(session_id, user_id):
-    # Check if attendance record exists
-    attendance = Attendance.query.filter_by(
-        session_id=session_id,
-        user_id=user_id
-    ).first()
-    
-    if not attendance:
-        attendance = Attendance(
-            session_id=session_id,
-            user_id=user_id
-        )
-        db.session.add(attendance)
-    
-    attendance.attended = True
-    attendance.check_in_time = datetime.utcnow()
-    attendance.qr_verified = request.json.get('qr_verified', False)
-    
+    data = request.get_json(silent=True) or {}
+    # A repeat scan of someone already present writes nothing
+    Attendance.check_in(session_id, {user_id: data.get('qr_verified', False)})
     db.session.commit()
     
     return jsonify({'success': True})
 
+@app.route('/admin/checkin/<int:session_id>/ticket', methods=['POST'])
+@login_required
+def checkin_ticket(session_id):
+    """Check in the holder of a scanned ticket"""
+    data = request.get_json(silent=True) or {}
+    ticket = verify_ticket(data.get('ticket'))
+    if not ticket:
+        return jsonify({'success': False, 'error': 'رمز غير صالح'}), 400
+    if ticket['session_id'] != session_id:
+        return jsonify({'success': False, 'error': 'هذا الرمز لجلسة أخرى'}), 400
+
+    result = Registration.check_in(ticket['registration_id'], session_id)
+    if result is None:
+        db.session.rollback()
+        return jsonify({'success': False, 'error': 'التسجيل غير موجود أو غير معتمد'}), 404
+    user_id, first_scan = result
+
+    # Members also get an attendance row so their history and analytics include the visit
+    if first_scan and user_id:
+        Attendance.check_in(session_id, {user_id: ticket['signed']})
+    db.session.commit()
+
+    return jsonify({
+        'success': True,
+        'registration_id': ticket['registration_id'],
+        'user_id': user_id,
+        'kind': ticket['kind'],
+        'already_checked_in': not first_scan
+    })
+
+@app.route('/api/checkin/<int:session_id>/roster')
+@login_required
+def api_checkin_roster(session_id):
+    """Compact roster snapshot for a door scanner, with the version to sync from"""
+    version = checkin_sync.current_version(session_id)
+    if version is None:
+        return jsonify({'success': False, 'error': 'الجلسة غير موجودة'}), 404
+    etag = f"roster-{session_id}-{version}"
+    response = Response(status=304) if etag in request.if_none_match else jsonify(checkin_sync.snapshot(session_id))
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/checkin/<int:session_id>/roster/delta')
+@login_required
+def api_checkin_roster_delta(session_id):
+    """Roster rows changed since the scanner's version"""
+    since = request.args.get('since', type=int)
+    if since is None or since < 0:
+        return jsonify({'success': False, 'error': 'رقم الإصدار مطلوب'}), 400
+    if checkin_sync.current_version(session_id) is None:
+        return jsonify({'success': False, 'error': 'الجلسة غير موجودة'}), 404
+    return jsonify(checkin_sync.delta(session_id, since))
+
+@app.route('/api/checkin/<int:session_id>/batch', methods=['POST'])
+@login_required
+def api_checkin_batch(session_id):
+    """Check in a batch of tickets scanned at the door"""
+    data = request.get_json(silent=True) or {}
+    scans = data.get('tickets')
+    if not isinstance(scans, list) or not scans:
+        return jsonify({'success': False, 'error': 'لم يتم إرسال أي رموز'}), 400
+    if len(scans) > checkin_sync.MAX_BATCH_SCANS:
+        return jsonify({'success': False,
+                        'error': f'الحد الأقصى {checkin_sync.MAX_BATCH_SCANS} رمز في الدفعة'}), 400
+    if checkin_sync.current_version(session_id) is None:
+        return jsonify({'success': False, 'error': 'الجلسة غير موجودة'}), 404
+
+    try:
+        results = checkin_sync.check_in_batch(session_id, [str(scan) for scan in scans])
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"Batch check-in failed: {e}")
+        return jsonify({'success': False, 'error': 'حدث خطأ في تسجيل الحضور'}), 500
+    return jsonify({
+        'success': True,
+        'version': checkin_sync.current_version(session_id),
+        'results': results
+    })
+
+@app.route('/api/tickets/verify', methods=['POST'])
+@login_required
+def api_verify_ticket():
+    """Check a ticket's signature without touching the database"""
+    data = request.get_json(silent=True) or {}
+    ticket = verify_ticket(data.get('ticket'))
+    if not ticket:
+        return jsonify({'valid': False})
+    return jsonify({'valid': True, **ticket})
+
 # API Routes for AJAX
 @app.route('/api/sessions/upcoming')
+@response_cache.cached(_listing_version)
 def api_upcoming_sessions():
     sessions = Session.query.filter(
         Session.date > datetime.utcnow(),
@@ -1254,7 +1540,7 @@ def api_countdown(session_id):
 @login_required
 def api_analytics_demographics():
     try:
-        result = analyze_participant_data('demographics')
+        result = analytics_cache.get('demographics')
         if result:
             return jsonify(result)
         else:
@@ -1267,7 +1553,7 @@ def api_analytics_demographics():
 @login_required
 def api_analytics_trends():
     try:
-        result = analyze_participant_data('trends')
+        result = analytics_cache.get('trends')
         if result:
             return jsonify(result)
         else:
@@ -1280,7 +1566,7 @@ def api_analytics_trends():
 @login_required
 def api_analytics_insights():
     try:
-        result = analyze_participant_data('insights')
+        result = analytics_cache.get('insights')
         if result:
             return jsonify(result)
         else:
@@ -1289,38 +1575,36 @@ def api_analytics_insights():
         app.logger.error(f"Insights API error: {e}")
         return jsonify({'error': 'خطأ في الخادم'}), 500
 
+def _performance_version():
+    return Session.performance_version()
+
+def _parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d') if value else None
+
 @app.route('/api/analytics/session-performance')
 @login_required
+@response_cache.cached(_performance_version)
 def api_session_performance():
+    """Attendance rate per session, best first; ?from=&to= (YYYY-MM-DD, inclusive), ?page=&per_page="""
     try:
-        # Get session performance metrics
-        sessions = Session.query.all()
-        performance_data = []
-        
-        for session in sessions:
-            registrations = session.get_registration_count()
-            attendances = len([a for a in session.attendances if a.attended])
-            attendance_rate = (attendances / registrations * 100) if registrations > 0 else 0
-            
-            performance_data.append({
-                'session_id': session.id,
-                'title': session.title,
-                'session_number': session.session_number,
-                'registrations': registrations,
-                'attendances': attendances,
-                'attendance_rate': attendance_rate,
-                'date': session.date.strftime('%Y-%m-%d')
-            })
-        
-        # Sort by attendance rate
-        performance_data.sort(key=lambda x: x['attendance_rate'], reverse=True)
-        
-        return jsonify({
-            'sessions': performance_data,
-            'average_attendance_rate': sum([s['attendance_rate'] for s in performance_data]) / len(performance_data) if performance_data else 0,
-            'total_sessions': len(sessions),
-            'best_performing_session': performance_data[0] if performance_data else None
+        date_from = _parse_date(request.args.get('from'))
+        date_to = _parse_date(request.args.get('to'))
+    except ValueError:
+        return jsonify({'error': 'صيغة التاريخ غير صحيحة'}), 400
+    page = max(request.args.get('page', 1, type=int), 1)
+    per_page = max(1, min(request.args.get('per_page', SESSION_PERFORMANCE_PAGE_SIZE, type=int),
+                          SESSION_PERFORMANCE_MAX_PAGE_SIZE))
+
+    try:
+        performance = participant_analytics.session_performance(
+            date_from, date_to + timedelta(days=1) if date_to else None, page, per_page
+        )
+        performance.update({
+            'page': page,
+            'per_page': per_page,
+            'pages': -(-performance['total_sessions'] // per_page)
         })
+        return jsonify(performance)
         
     except Exception as e:
         app.logger.error(f"Session performance API error: {e}")
@@ -1438,51 +1722,21 @@ def api_users_for_invite(session_id):
 @app.route('/api/admin/send-invites/<int:session_id>', methods=['POST'])
 @login_required
 def api_send_invites(session_id):
-    """Send email invitations to selected users"""
+    """Queue email invitations for the selected users in the background"""
     try:
-        session_obj = Session.query.get_or_404(session_id)
-        data = request.get_json()
-        user_ids = data.get('user_ids', [])
+        Session.query.get_or_404(session_id)
+        user_ids = _selected_user_ids()
 
         if not user_ids:
             return jsonify({'success': False, 'message': 'لم يتم تحديد مستخدمين'}), 400
 
-        sent_count = 0
-        for user_id in user_ids:
-            user = User.query.get(user_id)
-            if not user:
-                continue
-
-            # Check if already invited
-            existing_invite = Invite.query.filter_by(
-                session_id=session_id,
-                email=user.email
-            ).first()
-
-            if existing_invite:
-                continue
-
-            # Create invite record
-            token = generate_invite_token()
-            invite = Invite(
-                session_id=session_id,
-                email=user.email,
-                token=token,
-                expires_at=session_obj.date,  # Invite expires at session time
-                sent_at=datetime.utcnow()
-            )
-            db.session.add(invite)
-
-            # Send invitation email
-            if send_invitation_email(user.email, session_obj, token, session_obj.invite_message):
-                sent_count += 1
-
-        db.session.commit()
-
+        job, counts = bulk_invites.start_send_invites(session_id, user_ids)
         return jsonify({
             'success': True,
-            'sent_count': sent_count
-        })
+            'job_id': job.id,
+            'status_url': url_for('admin_job_status', job_id=job.id),
+            **counts
+        }), 202
 
     except Exception as e:
         db.session.rollback()
@@ -1490,81 +1744,34 @@ def api_send_invites(session_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+def _selected_user_ids():
+    """User ids posted as a JSON user_ids list or as form fields (comma-separated or repeated)"""
+    data = request.get_json(silent=True)
+    if data is not None:
+        values = data.get('user_ids', [])
+    else:
+        values = [value for field in request.form.getlist('user_ids') for value in field.split(',')]
+    return sorted({int(value) for value in values if str(value).strip().isdigit()})
+
+
 @app.route('/api/admin/generate-whatsapp-invites/<int:session_id>', methods=['POST'])
 @login_required
 def api_generate_whatsapp_invites(session_id):
     """Generate WhatsApp links for selected users"""
     try:
-        import urllib.parse
-
         session_obj = Session.query.get_or_404(session_id)
-        data = request.get_json()
-        user_ids = data.get('user_ids', [])
+        user_ids = _selected_user_ids()
 
         if not user_ids:
             return jsonify({'success': False, 'message': 'لم يتم تحديد مستخدمين'}), 400
 
-        links = []
-        for user_id in user_ids:
-            user = User.query.get(user_id)
-            if not user or not user.phone:
-                continue
-
-            # Generate invite token for tracking
-            token = generate_invite_token()
-
-            # Check if invite exists, if not create one
-            existing_invite = Invite.query.filter_by(
-                session_id=session_id,
-                email=user.email
-            ).first()
-
-            if not existing_invite:
-                invite = Invite(
-                    session_id=session_id,
-                    email=user.email,
-                    token=token,
-                    expires_at=session_obj.date
-                )
-                db.session.add(invite)
-            else:
-                token = existing_invite.token
-
-            # Build registration link
-            import os
-            base_url = os.environ.get('BASE_URL', request.host_url.rstrip('/'))
-            registration_link = f"{base_url}/event/{session_obj.slug or session_obj.id}/register?token={token}"
-
-            # Build WhatsApp message
-            message = f"""مرحباً {user.name}،
-
-نود دعوتك لحضور جلسة "{session_obj.title}" في ثلوثية الأعمال.
-
-📅 التاريخ: {session_obj.date.strftime('%Y-%m-%d')}
-🕐 الوقت: {session_obj.date.strftime('%H:%M')}
-📍 المكان: {session_obj.location or 'سيتم الإعلان عنه لاحقاً'}
-
-للتسجيل، استخدم الرابط التالي:
-{registration_link}
-
-نتطلع لرؤيتك معنا!"""
-
-            # Format phone number for WhatsApp (remove + and leading zeros)
-            formatted_phone = format_phone_number(user.phone)
-            # WhatsApp API expects number without + sign
-            wa_phone = formatted_phone.replace('+', '')
-
-            # Create WhatsApp URL
-            encoded_message = urllib.parse.quote(message)
-            whatsapp_url = f"https://wa.me/{wa_phone}?text={encoded_message}"
-
-            links.append({
-                'name': user.name,
-                'phone': user.phone,
-                'whatsapp_url': whatsapp_url
-            })
-
-        db.session.commit()
+        whatsapp_export.create_missing_invites(session_obj, user_ids)
+        base_url = os.environ.get('BASE_URL', request.host_url.rstrip('/'))
+        links = [{
+            'name': link['name'],
+            'phone': link['phone'],
+            'whatsapp_url': link['whatsapp_url']
+        } for link in whatsapp_export.iter_links(session_obj, user_ids, base_url)]
 
         return jsonify({
             'success': True,
@@ -1577,6 +1784,40 @@ def api_generate_whatsapp_invites(session_id):
         return jsonify({'success': False, 'message': str(e)}), 500
 
 
+@app.route('/api/admin/whatsapp-invites/<int:session_id>/export', methods=['POST'])
+@login_required
+def api_export_whatsapp_invites(session_id):
+    """Stream WhatsApp links for the selected users as CSV, or as a ZIP of per-batch CSV files"""
+    session_obj = Session.query.get_or_404(session_id)
+    user_ids = _selected_user_ids()
+    if not user_ids:
+        return jsonify({'success': False, 'message': 'لم يتم تحديد مستخدمين'}), 400
+
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'zip'):
+        return jsonify({'success': False, 'message': 'صيغة غير مدعومة'}), 400
+    batch_size = max(1, request.args.get('batch_size', 500, type=int))
+
+    try:
+        whatsapp_export.create_missing_invites(session_obj, user_ids)
+    except Exception as e:
+        db.session.rollback()
+        app.logger.error(f"WhatsApp invites export error: {e}")
+        return jsonify({'success': False, 'message': str(e)}), 500
+
+    base_url = os.environ.get('BASE_URL', request.host_url.rstrip('/'))
+    links = whatsapp_export.iter_links(session_obj, user_ids, base_url)
+    filename = f"whatsapp-invites-{session_obj.id}.{export_format}"
+    if export_format == 'zip':
+        body, mimetype = whatsapp_export.stream_zip(links, batch_size), 'application/zip'
+    else:
+        body, mimetype = whatsapp_export.stream_csv(links), 'text/csv'
+
+    response = Response(stream_with_context(body), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename={filename}'
+    return response
+
+
 @app.route('/api/admin/session-invites/<int:session_id>')
 @login_required
 def api_session_invites(session_id):
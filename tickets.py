@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Signed check-in tickets.
+
+A ticket is the text encoded in a registration's QR code:
+
+    T1:<kind>:<registration id>:<session id>:<signature>
+
+kind is R for a registrant and C for a companion. The signature is a
+truncated HMAC-SHA256 over everything before it, keyed with a per-session key
+derived from TICKET_SECRET (falling back to the app's secret key). Verifying needs
+no database access, and the door page for a session gets only that session's
+key so scanners can reject forged codes before sending anything to the server.
+"""
+
+import base64
+import hashlib
+import hmac
+import os
+
+from app import app
+
+TICKET_VERSION = 'T1'
+KIND_REGISTRANT = 'R'
+KIND_COMPANION = 'C'
+KINDS = (KIND_REGISTRANT, KIND_COMPANION)
+SIGNATURE_LENGTH = 22  # base64url characters, 132 bits
+
+# Unsigned "reg:ID,session:ID" codes from before signed tickets are forgeable, so they
+# are refused unless a deployment opts in while old tickets are still in circulation
+ACCEPT_LEGACY = os.environ.get('TICKET_ACCEPT_LEGACY', '0').lower() in ('1', 'true', 'yes')
+
+
+def _master_secret():
+    return (os.environ.get('TICKET_SECRET') or app.secret_key).encode('utf-8')
+
+
+def session_key(session_id):
+    """Signing key for one session's tickets, safe to hand to that session's door scanners"""
+    return hmac.new(_master_secret(), f"ticket-session:{session_id}".encode(), hashlib.sha256).digest()
+
+
+def _sign(key, message):
+    digest = hmac.new(key, message.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).decode().rstrip('=')[:SIGNATURE_LENGTH]
+
+
+def make_ticket(registration_id, session_id, kind=KIND_REGISTRANT):
+    """Signed ticket text for a registration"""
+    message = f"{TICKET_VERSION}:{kind}:{registration_id}:{session_id}"
+    return f"{message}:{_sign(session_key(session_id), message)}"
+
+
+def _parse_legacy(text):
+    fields = dict(part.split(':', 1) for part in text.split(',') if ':' in part)
+    if not fields.get('reg', '').isdigit() or not fields.get('session', '').isdigit():
+        return None
+    return {'registration_id': int(fields['reg']), 'session_id': int(fields['session']),
+            'kind': KIND_REGISTRANT, 'signed': False}
+
+
+def verify_ticket(text):
+    """Parse and check a scanned ticket.
+
+    Returns {'registration_id', 'session_id', 'kind', 'signed'} or None when the
+    text is not a ticket or its signature does not match.
+    """
+    text = (text or '').strip()
+    parts = text.split(':')
+    if len(parts) == 5 and parts[0] == TICKET_VERSION:
+        _, kind, registration_id, session_id, signature = parts
+        if kind not in KINDS or not registration_id.isdigit() or not session_id.isdigit():
+            return None
+        expected = _sign(session_key(int(session_id)), text.rsplit(':', 1)[0])
+        if not hmac.compare_digest(expected, signature):
+            return None
+        return {'registration_id': int(registration_id), 'session_id': int(session_id),
+                'kind': kind, 'signed': True}
+    if ACCEPT_LEGACY and text.startswith('reg:'):
+        return _parse_legacy(text)
+    return None
@@ -2,8 +2,14 @@ import re
 import qrcode
 import io
 import base64
+import functools
+import hashlib
+import time
 import resend
-from models import User
+from app import app, db
+from models import User, EmailOutbox
+from instrumentation import timed
+import email_transport
 import os
 import random
 import string
@@ -16,9 +22,48 @@ import logging
 logger = logging.getLogger(__name__)
 
 
-def _send_email(to, subject, text=None, html=None, attachments=None):
+# The batch endpoint takes at most this many emails per request
+RESEND_BATCH_LIMIT = 100
+
+
+@functools.lru_cache(maxsize=None)
+def _resend_sender():
+    """Configure Resend once per process and return the from address"""
+    local = email_transport.EMAIL_TRANSPORT == 'local'
+    api_key = os.environ.get("RESEND_API_KEY", "") or ('local' if local else '')
+    from_email = os.environ.get("FROM_EMAIL", "") or ('events@localhost' if local else '')
+
+    if not api_key:
+        raise RuntimeError("RESEND_API_KEY not configured")
+
+    if not from_email:
+        raise RuntimeError("FROM_EMAIL not configured")
+
+    resend.api_key = api_key
+    email_transport.install()
+    return from_email
+
+
+def _email_params(from_email, to, subject, text=None, html=None, attachments=None):
+    email_params = {
+        "from": from_email,
+        "to": [to] if isinstance(to, str) else to,
+        "subject": subject
+    }
+
+    if text:
+        email_params["text"] = text
+    if html:
+        email_params["html"] = html
+    if attachments:
+        email_params["attachments"] = attachments
+    return email_params
+
+
+@timed('email')
+def _deliver_email(to, subject, text=None, html=None, attachments=None, idempotency_key=None):
     """
-    Abstract email sending layer using Resend.
+    Send one email through Resend, raising on any failure.
 
     Args:
         to: Recipient email address (string or list)
@@ -26,46 +71,129 @@ def _send_email(to, subject, text=None, html=None, attachments=None):
         text: Plain text body (optional if html provided)
         html: HTML body (optional)
         attachments: List of attachment dicts with keys: filename, content, content_id (optional)
+        idempotency_key: Makes retries of this send safe; one is generated when not given
 
     Returns:
-        True on success, False on failure
+        The provider message id
     """
-    recipient = [to] if isinstance(to, str) else to
+    email_params = _email_params(_resend_sender(), to, subject, text=text, html=html, attachments=attachments)
+    recipient = email_params["to"]
+
+    logger.info("Sending email to %s: %s", recipient, subject)
+    response = resend.Emails.send(email_params, {'idempotency_key': idempotency_key or _new_idempotency_key()})
+    provider_id = response.get('id', 'unknown')
+    logger.info("Email sent successfully to %s (id: %s)", recipient, provider_id)
+    return provider_id
+
+
+def _new_idempotency_key():
+    return secrets.token_hex(16)
+
+
+def _batch_idempotency_key(messages):
+    """Key of a batch: derived from its messages' keys (sorted) when they all have one"""
+    keys = [message.get('idempotency_key') for message in messages]
+    if not all(keys):
+        return _new_idempotency_key()
+    return 'batch-' + hashlib.sha256(','.join(sorted(keys)).encode('utf-8')).hexdigest()
+
+
+@timed('email')
+def _deliver_batch(messages):
+    """Send up to RESEND_BATCH_LIMIT emails in one request, returning their provider ids"""
+    from_email = _resend_sender()
+    params = [_email_params(from_email, **{k: v for k, v in message.items() if k != 'idempotency_key'})
+              for message in messages]
+
+    logger.info("Sending batch of %s emails", len(params))
+    response = resend.Batch.send(params, {'idempotency_key': _batch_idempotency_key(messages)})
+    return [item.get('id', 'unknown') for item in response['data']]
+
+
+def send_many(messages, executor=None):
+    """
+    Send several emails with as few provider requests as possible.
+
+    Messages without attachments go through the batch endpoint in chunks of
+    RESEND_BATCH_LIMIT; the batch endpoint does not take attachments, so the
+    rest are sent one by one, as is a batch the provider rejects outright.
+    Requests run on executor when one is given.
+
+    Args:
+        messages: List of dicts with keys to, subject, text, html, attachments
+            and optionally idempotency_key, which should stay the same when
+            the message is sent again (the outbox uses its row id)
 
+    Returns:
+        A (provider_id, error) pair per message, in order; error is the
+        exception raised for it, None on success
+    """
+    plain = [i for i, message in enumerate(messages) if not message.get('attachments')]
+    chunks = [[i] for i, message in enumerate(messages) if message.get('attachments')]
+    chunks += [plain[i:i + RESEND_BATCH_LIMIT] for i in range(0, len(plain), RESEND_BATCH_LIMIT)]
+
+    def send_one(index):
+        try:
+            return _deliver_email(**messages[index]), None
+        except Exception as e:
+            logger.error("Email sending failed to %s: %s", messages[index]['to'], str(e))
+            return None, e
+
+    def send(indexes):
+        if len(indexes) == 1:
+            return [send_one(indexes[0])]
+        try:
+            return [(provider_id, None) for provider_id in _deliver_batch([messages[i] for i in indexes])]
+        except Exception as e:
+            if email_transport.is_transient_error(e):
+                logger.error("Email batch of %s failed: %s", len(indexes), str(e))
+                return [(None, e)] * len(indexes)
+            # The provider rejects a whole batch over one bad message; find it by sending singly
+            logger.warning("Email batch of %s rejected (%s), sending one by one", len(indexes), str(e))
+            return [send_one(index) for index in indexes]
+
+    results = [None] * len(messages)
+    for indexes, outcome in zip(chunks, (executor.map if executor else map)(send, chunks)):
+        for index, result in zip(indexes, outcome):
+            results[index] = result
+    return results
+
+
+def _send_email(to, subject, text=None, html=None, attachments=None):
+    """
+    Send an email immediately, bypassing the outbox.
+
+    Returns:
+        True on success, False on failure
+    """
     try:
-        resend.api_key = os.environ.get("RESEND_API_KEY", "")
-        from_email = os.environ.get("FROM_EMAIL", "")
-
-        if not resend.api_key:
-            logger.warning("RESEND_API_KEY not configured - email not sent to %s", recipient)
-            return False
-
-        if not from_email:
-            logger.warning("FROM_EMAIL not configured - email not sent to %s", recipient)
-            return False
-
-        email_params = {
-            "from": from_email,
-            "to": recipient,
-            "subject": subject
-        }
-
-        if text:
-            email_params["text"] = text
-        if html:
-            email_params["html"] = html
-        if attachments:
-            email_params["attachments"] = attachments
-
-        logger.info("Sending email to %s: %s", recipient, subject)
-        response = resend.Emails.send(email_params)
-        logger.info("Email sent successfully to %s (id: %s)", recipient, response.get('id', 'unknown'))
+        _deliver_email(to, subject, text=text, html=html, attachments=attachments)
         return True
-
     except Exception as e:
-        logger.error("Email sending failed to %s: %s", recipient, str(e))
+        logger.error("Email sending failed to %s: %s", to, str(e))
         return False
 
+
+def _queue_email(to, subject, text=None, html=None, attachments=None):
+    """
+    Queue an email in the outbox as part of the current database transaction.
+
+    Nothing is sent until the caller commits and email_worker.py picks the
+    message up, so request latency never depends on the email provider.
+
+    Returns:
+        The pending EmailOutbox row
+    """
+    message = EmailOutbox(
+        recipients=[to] if isinstance(to, str) else list(to),
+        subject=subject,
+        text=text,
+        html=html,
+        attachments=attachments
+    )
+    db.session.add(message)
+    return message
+
 def generate_username(name):
     """Generate a unique username from name"""
     # Clean name and create base username
@@ -81,244 +209,224 @@ def generate_username(name):
     
     return username
 
-def generate_qr_code(data):
-    """Generate QR code for the given data"""
+QR_BOX_SIZE = 10
+QR_BORDER = 4
+QR_CACHE_SIZE = int(os.environ.get('QR_CACHE_SIZE', 2048))
+# Shared by all workers and kept across restarts; set QR_CACHE_DIR="" to disable. The images
+# are signed tickets, so the directory and files are private to the app's user
+QR_CACHE_DIR = os.environ.get('QR_CACHE_DIR', os.path.join(app.instance_path, 'qr-cache'))
+QR_CACHE_MAX_AGE = int(os.environ.get('QR_CACHE_MAX_AGE_DAYS', 30)) * 86400  # Seconds
+QR_CACHE_PRUNE_INTERVAL = 3600  # Seconds between sweeps for expired files, per process
+QR_FORMATS = ('png', 'svg')
+
+
+def _make_qr(data):
+    qr = qrcode.QRCode(
+        version=1,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        box_size=QR_BOX_SIZE,
+        border=QR_BORDER,
+    )
+    qr.add_data(data)
+    qr.make(fit=True)
+    return qr
+
+
+def _render_qr(data, fmt, compact):
+    """Encode data and render it to PNG or SVG bytes"""
+    qr = _make_qr(data)
+
+    if fmt == 'svg':
+        # One path of horizontal runs instead of a rect per module
+        matrix = qr.get_matrix()
+        size = len(matrix)
+        runs = []
+        for y, row in enumerate(matrix):
+            x = 0
+            while x < size:
+                if row[x]:
+                    start = x
+                    while x < size and row[x]:
+                        x += 1
+                    runs.append(f"M{start} {y}h{x - start}v1h-{x - start}z")
+                else:
+                    x += 1
+        return (
+            f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {size} {size}" '
+            f'width="{size * QR_BOX_SIZE}" height="{size * QR_BOX_SIZE}" shape-rendering="crispEdges">'
+            f'<rect width="{size}" height="{size}" fill="#fff"/><path d="{"".join(runs)}"/></svg>'
+        ).encode()
+
+    if compact:
+        # One pixel per module; display it scaled up with CSS image-rendering: pixelated
+        qr.box_size = 1
+    img = qr.make_image(fill_color="black", back_color="white").get_image()
+    buffer = io.BytesIO()
+    img.convert('1').save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def _qr_cache_path(data, fmt, compact):
+    """Content address of a rendered QR code: payload plus every render option"""
+    key = hashlib.sha256(
+        f"{fmt}:{int(compact)}:{QR_BOX_SIZE}:{QR_BORDER}:{data}".encode('utf-8')
+    ).hexdigest()
+    return os.path.join(QR_CACHE_DIR, key[:2], f"{key}.{fmt}")
+
+
+def _read_qr_file(path):
     try:
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_L,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(data)
-        qr.make(fit=True)
-        
-        img = qr.make_image(fill_color="black", back_color="white")
-        
-        # Convert to base64
-        buffer = io.BytesIO()
-        img.save(buffer, format='PNG')
-        buffer.seek(0)
-        
-        img_str = base64.b64encode(buffer.getvalue()).decode()
-        return f"data:image/png;base64,{img_str}"
-        
+        with open(path, 'rb') as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+def _write_qr_file(path, content):
+    try:
+        # makedirs applies mode to the leaf only, so create the cache root on its own first
+        os.makedirs(QR_CACHE_DIR, mode=0o700, exist_ok=True)
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        logger.warning("Could not write QR cache file %s: %s", path, e)
+    _prune_qr_cache()
+
+
+_qr_cache_pruned_at = 0.0
+
+
+def _prune_qr_cache():
+    """Delete cached QR files older than QR_CACHE_MAX_AGE, at most once per QR_CACHE_PRUNE_INTERVAL"""
+    global _qr_cache_pruned_at
+    now = time.time()
+    if now - _qr_cache_pruned_at < QR_CACHE_PRUNE_INTERVAL:
+        return
+    _qr_cache_pruned_at = now
+    removed = 0
+    for root, _, files in os.walk(QR_CACHE_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            try:
+                if os.stat(path).st_mtime < now - QR_CACHE_MAX_AGE:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass  # Removed by another worker meanwhile
+    if removed:
+        logger.info("Pruned %s expired QR cache files", removed)
+
+
+@functools.lru_cache(maxsize=QR_CACHE_SIZE)
+def _qr_data_uri(data, fmt, compact):
+    path = _qr_cache_path(data, fmt, compact) if QR_CACHE_DIR else None
+    content = _read_qr_file(path) if path else None
+    if content is None:
+        content = _render_qr(data, fmt, compact)
+        if path:
+            _write_qr_file(path, content)
+    mime = 'image/svg+xml' if fmt == 'svg' else 'image/png'
+    return f"data:{mime};base64,{base64.b64encode(content).decode()}"
+
+
+def generate_qr_code(data, fmt='png', compact=False):
+    """Generate a QR code data URI for the given data.
+
+    fmt is 'png' or 'svg'; a compact PNG has one pixel per module. The same
+    payload always renders the same image, so results are cached in memory
+    and on disk under a hash of the payload and render options.
+    """
+    try:
+        if fmt not in QR_FORMATS:
+            raise ValueError(f"Unknown QR format: {fmt}")
+        return _qr_data_uri(str(data), fmt, bool(compact) and fmt == 'png')
     except Exception as e:
-        print(f"QR code generation failed: {e}")
+        logger.error(f"QR code generation failed: {e}")
         return None
 
-def send_confirmation_email(email_address, name, session):
-    """Send confirmation email to participant"""
-    body = f"""
-مرحباً {name},
+@functools.lru_cache(maxsize=None)
+def _email_template(name):
+    """Email template compiled once per process"""
+    return app.jinja_env.get_template(f"emails/{name}")
 
-تم تأكيد تسجيلك في:
-{session.title}
-التجمع رقم {session.session_number}
 
-التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}
+def _render_email(template_name, **context):
+    """Render templates/emails/<template_name>"""
+    return _email_template(template_name).render(**context)
 
-نتطلع لرؤيتك معنا!
 
-فريق ثلوثية الأعمال
-    """
+def _qr_attachments(qr_data):
+    """Inline attachment for a PNG QR data URI, referenced as cid:qrcode"""
+    if not qr_data or not qr_data.startswith('data:image/png;base64,'):
+        return None
+    return [{
+        "filename": "qrcode.png",
+        "content": qr_data.split(',')[1],
+        "content_id": "qrcode"
+    }]
+
 
-    return _send_email(
+def send_confirmation_email(email_address, name, session):
+    """Send confirmation email to participant"""
+    return _queue_email(
         to=email_address,
         subject=f"تأكيد التسجيل - {session.title}",
-        text=body
+        text=_render_email('confirmation.txt', name=name, session=session)
     )
 
 
 def send_registration_pending_email(email_address, name, session):
     """Send registration received email (pending approval)"""
-    body = f"""
-مرحباً {name},
-
-شكراً لتسجيلك في:
-{session.title}
-التجمع رقم {session.session_number}
-
-التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}
-
-تسجيلك قيد المراجعة وسيتم إخطارك بالموافقة قريباً.
-
-فريق ثلوثية الأعمال
-    """
-
-    return _send_email(
+    return _queue_email(
         to=email_address,
         subject=f"استلام التسجيل - {session.title}",
-        text=body
+        text=_render_email('registration_pending.txt', name=name, session=session)
     )
 
 
 def send_registration_confirmed_email(email_address, name, session, qr_data=None):
     """Send registration confirmed email with optional QR code"""
-    # Build HTML body with optional QR code
-    qr_section = ""
-    if qr_data and session.send_qr_in_email:
-        qr_section = """
-<br><br>
-<p style="text-align: center;"><strong>رمز الحضور الخاص بك:</strong></p>
-<p style="text-align: center;"><img src="cid:qrcode" alt="QR Code" style="max-width: 200px;"></p>
-<p style="text-align: center; font-size: 12px;">أظهر هذا الرمز عند الحضور</p>
-"""
-
-    html_body = f"""
-<html>
-<head>
-<meta charset="utf-8">
-</head>
-<body dir="rtl" style="font-family: Arial, sans-serif; text-align: right;">
-<p>مرحباً {name},</p>
-
-<p>تم تأكيد تسجيلك في:</p>
-<p><strong>{session.title}</strong><br>
-التجمع رقم {session.session_number}</p>
-
-<p>التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}<br>
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}</p>
-{qr_section}
-<p>نتطلع لرؤيتك معنا!</p>
-
-<p>فريق ثلوثية الأعمال</p>
-</body>
-</html>
-    """
-
-    plain_body = f"""
-مرحباً {name},
-
-تم تأكيد تسجيلك في:
-{session.title}
-التجمع رقم {session.session_number}
-
-التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}
-
-نتطلع لرؤيتك معنا!
-
-فريق ثلوثية الأعمال
-    """
+    attachments = _qr_attachments(qr_data) if session.send_qr_in_email else None
+    context = {'name': name, 'session': session, 'show_qr': bool(qr_data and session.send_qr_in_email)}
 
-    # Build attachments if QR code provided
-    attachments = None
-    if qr_data and session.send_qr_in_email:
-        if qr_data.startswith('data:image/png;base64,'):
-            qr_base64 = qr_data.split(',')[1]
-            attachments = [{
-                "filename": "qrcode.png",
-                "content": qr_base64,
-                "content_id": "qrcode"
-            }]
-
-    return _send_email(
+    return _queue_email(
         to=email_address,
         subject=f"تأكيد التسجيل - {session.title}",
-        html=html_body,
-        text=plain_body,
+        html=_render_email('registration_confirmed.html', **context),
+        text=_render_email('confirmation.txt', **context),
         attachments=attachments
     )
 
 
 def send_companion_registered_email(email_address, companion_name, registrant_name, session, is_approved=False, qr_data=None):
     """Send email to companion notifying them of registration"""
-    # Build status message and optional QR
-    if is_approved:
-        status_message = "نتطلع لرؤيتك معنا!"
-        qr_section = ""
-        if qr_data and session.send_qr_in_email:
-            qr_section = """
-<br><br>
-<p style="text-align: center;"><strong>رمز الحضور الخاص بك:</strong></p>
-<p style="text-align: center;"><img src="cid:qrcode" alt="QR Code" style="max-width: 200px;"></p>
-<p style="text-align: center; font-size: 12px;">أظهر هذا الرمز عند الحضور</p>
-"""
-    else:
-        status_message = "تسجيلك قيد المراجعة وسيتم إخطارك بالموافقة قريباً."
-        qr_section = ""
-
-    html_body = f"""
-<html>
-<head>
-<meta charset="utf-8">
-</head>
-<body dir="rtl" style="font-family: Arial, sans-serif; text-align: right;">
-<p>مرحباً {companion_name},</p>
-
-<p>تم تسجيلك كمرافق للأستاذ/ة {registrant_name} في:</p>
-<p><strong>{session.title}</strong><br>
-التجمع رقم {session.session_number}</p>
-
-<p>التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}<br>
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}</p>
-{qr_section}
-<p>{status_message}</p>
-
-<p>فريق ثلوثية الأعمال</p>
-</body>
-</html>
-    """
-
-    plain_body = f"""
-مرحباً {companion_name},
-
-تم تسجيلك كمرافق للأستاذ/ة {registrant_name} في:
-{session.title}
-التجمع رقم {session.session_number}
-
-التاريخ: {session.date.strftime('%Y-%m-%d %H:%M')}
-المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}
-
-{status_message}
-
-فريق ثلوثية الأعمال
-    """
+    show_qr = bool(is_approved and qr_data and session.send_qr_in_email)
+    context = {
+        'companion_name': companion_name,
+        'registrant_name': registrant_name,
+        'session': session,
+        'is_approved': is_approved,
+        'show_qr': show_qr
+    }
 
-    # Build attachments if QR code provided
-    attachments = None
-    if is_approved and qr_data and session.send_qr_in_email:
-        if qr_data.startswith('data:image/png;base64,'):
-            qr_base64 = qr_data.split(',')[1]
-            attachments = [{
-                "filename": "qrcode.png",
-                "content": qr_base64,
-                "content_id": "qrcode"
-            }]
-
-    return _send_email(
+    return _queue_email(
         to=email_address,
         subject=f"تم تسجيلك كمرافق - {session.title}",
-        html=html_body,
-        text=plain_body,
-        attachments=attachments
+        html=_render_email('companion_registered.html', **context),
+        text=_render_email('companion_registered.txt', **context),
+        attachments=_qr_attachments(qr_data) if show_qr else None
     )
 
 
 def send_password_reset_email(email_address, name, reset_url):
     """Send password reset email to user"""
-    body = f"""
-مرحباً {name},
-
-لقد طلبت إعادة تعيين كلمة المرور الخاصة بك.
-
-اضغط على الرابط التالي لإعادة تعيين كلمة المرور:
-{reset_url}
-
-هذا الرابط صالح لمدة ساعة واحدة فقط.
-
-إذا لم تطلب إعادة تعيين كلمة المرور، يمكنك تجاهل هذه الرسالة.
-
-فريق ثلوثية الأعمال
-    """
-
-    return _send_email(
+    return _queue_email(
         to=email_address,
         subject="إعادة تعيين كلمة المرور - ثلوثية الأعمال",
-        text=body
+        text=_render_email('password_reset.txt', name=name, reset_url=reset_url)
     )
 
 
@@ -444,8 +552,8 @@ def generate_invite_token():
     """Generate secure random token for invitations"""
     return secrets.token_urlsafe(32)
 
-def send_invitation_email(email_address, session, token, custom_message=None):
-    """Send invitation email with registration link"""
+def invitation_email(session, token, custom_message=None):
+    """Subject and plain-text body of an invitation, as (subject, text)"""
     # Generate registration link
     registration_link = f"{os.environ.get('BASE_URL', 'https://your-domain.com')}/event/{session.slug or session.id}/register?token={token}"
 
@@ -453,26 +561,16 @@ def send_invitation_email(email_address, session, token, custom_message=None):
     if custom_message:
         body = custom_message.replace('[رابط التسجيل]', registration_link)
     else:
-        body = f"""
-مرحباً،
-
-نود دعوتك لحضور جلسة "{session.title}" في ثلوثية الأعمال.
-
-تفاصيل الجلسة:
-📅 التاريخ: {session.date.strftime('%Y-%m-%d')}
-🕐 الوقت: {session.date.strftime('%H:%M')}
-📍 المكان: {session.location or 'سيتم الإعلان عنه لاحقاً'}
+        body = _render_email('invitation.txt', session=session, registration_link=registration_link)
 
-هذه دعوة خاصة. استخدم الرابط أدناه للتسجيل:
-{registration_link}
+    return f"دعوة خاصة - {session.title}", body
 
-نتطلع لرؤيتك معنا!
 
-فريق ثلوثية الأعمال
-        """
-
-    return _send_email(
+def send_invitation_email(email_address, session, token, custom_message=None):
+    """Send invitation email with registration link"""
+    subject, body = invitation_email(session, token, custom_message)
+    return _queue_email(
         to=email_address,
-        subject=f"دعوة خاصة - {session.title}",
+        subject=subject,
         text=body
     )
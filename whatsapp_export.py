@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+WhatsApp invitation links for many users.
+
+Missing invite tokens are created up front with one anti-join and one bulk
+insert; the links are then built from a single users-join-invites query read
+in chunks (a server-side cursor on PostgreSQL), so exports can be streamed
+as CSV, or as a ZIP with one CSV per batch, without holding every recipient
+in memory.
+"""
+
+import csv
+import io
+import urllib.parse
+import zipfile
+from datetime import datetime
+
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import Invite, User
+from utils import generate_invite_token, format_phone_number
+
+FETCH_SIZE = 1000
+INSERT_CHUNK_SIZE = 1000
+INSERT_ATTEMPTS = 3
+CSV_HEADER = ['الاسم', 'الهاتف', 'رابط واتساب', 'رابط التسجيل']
+# Excel needs the BOM to read Arabic UTF-8 CSV
+CSV_BOM = '\ufeff'
+
+
+def _recipients(user_ids):
+    return db.and_(User.id.in_(user_ids), User.phone.isnot(None), User.phone != '')
+
+
+def create_missing_invites(session_obj, user_ids):
+    """Give every selected user with a phone an invite for the session; returns how many were created"""
+    missing = db.session.scalars(
+        db.select(User.email).where(
+            _recipients(user_ids),
+            ~db.select(Invite.id).where(
+                Invite.session_id == session_obj.id, Invite.email == User.email
+            ).exists()
+        )
+    ).all()
+
+    created = 0
+    for start in range(0, len(missing), INSERT_CHUNK_SIZE):
+        emails = missing[start:start + INSERT_CHUNK_SIZE]
+        for _ in range(INSERT_ATTEMPTS):
+            now = datetime.utcnow()
+            try:
+                if emails:
+                    db.session.execute(db.insert(Invite), [{
+                        'session_id': session_obj.id,
+                        'email': email,
+                        'token': generate_invite_token(),
+                        'expires_at': session_obj.date,
+                        'created_at': now
+                    } for email in emails])
+                db.session.commit()
+                created += len(emails)
+                break
+            except IntegrityError:
+                # Invited by someone else meanwhile; their token is reused below
+                db.session.rollback()
+                taken = set(db.session.scalars(db.select(Invite.email).where(
+                    Invite.session_id == session_obj.id, Invite.email.in_(emails)
+                )))
+                emails = [email for email in emails if email not in taken]
+        else:
+            raise RuntimeError("Invites kept colliding with another invitation run; try again")
+    return created
+
+
+def iter_links(session_obj, user_ids, base_url):
+    """Yield a dict per recipient (name, phone, whatsapp_url, registration_link) in user id order"""
+    template = app.jinja_env.get_template('whatsapp/invitation.txt')
+    register_url = f"{base_url}/event/{session_obj.slug or session_obj.id}/register?token="
+    rows = db.session.execute(
+        db.select(User.name, User.phone, Invite.token)
+        # Outer join so the planner drives from the selected users: SQLite without
+        # statistics otherwise scans the session's invites against the id list
+        .outerjoin(Invite, db.and_(Invite.session_id == session_obj.id, Invite.email == User.email))
+        .where(_recipients(user_ids), Invite.token.isnot(None))
+        .order_by(User.id)
+        .execution_options(yield_per=FETCH_SIZE)
+    )
+    for name, phone, token in rows:
+        registration_link = register_url + token
+        message = template.render(name=name, session=session_obj, registration_link=registration_link)
+        # WhatsApp API expects number without + sign
+        wa_phone = format_phone_number(phone).replace('+', '')
+        yield {
+            'name': name,
+            'phone': phone,
+            'whatsapp_url': f"https://wa.me/{wa_phone}?text={urllib.parse.quote(message)}",
+            'registration_link': registration_link
+        }
+
+
+def stream_csv(links, flush_every=200):
+    """CSV text chunks for links, flushed every flush_every rows"""
+    buffer = io.StringIO()
+    buffer.write(CSV_BOM)
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    for count, link in enumerate(links, 1):
+        writer.writerow([link['name'], link['phone'], link['whatsapp_url'], link['registration_link']])
+        if count % flush_every == 0:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _drain(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+class _ZipStream:
+    """Write-only file object handing zipfile's output to a generator"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def stream_zip(links, batch_size, prefix='whatsapp-invites'):
+    """ZIP bytes for links with one CSV per batch_size recipients, yielded as each batch is written"""
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', zipfile.ZIP_DEFLATED) as archive:
+        batch = []
+        number = 0
+        for link in links:
+            batch.append(link)
+            if len(batch) == batch_size:
+                number += 1
+                _write_batch(archive, f"{prefix}-{number:03d}.csv", batch)
+                batch = []
+                yield stream.drain()
+        if batch or not number:
+            number += 1
+            _write_batch(archive, f"{prefix}-{number:03d}.csv", batch)
+    yield stream.drain()
+
+
+def _write_batch(archive, name, batch):
+    with archive.open(name, 'w') as member:
+        member.write(''.join(stream_csv(batch)).encode('utf-8'))